@@ -1,45 +1,62 @@
+import asyncio
+import hashlib
+import hmac
+import time
 from enum import Enum
+from uuid import uuid4
 from typing import Optional
 from datetime import datetime, timedelta, timezone
 
-from jose import jwt, JWTError
-from passlib.context import CryptContext
+from jose import JWTError
 from pydantic import EmailStr
 from fastapi import Depends, Request, HTTPException, status, Response
 from sqlalchemy.ext.asyncio import AsyncSession
-from fastapi_cache.decorator import cache
 
-from config.config import get_auth_data
+from config.config import settings
 from config.logger import logger
 from repository import AuthRepository
 from database.database import get_db
-from schemas import UserRead
+from schemas import UserRead, TokenIntrospection
+from database.models import AccountStatus
+from hashing import password_hasher, pwd_context, needs_rehash
+from jwt_keys import key_ring
+from instrumentation import timed, timed_stage
+from revocation import revocation_list, REFRESH_REUSE_DETECTED
 
 
 class TokenType(str, Enum):
     ACCESS = "access"
     REFRESH = "refresh"
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# strong references to running hash upgrades, the event loop only keeps weak ones
+_hash_upgrades: set[asyncio.Task] = set()
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
+@timed_stage("password_hash", "verify")
+async def verify_password(plain_password: str, hashed_password: str) -> bool:
+    return await password_hasher.verify(pwd_context, plain_password, hashed_password)
 
 def create_token_factory(expire: timedelta):
     async def create_token(data: dict) -> str:
         to_encode = data.copy()
         token_expire = datetime.now(timezone.utc) + expire
         to_encode.update({"exp": token_expire})
-        # TODO: реализовать хранение секретов
-        auth_data = get_auth_data()
-        if not auth_data or 'secret_key' not in auth_data or 'algorithm' not in auth_data:
-            raise ValueError("Auth data must contain 'secret_key' and 'algorithm'")
-        encode_jwt = jwt.encode(to_encode, auth_data['secret_key'], algorithm=auth_data['algorithm'])
+        with timed("jwt", "encode"):
+            encode_jwt = key_ring.encode(to_encode)
         return encode_jwt
     return create_token
     
-create_access_token = create_token_factory(timedelta(minutes=30))
-create_refresh_token = create_token_factory(timedelta(days=7))
+create_access_token = create_token_factory(timedelta(minutes=settings.ACCESS_TOKEN_TTL_MINUTES))
+create_refresh_token = create_token_factory(timedelta(days=settings.REFRESH_TOKEN_TTL_DAYS))
+
+async def issue_tokens(user_id: int, session_id: Optional[str] = None) -> tuple[str, str]:
+    # both tokens carry the session id so that logout and refresh token reuse
+    # can revoke the whole session; the refresh token also gets a single-use jti
+    session_id = session_id or uuid4().hex
+    access_token = await create_access_token({"sub": str(user_id), "sid": session_id, "type": TokenType.ACCESS.value})
+    refresh_token = await create_refresh_token(
+        {"sub": str(user_id), "sid": session_id, "jti": uuid4().hex, "type": TokenType.REFRESH.value}
+    )
+    return access_token, refresh_token
 
 async def set_token_cookie(response: Response, token_type: TokenType, token_value: str):
     cookie_params = {"key": f"user_{token_type.value}_token", "value": token_value, "httponly": True}
@@ -47,12 +64,18 @@ async def set_token_cookie(response: Response, token_type: TokenType, token_valu
         cookie_params["path"] = "/auth/refresh"
     response.set_cookie(**cookie_params)
 
-@cache(expire=100)
 async def authenticate_user(email: EmailStr, password: str, session: AsyncSession):
-    user = await AuthRepository.find_user_by_email(email, session)
-    if not user or verify_password(plain_password=password, hashed_password=user.password) is False:
+    credentials = await AuthRepository.find_credentials(email, session)
+    if not credentials or await verify_password(plain_password=password, hashed_password=credentials[1]) is False:
         logger.warning("Invalid email or password")
         return None
+    user, hashed_password = credentials
+    if needs_rehash(pwd_context, hashed_password):
+        # the new hash costs as much as the check did, so it is made and
+        # stored after the response instead of doubling this login
+        task = asyncio.create_task(AuthRepository.upgrade_password_hash(user.id, user.email, hashed_password, password))
+        _hash_upgrades.add(task)
+        task.add_done_callback(_hash_upgrades.discard)
     return user
 
 async def get_token(request: Request, token_type: TokenType):
@@ -62,12 +85,46 @@ async def get_token(request: Request, token_type: TokenType):
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail=f"{token_type.value}_token is not found")
     return token
 
-@cache(expire=100)
-async def get_current_user(request: Request, token_type: TokenType, session: AsyncSession):
-    token = await get_token(request, token_type)
+# clock skew allowed between the workers that issue and check tokens
+LEGACY_TOKEN_LEEWAY = 60
+
+def token_type_of(payload: dict) -> TokenType:
+    if payload.get('type'):
+        return TokenType(payload['type'])
+    # tokens issued before the type claim: refresh tokens with rotation had a
+    # jti, the ones before it had nothing but a lifetime no access token has
+    if payload.get('jti'):
+        return TokenType.REFRESH
+    if payload['exp'] - time.time() > settings.ACCESS_TOKEN_TTL_MINUTES * 60 + LEGACY_TOKEN_LEEWAY:
+        return TokenType.REFRESH
+    return TokenType.ACCESS
+
+def check_token_type(payload: dict, token_type: TokenType):
+    # spent jtis are not in the revocation filter, so a refresh token must
+    # never be accepted where an access token is expected
     try:
-        auth_data = get_auth_data()
-        payload = jwt.decode(token, auth_data['secret_key'], algorithms=[auth_data['algorithm']])
+        actual = token_type_of(payload)
+    except ValueError:
+        actual = None
+    if actual != token_type:
+        logger.error("%s token expected for user with id - %s", token_type.value, payload.get('sub'))
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail=f'{token_type.value} token expected')
+
+def legacy_token_id(token: str) -> str:
+    # a refresh token from before rotation has no jti, the token itself is spent instead
+    return f"legacy:{hashlib.sha256(token.encode()).hexdigest()}"
+
+async def is_token_revoked(token: str, payload: dict) -> bool:
+    if await revocation_list.is_revoked(payload.get('sid')):
+        return True
+    # an untyped token that is not told apart by its lifetime, a legacy
+    # refresh token close to expiry, stops working once it has been exchanged
+    return not payload.get('type') and await revocation_list.is_spent(legacy_token_id(token))
+
+def decode_token(token: str) -> dict:
+    try:
+        with timed("jwt", "decode"):
+            payload = key_ring.decode(token)
     except JWTError:
         logger.error("token is not found")
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='Token not found')
@@ -76,25 +133,131 @@ async def get_current_user(request: Request, token_type: TokenType, session: Asy
     user_id = payload.get('sub')
     expire_time = datetime.fromtimestamp(int(expire), tz=timezone.utc)
     if (not expire) or (expire_time < datetime.now(timezone.utc)):
-        logger.error(f"token for user with id - {user_id} is not found")
+        logger.error("token for user with id - %s is not found", user_id)
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='token has been expired')
     
-    user_id = payload.get('sub')
     if not user_id:
-        logger.error(f"user_id is not found in token")
+        logger.error("user_id is not found in token")
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='user_id is not found')
-    user = await AuthRepository.find_user_by_id(int(user_id), session)
+    return payload
+
+async def get_current_user(request: Request, token_type: TokenType, session: AsyncSession):
+    token = await get_token(request, token_type)
+    payload = decode_token(token)
+    check_token_type(payload, token_type)
+    if await is_token_revoked(token, payload):
+        logger.error("revoked token for user with id - %s was used", payload['sub'])
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='token has been revoked')
+    return await get_token_user(payload, session)
+
+async def get_token_user(payload: dict, session: AsyncSession):
+    user = await AuthRepository.find_user_by_id(int(payload['sub']), session)
     if not user:
         logger.error("user in not found")
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='User not found')
+    if user.status == AccountStatus.BANNED:
+        logger.error("banned user with id - %s tried to authenticate", user.id)
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail='account is banned')
     return user
 
+async def rotate_refresh_token(request: Request, session: AsyncSession) -> tuple[str, str]:
+    token = await get_token(request, TokenType.REFRESH)
+    payload = decode_token(token)
+    check_token_type(payload, TokenType.REFRESH)
+    session_id, jti = payload.get('sid'), payload.get('jti')
+    if not jti:
+        if not settings.REFRESH_ACCEPT_LEGACY:
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='refresh token is outdated')
+        if not await revocation_list.claim(legacy_token_id(token), ttl=int(payload['exp'] - time.time())):
+            REFRESH_REUSE_DETECTED.inc()
+            logger.error("legacy refresh token reuse for user with id - %s", payload['sub'])
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='token has been revoked')
+        session_id = None
+    else:
+        if await revocation_list.is_revoked(session_id):
+            logger.error("refresh token of revoked session for user with id - %s was used", payload['sub'])
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='token has been revoked')
+        # spending the jti is atomic, so of two refreshes with the same token only one wins;
+        # the other one means the token leaked and the whole session is ended
+        if not await revocation_list.claim(jti, ttl=int(payload['exp'] - time.time())):
+            REFRESH_REUSE_DETECTED.inc()
+            await revocation_list.revoke(session_id)
+            logger.error("refresh token reuse for user with id - %s, session revoked", payload['sub'])
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='token has been revoked')
+    user = await get_token_user(payload, session)
+    return await issue_tokens(user.id, session_id)
+
+async def revoke_session(request: Request):
+    # the refresh cookie is only sent to /auth/refresh, so logout usually
+    # finds the session id in the access token; an expired one still counts
+    for token_type in (TokenType.ACCESS, TokenType.REFRESH):
+        token = request.cookies.get(f'user_{token_type.value}_token')
+        if not token:
+            continue
+        try:
+            payload = key_ring.decode(token, options={"verify_exp": False})
+        except JWTError:
+            continue
+        if payload.get('sid'):
+            await revocation_list.revoke(payload['sid'])
+            logger.info("session of user with id - %s revoked", payload.get('sub'))
+            return
+
+async def introspect_tokens(tokens: list[str], session: AsyncSession) -> list[TokenIntrospection]:
+    # same checks as get_current_user, but the users of the whole batch
+    # are resolved with a single multi-get
+    payloads = []
+    for token in tokens:
+        try:
+            payload = decode_token(token)
+            check_token_type(payload, TokenType.ACCESS)
+        except HTTPException as e:
+            payloads.append(e)
+            continue
+        if await is_token_revoked(token, payload):
+            payloads.append(HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='token has been revoked'))
+            continue
+        payloads.append(payload)
+    user_ids = [int(payload['sub']) for payload in payloads if isinstance(payload, dict)]
+    users = await AuthRepository.find_users_by_ids(user_ids, session) if user_ids else {}
+
+    results = []
+    for payload in payloads:
+        if isinstance(payload, HTTPException):
+            results.append(TokenIntrospection(active=False, error=payload.detail))
+            continue
+        user = users.get(int(payload['sub']))
+        if user is None:
+            results.append(TokenIntrospection(active=False, error='User not found', claims=payload))
+            continue
+        results.append(TokenIntrospection(
+            active=user.status == AccountStatus.ACTIVE,
+            error=None if user.status == AccountStatus.ACTIVE else f'account is {user.status.value}',
+            claims=payload,
+            user_id=user.id,
+            role=user.role,
+            status=user.status,
+        ))
+    return results
+
+async def authorize_introspection(request: Request, session: AsyncSession):
+    # a service presents one of INTROSPECTION_CLIENT_TOKENS as a bearer
+    # token, anyone else needs an admin session
+    scheme, _, credentials = request.headers.get("authorization", "").partition(" ")
+    if scheme.lower() == "bearer" and credentials:
+        for client_token in settings.INTROSPECTION_CLIENT_TOKENS:
+            if hmac.compare_digest(credentials.encode(), client_token.encode()):
+                return
+        logger.error("introspection with an unknown client token")
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="unknown client token")
+    await get_current_admin_user(request, session)
+
 # admin can ban users
 async def get_current_admin_user(request: Request, session: AsyncSession):
     current_user = await get_current_user(request, TokenType.ACCESS, session)
     if current_user.role == "admin":
-        logger.info(f"user with email - {current_user.email} is admin")
+        logger.info("user with email - %s is admin", current_user.email)
         return current_user
-    logger.info(f"user with email - {current_user.email} is not admin")
+    logger.info("user with email - %s is not admin", current_user.email)
     raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="У вас недостаточно прав доступа")
     
\ No newline at end of file
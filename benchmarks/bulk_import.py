@@ -0,0 +1,64 @@
+"""Measure bulk import throughput in rows per second.
+
+    AUTH_DATABASE_URL=sqlite+aiosqlite:///bench.db python -m benchmarks.bulk_import --rows 20000
+
+Runs the import pipeline against whatever database AUTH_DATABASE_URL points
+at, once with already-hashed passwords and once with plaintext ones. The
+plaintext run uses --bcrypt-rounds so it finishes in reasonable time; the
+rate scales with 2 ** rounds and the number of workers.
+"""
+import argparse
+import asyncio
+import json
+
+from passlib.context import CryptContext
+from sqlalchemy import delete
+
+from bulk_import import import_users
+from config.config import available_cpus
+from database.database import async_engine, async_session, create_tables
+from database.models import Users
+from hashing import PasswordHasher
+
+
+async def generate_lines(rows: int, prefix: str, password: str):
+    yield "email,password,role,status,balance"
+    for i in range(rows):
+        yield f"{prefix}{i}@example.com,{password},user,active,0"
+
+
+async def run(name: str, rows: int, password: str, context: CryptContext, workers: int):
+    async with async_session() as session:
+        await session.execute(delete(Users).where(Users.email.like(f"bench-{name}-%")))
+        await session.commit()
+        hasher = PasswordHasher(executor="process", workers=workers, max_queue=workers)
+        try:
+            report = await import_users(generate_lines(rows, f"bench-{name}-", password), "csv", session, hasher, context)
+        finally:
+            hasher.shutdown()
+    result = report.as_dict()
+    result.pop("errors")
+    return result
+
+
+async def main(args):
+    await create_tables()
+    context = CryptContext(schemes=["bcrypt"], bcrypt__rounds=args.bcrypt_rounds)
+    prehashed = context.hash("password")
+    results = {
+        "workers": args.workers,
+        "bcrypt_rounds": args.bcrypt_rounds,
+        "prehashed": await run("prehashed", args.rows, prehashed, context, args.workers),
+        "plaintext": await run("plaintext", args.plaintext_rows, "password", context, args.workers),
+    }
+    await async_engine.dispose()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--plaintext-rows", type=int, default=2000)
+    parser.add_argument("--bcrypt-rounds", type=int, default=4)
+    parser.add_argument("--workers", type=int, default=available_cpus())
+    asyncio.run(main(parser.parse_args()))
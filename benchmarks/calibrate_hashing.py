@@ -0,0 +1,126 @@
+"""Pick password hashing costs for this machine.
+
+    python -m benchmarks.calibrate_hashing --target-ms 250 --memory-mb 256 --workers 8
+
+Hashes with --workers threads at once, the way the PasswordHasher pool of one
+server worker does under load (the default is that pool's size,
+PASSWORD_HASH_WORKERS, derived from the usable CPUs and SERVER_WORKERS like in
+the service), and reports the most expensive parameters whose median latency
+stays within --target-ms: the argon2id time cost at the largest memory cost
+that fits (--memory-mb is the budget for all --workers hashing together), and
+the bcrypt rounds. The result is JSON with the measurements and an "env"
+section for the chosen scheme that can go straight into the deployment's
+environment. Run it on the hardware (and CPU quota) the service runs on.
+"""
+import argparse
+import json
+import os
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+os.environ.setdefault("SECRET_KEY", "benchmark")
+os.environ.setdefault("ALGORITHM", "HS256")
+os.environ.setdefault("AUTH_DATABASE_URL", "sqlite+aiosqlite:///:memory:")
+os.environ.setdefault("REDIS_URL", "redis://localhost:6379/0")
+
+from passlib.hash import argon2, bcrypt
+
+from config.config import available_cpus, settings
+
+
+# OWASP's lower bound for argon2id memory
+MIN_ARGON2_MEMORY_KIB = 19 * 1024
+MAX_ARGON2_TIME_COST = 10
+BCRYPT_ROUNDS = range(10, 17)
+
+
+def measure(handler, workers: int, samples: int) -> float:
+    # median seconds per hash with `workers` hashes running concurrently
+    def one(_):
+        start = time.perf_counter()
+        handler.hash("calibration-password")
+        return time.perf_counter() - start
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        durations = list(pool.map(one, range(workers * samples)))
+    return statistics.median(durations)
+
+
+def calibrate_argon2(target: float, memory_kib: int, parallelism: int, workers: int, samples: int) -> dict:
+    runs = []
+    while True:
+        best = None
+        for time_cost in range(1, MAX_ARGON2_TIME_COST + 1):
+            handler = argon2.using(type="ID", time_cost=time_cost, memory_cost=memory_kib, parallelism=parallelism)
+            seconds = measure(handler, workers, samples)
+            runs.append({"memory_kib": memory_kib, "time_cost": time_cost, "ms": round(seconds * 1000, 1)})
+            if seconds > target:
+                break
+            best = time_cost
+        # even one pass over this much memory is too slow, try with less
+        if best is not None or memory_kib // 2 < MIN_ARGON2_MEMORY_KIB:
+            break
+        memory_kib //= 2
+    return {
+        "runs": runs,
+        "fits_target": best is not None,
+        "env": {
+            "PASSWORD_HASH_SCHEME": "argon2",
+            "PASSWORD_ARGON2_TIME_COST": best or 1,
+            "PASSWORD_ARGON2_MEMORY_COST": memory_kib,
+            "PASSWORD_ARGON2_PARALLELISM": parallelism,
+        },
+    }
+
+
+def calibrate_bcrypt(target: float, workers: int, samples: int) -> dict:
+    runs = []
+    best = None
+    for rounds in BCRYPT_ROUNDS:
+        seconds = measure(bcrypt.using(rounds=rounds), workers, samples)
+        runs.append({"rounds": rounds, "ms": round(seconds * 1000, 1)})
+        if seconds > target:
+            break
+        best = rounds
+    return {
+        "runs": runs,
+        "fits_target": best is not None,
+        "env": {
+            "PASSWORD_HASH_SCHEME": "bcrypt",
+            "PASSWORD_BCRYPT_ROUNDS": best or BCRYPT_ROUNDS[0],
+        },
+    }
+
+
+def main(args) -> dict:
+    target = args.target_ms / 1000
+    memory_kib = args.memory_mb * 1024 // args.workers
+    result = {
+        "cpus": available_cpus(),
+        "server_workers": settings.SERVER_WORKERS,
+        "workers": args.workers,
+        "target_ms": args.target_ms,
+        "memory_budget_mb": args.memory_mb,
+    }
+    if memory_kib < MIN_ARGON2_MEMORY_KIB:
+        result["warning"] = (
+            f"{args.memory_mb} MB across {args.workers} workers is below "
+            f"{MIN_ARGON2_MEMORY_KIB // 1024} MB per hash, argon2 is calibrated at the minimum"
+        )
+        memory_kib = MIN_ARGON2_MEMORY_KIB
+    result["argon2"] = calibrate_argon2(target, memory_kib, args.parallelism, args.workers, args.samples)
+    result["bcrypt"] = calibrate_bcrypt(target, args.workers, args.samples)
+    result["env"] = result[args.scheme]["env"]
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--target-ms", type=float, default=250.0, help="median latency of one hash under load")
+    parser.add_argument("--memory-mb", type=int, default=256, help="memory for the concurrent argon2 hashes of one server worker")
+    parser.add_argument("--workers", type=int, default=settings.PASSWORD_HASH_WORKERS, help="concurrent hashes, one server worker's pool")
+    parser.add_argument("--parallelism", type=int, default=1, help="argon2 lanes per hash, the pool already uses every core")
+    parser.add_argument("--samples", type=int, default=3, help="hashes per worker for each candidate")
+    parser.add_argument("--scheme", choices=["argon2", "bcrypt"], default="argon2", help="scheme for the env section")
+    print(json.dumps(main(parser.parse_args()), indent=2))
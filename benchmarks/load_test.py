@@ -0,0 +1,256 @@
+"""Replay a mix of auth requests and report per-route latency and throughput.
+
+    python -m benchmarks.load_test --requests 2000 --concurrency 20 --output run.json
+    python -m benchmarks.load_test --baseline run.json --max-regression 0.15
+
+By default the app runs in-process behind httpx's ASGI transport, on a
+throwaway SQLite database, fakeredis and the fake Kafka producer, so nothing
+but `pip install -r benchmarks/requirements.txt` is needed. With --url the
+same mix is sent to a running server instead (e.g. local uvicorn wired to
+real Postgres/Redis/Kafka) and the stand-ins are not used.
+
+Each virtual user registers and logs in before the measured run and keeps its
+own cookies. --workload-out/--workload-in save and replay the exact request
+sequence so two runs can be compared request for request. The result is JSON;
+with --baseline the p95 and throughput of every route are compared against an
+earlier result and the process exits with 1 on a regression.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+import httpx
+
+
+ROUTES = ("register", "login", "refresh", "user_info", "update_user")
+DEFAULT_MIX = "login=20,refresh=15,user_info=50,update_user=5,register=10"
+PASSWORD = "benchmark-password"
+
+
+def parse_mix(mix: str) -> dict[str, float]:
+    weights = {}
+    for part in mix.split(","):
+        route, _, weight = part.partition("=")
+        if route not in ROUTES:
+            raise ValueError(f"unknown route in mix: {route}")
+        weights[route] = float(weight)
+    return weights
+
+
+def generate_workload(requests: int, mix: dict[str, float], seed: int) -> list[str]:
+    rng = random.Random(seed)
+    return rng.choices(list(mix), weights=list(mix.values()), k=requests)
+
+
+def percentile(samples: list[float], q: float) -> float:
+    ordered = sorted(samples)
+    index = min(int(round(q * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+
+class VirtualUser:
+    def __init__(self, client: httpx.AsyncClient, number: int, run_id: str):
+        self.client = client
+        self.prefix = f"bench-{run_id}-{number}"
+        self.email = f"{self.prefix}@example.com"
+        self.counter = 0
+
+    def _next_email(self) -> str:
+        self.counter += 1
+        return f"{self.prefix}-{self.counter}@example.com"
+
+    async def setup(self):
+        response = await self.client.post("/auth/register/", json={"email": self.email, "password": PASSWORD})
+        response.raise_for_status()
+        await self.login()
+
+    async def register(self):
+        return await self.client.post("/auth/register/", json={"email": self._next_email(), "password": PASSWORD})
+
+    async def login(self):
+        return await self.client.post("/auth/login/", json={"email": self.email, "password": PASSWORD})
+
+    async def refresh(self):
+        return await self.client.post("/auth/refresh/")
+
+    async def user_info(self):
+        return await self.client.get("/auth/user_info/")
+
+    async def update_user(self):
+        new_email = self._next_email()
+        response = await self.client.patch("/auth/update_user/", json={"email": new_email, "password": PASSWORD})
+        if response.status_code == 200:
+            self.email = new_email
+        return response
+
+
+async def run_workload(users: list[VirtualUser], workload: list[str]) -> tuple[dict, float]:
+    latencies = defaultdict(list)
+    errors = defaultdict(int)
+    queue = asyncio.Queue()
+    for route in workload:
+        queue.put_nowait(route)
+
+    async def worker(user: VirtualUser):
+        while not queue.empty():
+            route = queue.get_nowait()
+            start = time.perf_counter()
+            try:
+                response = await getattr(user, route)()
+                failed = response.status_code >= 400
+            except httpx.HTTPError:
+                failed = True
+            latencies[route].append(time.perf_counter() - start)
+            if failed:
+                errors[route] += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(user) for user in users))
+    elapsed = time.perf_counter() - start
+
+    routes = {}
+    for route, samples in sorted(latencies.items()):
+        routes[route] = {
+            "requests": len(samples),
+            "errors": errors[route],
+            "throughput": round(len(samples) / elapsed, 2),
+            "mean_ms": round(sum(samples) / len(samples) * 1000, 3),
+            "p50_ms": round(percentile(samples, 0.50) * 1000, 3),
+            "p95_ms": round(percentile(samples, 0.95) * 1000, 3),
+            "p99_ms": round(percentile(samples, 0.99) * 1000, 3),
+            "max_ms": round(max(samples) * 1000, 3),
+        }
+    return routes, elapsed
+
+
+def compare(result: dict, baseline: dict, max_regression: float) -> list[str]:
+    regressions = []
+    for route, current in result["routes"].items():
+        previous = baseline["routes"].get(route)
+        if previous is None:
+            continue
+        if current["p95_ms"] > previous["p95_ms"] * (1 + max_regression):
+            regressions.append(f"{route}: p95 {previous['p95_ms']}ms -> {current['p95_ms']}ms")
+        if current["throughput"] < previous["throughput"] * (1 - max_regression):
+            regressions.append(f"{route}: throughput {previous['throughput']} -> {current['throughput']} req/s")
+    return regressions
+
+
+def use_local_stand_ins(database_path: str):
+    # must run before the app is imported, settings are read at import time
+    os.environ.setdefault("SECRET_KEY", "benchmark")
+    os.environ.setdefault("ALGORITHM", "HS256")
+    os.environ["AUTH_DATABASE_URL"] = f"sqlite+aiosqlite:///{database_path}"
+    os.environ["REDIS_URL"] = "redis://localhost:6379/0"
+    os.environ["KAFKA_PRODUCER"] = "fake"
+    # every virtual user logs in from the same address over and over
+    os.environ.setdefault("RATE_LIMIT_LOGIN_PER_EMAIL", "1000000")
+    os.environ.setdefault("RATE_LIMIT_LOGIN_PER_IP", "1000000")
+
+    import fakeredis
+    from redis import asyncio as aioredis
+
+    fake_redis = fakeredis.FakeAsyncRedis()
+
+    async def from_url(*args, **kwargs):
+        return fake_redis
+
+    aioredis.from_url = from_url
+
+
+async def benchmark(args, client_factory) -> dict:
+    if args.workload_in:
+        with open(args.workload_in, encoding="utf-8") as workload_file:
+            workload = json.load(workload_file)
+    else:
+        workload = generate_workload(args.requests, parse_mix(args.mix), args.seed)
+    if args.workload_out:
+        with open(args.workload_out, "w", encoding="utf-8") as workload_file:
+            json.dump(workload, workload_file)
+
+    run_id = f"{int(time.time())}-{os.getpid()}"
+    clients = [client_factory() for _ in range(args.concurrency)]
+    try:
+        users = [VirtualUser(client, number, run_id) for number, client in enumerate(clients)]
+        for user in users:
+            await user.setup()
+        routes, elapsed = await run_workload(users, workload)
+    finally:
+        for client in clients:
+            await client.aclose()
+
+    total = sum(route["requests"] for route in routes.values())
+    return {
+        "target": args.url or "in-process",
+        "requests": total,
+        "concurrency": args.concurrency,
+        "seed": args.seed,
+        "mix": args.mix if not args.workload_in else args.workload_in,
+        "bcrypt_rounds": args.bcrypt_rounds,
+        "seconds": round(elapsed, 3),
+        "throughput": round(total / elapsed, 2),
+        "errors": sum(route["errors"] for route in routes.values()),
+        "routes": routes,
+    }
+
+
+async def main(args) -> dict:
+    if args.url:
+        return await benchmark(args, lambda: httpx.AsyncClient(base_url=args.url, timeout=args.timeout))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        use_local_stand_ins(os.path.join(tmp, "bench.db"))
+        import main as app_module
+        from database.database import async_engine
+        from hashing import pwd_context
+
+        if args.bcrypt_rounds:
+            pwd_context.update(bcrypt__rounds=args.bcrypt_rounds)
+
+        transport = httpx.ASGITransport(app=app_module.app)
+        try:
+            async with app_module.lifespan(app_module.app):
+                return await benchmark(
+                    args,
+                    lambda: httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=args.timeout),
+                )
+        finally:
+            await async_engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", help="benchmark a running server instead of the in-process app")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="comma separated route=weight pairs")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--timeout", type=float, default=30.0)
+    parser.add_argument("--bcrypt-rounds", type=int, help="in-process only, lower the bcrypt cost to shift the focus off hashing")
+    parser.add_argument("--workload-in", help="replay a request sequence saved with --workload-out")
+    parser.add_argument("--workload-out", help="save the generated request sequence")
+    parser.add_argument("--output", help="write the result JSON here as well as to stdout")
+    parser.add_argument("--baseline", help="result JSON of an earlier run to compare against")
+    parser.add_argument("--max-regression", type=float, default=0.10)
+    parser.add_argument("--log-level", default="WARNING", help="the app logs every request at INFO")
+    args = parser.parse_args()
+
+    os.environ.setdefault("LOG_LEVEL", args.log_level)
+    result = asyncio.run(main(args))
+    output = json.dumps(result, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output_file:
+            output_file.write(output + "\n")
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as baseline_file:
+            regressions = compare(result, json.load(baseline_file), args.max_regression)
+        for regression in regressions:
+            print(f"regression: {regression}", file=sys.stderr)
+        sys.exit(1 if regressions else 0)
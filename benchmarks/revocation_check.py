@@ -0,0 +1,72 @@
+"""Measure the cost of the token revocation check.
+
+    python -m benchmarks.revocation_check --revoked 100000 --checks 200000
+
+Fills a RevocationList with revoked ids in fakeredis, then checks ids that
+were never revoked (the common case, answered by the Bloom filter alone) and
+ids that were (confirmed in Redis). The plain Redis EXISTS per check that the
+filter avoids is timed for comparison; against a real server add the network
+round trip to that number.
+"""
+import argparse
+import asyncio
+import json
+import time
+from uuid import uuid4
+
+import fakeredis
+
+from revocation import RevocationList
+
+
+async def timed_checks(check, ids: list[str]) -> tuple[float, int]:
+    hits = 0
+    start = time.perf_counter()
+    for id in ids:
+        hits += await check(id)
+    return (time.perf_counter() - start) / len(ids), hits
+
+
+async def main(args):
+    redis = fakeredis.FakeAsyncRedis()
+    revocations = RevocationList("bench-revocations", 3600, args.capacity, args.error_rate, 3600)
+    revoked = [uuid4().hex for _ in range(args.revoked)]
+    async with redis.pipeline(transaction=False) as pipe:
+        for id in revoked:
+            pipe.set(f"revoked:{id}", 1, ex=3600)
+            pipe.xadd("bench-revocations", {"id": id})
+        await pipe.execute()
+    start = time.perf_counter()
+    await revocations.start(redis)
+    load_seconds = time.perf_counter() - start
+
+    valid = [uuid4().hex for _ in range(args.checks)]
+    start = time.perf_counter()
+    false_positives = sum(id in revocations.filter for id in valid)
+    filter_seconds = (time.perf_counter() - start) / len(valid)
+    check_seconds, _ = await timed_checks(revocations.is_revoked, valid)
+    revoked_seconds, confirmed = await timed_checks(revocations.is_revoked, revoked[:args.checks // 10])
+    exists_seconds, _ = await timed_checks(lambda id: redis.exists(f"revoked:{id}"), valid[:args.checks // 10])
+    await revocations.stop()
+
+    print(json.dumps({
+        "revoked_ids": args.revoked,
+        "filter_bytes": len(revocations.filter.bits),
+        "hash_count": revocations.filter.hash_count,
+        "load_seconds": round(load_seconds, 3),
+        "false_positive_rate": round(false_positives / len(valid), 5),
+        "filter_lookup_us": round(filter_seconds * 1e6, 3),
+        "valid_token_check_us": round(check_seconds * 1e6, 3),
+        "revoked_token_check_us": round(revoked_seconds * 1e6, 3),
+        "revoked_confirmed": confirmed,
+        "redis_exists_per_check_us": round(exists_seconds * 1e6, 3),
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--revoked", type=int, default=100000)
+    parser.add_argument("--checks", type=int, default=200000)
+    parser.add_argument("--capacity", type=int, default=1_000_000)
+    parser.add_argument("--error-rate", type=float, default=0.001)
+    asyncio.run(main(parser.parse_args()))
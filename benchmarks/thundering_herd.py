@@ -0,0 +1,69 @@
+"""Fire concurrent lookups of the same cold user and count database queries.
+
+    AUTH_DATABASE_URL=sqlite+aiosqlite:///bench.db python -m benchmarks.thundering_herd --concurrency 200
+
+Runs AuthRepository.find_user_by_id with an empty cache from --concurrency
+tasks at once, first through the uncached function (what every request did
+on a cold key before coalescing) and then through the cached one.
+"""
+import argparse
+import asyncio
+import json
+import time
+
+import fakeredis
+from fastapi_cache import FastAPICache
+from fastapi_cache.backends.redis import RedisBackend
+from sqlalchemy import delete
+
+from cache import local_cache, CACHE_COALESCED
+from database.database import async_engine, async_session, create_tables, DB_QUERY_DURATION
+from database.models import Users
+from repository import AuthRepository
+
+
+def selects() -> float:
+    for metric in DB_QUERY_DURATION.collect():
+        for sample in metric.samples:
+            if sample.name.endswith("_count") and sample.labels["statement"] == "SELECT":
+                return sample.value
+    return 0.0
+
+
+async def herd(lookup, user_id: int, concurrency: int) -> dict:
+    async def one():
+        async with async_session() as session:
+            return await lookup(user_id, session)
+
+    before = selects()
+    start = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(concurrency)))
+    return {"seconds": round(time.perf_counter() - start, 4), "db_queries": int(selects() - before)}
+
+
+async def main(args):
+    await create_tables()
+    FastAPICache.init(RedisBackend(fakeredis.FakeAsyncRedis()), prefix="bench")
+    async with async_session() as session:
+        await session.execute(delete(Users).where(Users.email == "herd@example.com"))
+        user = Users(email="herd@example.com", password="x")
+        session.add(user)
+        await session.commit()
+        user_id = user.id
+
+    uncached = AuthRepository.find_user_by_id.__wrapped__.__get__(AuthRepository)
+    results = {
+        "concurrency": args.concurrency,
+        "uncached": await herd(uncached, user_id, args.concurrency),
+        "cached": await herd(AuthRepository.find_user_by_id, user_id, args.concurrency),
+        "coalesced": CACHE_COALESCED.labels("users:id")._value.get(),
+    }
+    local_cache.clear()
+    await async_engine.dispose()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--concurrency", type=int, default=200)
+    asyncio.run(main(parser.parse_args()))
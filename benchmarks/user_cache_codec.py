@@ -0,0 +1,82 @@
+"""Compare the cache encodings of UserRead.
+
+    python -m benchmarks.user_cache_codec --iterations 100000
+
+"json" is the previous setup: fastapi-cache's JsonCoder on a UserRead that
+still carried the password hash, validated through a TypeAdapter on every
+hit. "msgpack" is UserRecordCoder. Reported are bytes per entry, encode and
+decode time per entry, and the cost of turning a cached user into a response
+body, through FastAPI's jsonable_encoder and with the memoized json_bytes().
+"""
+import argparse
+import json
+import os
+import time
+from datetime import datetime
+
+os.environ.setdefault("SECRET_KEY", "benchmark")
+os.environ.setdefault("ALGORITHM", "HS256")
+os.environ.setdefault("AUTH_DATABASE_URL", "sqlite+aiosqlite:///:memory:")
+os.environ.setdefault("REDIS_URL", "redis://localhost:6379/0")
+
+from fastapi.encoders import jsonable_encoder
+from fastapi_cache.coder import JsonCoder
+from pydantic import TypeAdapter
+
+from database.models import AccountStatus, RoleEnum
+from hashing import build_password_context
+from schemas import UserRead, UserRecordCoder
+
+
+class LegacyUserRead(UserRead):
+    password: str
+
+
+def per_call_us(func, iterations: int) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    return round((time.perf_counter() - start) / iterations * 1e6, 3)
+
+
+def main(args) -> dict:
+    fields = {
+        "id": 123456,
+        "email": "some.user@example.com",
+        "balance": 1250.5,
+        "role": RoleEnum.USER,
+        "status": AccountStatus.ACTIVE,
+        "created_at": datetime(2025, 3, 14, 15, 9, 26, 535897),
+    }
+    legacy = LegacyUserRead(**fields, password=build_password_context("bcrypt", 4).hash("password"))
+    user = UserRead(**fields)
+    adapter = TypeAdapter(LegacyUserRead)
+
+    legacy_encoded = JsonCoder.encode(legacy)
+    encoded = UserRecordCoder.encode(user)
+    assert UserRecordCoder.decode(encoded) == user
+
+    return {
+        "iterations": args.iterations,
+        "json": {
+            "bytes": len(legacy_encoded),
+            "encode_us": per_call_us(lambda: JsonCoder.encode(legacy), args.iterations),
+            "decode_us": per_call_us(lambda: adapter.validate_python(JsonCoder.decode(legacy_encoded)), args.iterations),
+        },
+        "msgpack": {
+            "bytes": len(encoded),
+            "encode_us": per_call_us(lambda: UserRecordCoder.encode(user), args.iterations),
+            "decode_us": per_call_us(lambda: UserRecordCoder.decode(encoded), args.iterations),
+        },
+        "response": {
+            "jsonable_encoder_us": per_call_us(lambda: json.dumps(jsonable_encoder(user)).encode(), args.iterations),
+            "json_bytes_first_us": per_call_us(lambda: UserRecordCoder.decode(encoded).json_bytes(), args.iterations),
+            "json_bytes_cached_us": per_call_us(user.json_bytes, args.iterations),
+        },
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=100000)
+    print(json.dumps(main(parser.parse_args()), indent=2))
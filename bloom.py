@@ -0,0 +1,77 @@
+import hashlib
+import math
+
+
+def bloom_parameters(capacity: int, error_rate: float) -> tuple[int, int]:
+    # bit count and hash count for the given capacity and false positive rate
+    size = max(int(-capacity * math.log(error_rate) / math.log(2) ** 2), 8)
+    hash_count = max(int(round(size / capacity * math.log(2))), 1)
+    return size, hash_count
+
+
+def bloom_positions(item: str, size: int, hash_count: int) -> list[int]:
+    # k bit positions from one blake2b digest (Kirsch-Mitzenmacher double
+    # hashing), so a lookup is a single hash plus k bit tests
+    digest = hashlib.blake2b(item.encode("utf-8"), digest_size=16).digest()
+    h1 = int.from_bytes(digest[:8], "little")
+    h2 = int.from_bytes(digest[8:], "little") | 1
+    return [(h1 + i * h2) % size for i in range(hash_count)]
+
+
+class BloomFilter:
+    # bits are stored most significant first, the same layout as a Redis
+    # bitmap, so the buffer can be written to Redis as is
+    def __init__(self, capacity: int, error_rate: float):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size, self.hash_count = bloom_parameters(capacity, error_rate)
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def add(self, item: str):
+        for position in bloom_positions(item, self.size, self.hash_count):
+            self.bits[position >> 3] |= 0x80 >> (position & 7)
+        self.count += 1
+
+    def __contains__(self, item: str) -> bool:
+        bits = self.bits
+        for position in bloom_positions(item, self.size, self.hash_count):
+            if not bits[position >> 3] & (0x80 >> (position & 7)):
+                return False
+        return True
+
+    def __len__(self) -> int:
+        return self.count
+
+
+class RedisBloomFilter:
+    # the same filter kept in a Redis bitmap and shared by all workers;
+    # a lookup or an insert is a single BITFIELD command
+    def __init__(self, key: str, capacity: int, error_rate: float):
+        self.key = key
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size, self.hash_count = bloom_parameters(capacity, error_rate)
+
+    async def add(self, redis, *items: str):
+        if not items:
+            return
+        args = []
+        for item in items:
+            for position in bloom_positions(item, self.size, self.hash_count):
+                args += ["SET", "u1", position, 1]
+        await redis.execute_command("BITFIELD", self.key, *args)
+
+    async def contains(self, redis, item: str) -> bool:
+        args = []
+        for position in bloom_positions(item, self.size, self.hash_count):
+            args += ["GET", "u1", position]
+        return all(await redis.execute_command("BITFIELD", self.key, *args))
+
+    async def replace(self, redis, local: BloomFilter):
+        # swaps in a filter built locally, readers never see a half-built one
+        staging_key = f"{self.key}:staging"
+        async with redis.pipeline(transaction=True) as pipe:
+            pipe.set(staging_key, bytes(local.bits))
+            pipe.rename(staging_key, self.key)
+            await pipe.execute()
@@ -0,0 +1,277 @@
+import argparse
+import asyncio
+import csv
+import json
+import time
+from collections import deque
+from datetime import datetime
+from typing import AsyncIterator, Optional
+
+from passlib.context import CryptContext
+from pydantic import EmailStr, TypeAdapter, ValidationError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from config.config import settings, available_cpus
+from config.logger import logger
+from database.database import async_engine, async_session, dialect_insert
+from database.models import Users, RoleEnum, AccountStatus
+from email_filter import email_filter
+from hashing import PasswordHasher, pwd_context
+
+
+email_adapter = TypeAdapter(EmailStr)
+
+COLUMNS = ("email", "password", "role", "status", "balance", "created_at")
+
+
+class ImportReport:
+    def __init__(self, max_errors: int):
+        self.max_errors = max_errors
+        self.processed = 0
+        self.inserted = 0
+        self.duplicates = 0
+        self.failed = 0
+        self.errors = []
+        self._started = time.perf_counter()
+
+    def add_error(self, line: int, email: Optional[str], error: str):
+        self.failed += 1
+        if len(self.errors) < self.max_errors:
+            self.errors.append({"line": line, "email": email, "error": error})
+
+    def as_dict(self) -> dict:
+        elapsed = time.perf_counter() - self._started
+        return {
+            "processed": self.processed,
+            "inserted": self.inserted,
+            "duplicates": self.duplicates,
+            "failed": self.failed,
+            "seconds": round(elapsed, 3),
+            "rows_per_second": round(self.processed / elapsed, 1) if elapsed else None,
+            "errors": self.errors,
+        }
+
+
+async def iter_lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    buffer = b""
+    async for chunk in chunks:
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            yield line.decode("utf-8").rstrip("\r")
+    if buffer:
+        yield buffer.decode("utf-8").rstrip("\r")
+
+
+async def iter_file_lines(path: str) -> AsyncIterator[str]:
+    with open(path, encoding="utf-8") as source:
+        for line in source:
+            yield line.rstrip("\r\n")
+
+
+class LineFeed:
+    # the input of the one csv.reader of an import: lines arrive
+    # asynchronously, the reader is only asked for a record once all of its
+    # lines are here
+    def __init__(self):
+        self.lines = deque()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> str:
+        if not self.lines:
+            raise StopIteration
+        return self.lines.popleft()
+
+
+async def iter_rows(lines: AsyncIterator[str], fmt: str) -> AsyncIterator[tuple[int, Optional[dict], Optional[str]]]:
+    # yields (line number, raw row, parse error); a CSV record can span lines
+    # when a quoted field contains newlines, its first line is reported
+    header = None
+    line_number = 0
+    feed = LineFeed()
+    reader = csv.reader(feed)
+    record_start = 0
+    quotes = 0
+    async for line in lines:
+        line_number += 1
+        if fmt == "ndjson":
+            if not line.strip():
+                continue
+            try:
+                yield line_number, json.loads(line), None
+            except ValueError as e:
+                yield line_number, None, f"malformed {fmt} row: {e}"
+            continue
+        if not feed.lines:
+            if not line.strip():
+                continue
+            record_start = line_number
+        feed.lines.append(line + "\n")
+        # an odd number of quotes so far means a quoted field goes on in the next line
+        quotes += line.count('"')
+        if quotes % 2:
+            continue
+        quotes = 0
+        # more than one record when a quote in an unquoted field held lines back
+        while feed.lines:
+            try:
+                record = next(reader)
+            except csv.Error as e:
+                feed.lines.clear()
+                yield record_start, None, f"malformed {fmt} row: {e}"
+                break
+            if header is None:
+                header = [column.strip() for column in record]
+            else:
+                yield record_start, dict(zip(header, record)), None
+    if feed.lines:
+        yield record_start, None, f"malformed {fmt} row: unterminated quoted field"
+
+
+def prepare_row(raw: dict, context: CryptContext) -> tuple[dict, bool]:
+    # returns the row for insertion and whether its password still needs hashing
+    email = email_adapter.validate_python((raw.get("email") or "").strip())
+    password = raw.get("password")
+    if not password:
+        raise ValueError("password is required")
+    row = {
+        "email": email,
+        "password": password,
+        "role": RoleEnum(raw.get("role") or RoleEnum.USER),
+        "status": AccountStatus(raw.get("status") or AccountStatus.ACTIVE),
+        "balance": float(raw.get("balance") or 0),
+        "created_at": datetime.now(),
+    }
+    # hashes exported from another system are kept as-is
+    return row, context.identify(password, required=False) is None
+
+
+class UserImporter:
+    def __init__(self, session: AsyncSession, hasher: PasswordHasher, context: CryptContext, batch_size: int, max_errors: int):
+        self.session = session
+        self.hasher = hasher
+        self.context = context
+        self.batch_size = batch_size
+        self.report = ImportReport(max_errors)
+
+    async def run(self, lines: AsyncIterator[str], fmt: str) -> ImportReport:
+        batch = []
+        pending_write = None
+        async for line_number, raw, error in iter_rows(lines, fmt):
+            self.report.processed += 1
+            if error:
+                self.report.add_error(line_number, None, error)
+                continue
+            if not isinstance(raw, dict):
+                self.report.add_error(line_number, None, "row must be an object")
+                continue
+            try:
+                batch.append((line_number, *prepare_row(raw, self.context)))
+            except ValidationError as e:
+                self.report.add_error(line_number, raw.get("email"), e.errors()[0]["msg"])
+            except (ValueError, TypeError) as e:
+                self.report.add_error(line_number, raw.get("email"), str(e))
+            if len(batch) >= self.batch_size:
+                pending_write = await self._flush(batch, pending_write)
+                batch = []
+        if batch:
+            pending_write = await self._flush(batch, pending_write)
+        if pending_write is not None:
+            await pending_write
+        return self.report
+
+    async def _flush(self, batch: list, pending_write: Optional[asyncio.Task]) -> asyncio.Task:
+        # hash this batch on all cores while the previous one is being written
+        to_hash = [row for _, row, needs_hash in batch if needs_hash]
+        hashed = await self.hasher.hash_many(self.context, [row["password"] for row in to_hash])
+        for row, password_hash in zip(to_hash, hashed):
+            row["password"] = password_hash
+        if pending_write is not None:
+            await pending_write
+        return asyncio.create_task(self._write(batch))
+
+    async def _write(self, batch: list):
+        rows = [row for _, row, _ in batch]
+        try:
+            if async_engine.dialect.name == "postgresql":
+                inserted = await self._copy_rows(rows)
+            else:
+                inserted = await self._insert_rows(rows)
+            await self.session.commit()
+        except Exception as e:
+            # a failed batch fails its own rows, the import goes on with the next one
+            logger.error("bulk import: writing %s rows failed: %s", len(rows), e)
+            await self.session.rollback()
+            for line_number, row, _ in batch:
+                self.report.add_error(line_number, row["email"], f"batch not written: {e}")
+            return
+        await email_filter.add(*(row["email"] for row in rows))
+        self.report.inserted += inserted
+        self.report.duplicates += len(rows) - inserted
+        logger.info("bulk import: %s rows processed, %s inserted", self.report.processed, self.report.inserted)
+
+    async def _insert_rows(self, rows: list[dict]) -> int:
+        query = dialect_insert(Users).values(rows).on_conflict_do_nothing(index_elements=[Users.email])
+        result = await self.session.execute(query)
+        return result.rowcount
+
+    async def _copy_rows(self, rows: list[dict]) -> int:
+        # COPY into a session-local staging table, then one INSERT ... SELECT
+        # so duplicates are skipped by the unique index on email
+        connection = await self.session.connection()
+        raw_connection = await connection.get_raw_connection()
+        driver = raw_connection.driver_connection
+        await driver.execute(
+            "CREATE TEMP TABLE IF NOT EXISTS users_import ON COMMIT DELETE ROWS AS "
+            f"SELECT {', '.join(COLUMNS)} FROM users WITH NO DATA"
+        )
+        records = [
+            (row["email"], row["password"], row["role"].name, row["status"].name, row["balance"], row["created_at"])
+            for row in rows
+        ]
+        await driver.copy_records_to_table("users_import", records=records, columns=COLUMNS)
+        status = await driver.execute(
+            f"INSERT INTO users ({', '.join(COLUMNS)}) "
+            f"SELECT {', '.join(COLUMNS)} FROM users_import "
+            "ON CONFLICT (email) DO NOTHING"
+        )
+        return int(status.split()[-1])
+
+
+async def import_users(
+    lines: AsyncIterator[str],
+    fmt: str,
+    session: AsyncSession,
+    hasher: Optional[PasswordHasher] = None,
+    context: CryptContext = pwd_context,
+    workers: int = settings.BULK_IMPORT_WORKERS,
+) -> ImportReport:
+    own_hasher = hasher is None
+    if own_hasher:
+        # separate from the request-path pool; inside a web worker it is kept
+        # small (BULK_IMPORT_WORKERS) so an import does not starve logins
+        hasher = PasswordHasher(executor="process", workers=workers, max_queue=workers)
+    importer = UserImporter(session, hasher, context, settings.BULK_IMPORT_BATCH_SIZE, settings.BULK_IMPORT_MAX_ERRORS)
+    try:
+        return await importer.run(lines, fmt)
+    finally:
+        if own_hasher:
+            await asyncio.to_thread(hasher.shutdown)
+
+
+async def main(path: str, fmt: str, workers: int):
+    async with async_session() as session:
+        report = await import_users(iter_file_lines(path), fmt, session, workers=workers)
+    print(json.dumps(report.as_dict(), indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bulk import users from CSV or NDJSON")
+    parser.add_argument("path")
+    parser.add_argument("--format", choices=["csv", "ndjson"], help="defaults to the file extension")
+    parser.add_argument("--workers", type=int, default=available_cpus(), help="hashing processes, all CPUs by default")
+    args = parser.parse_args()
+    fmt = args.format or ("ndjson" if args.path.endswith((".ndjson", ".jsonl")) else "csv")
+    asyncio.run(main(args.path, fmt, args.workers))
@@ -0,0 +1,607 @@
+import asyncio
+import math
+import random
+import time
+from collections import OrderedDict
+from functools import wraps
+from typing import Any, Callable, Optional, Type
+from uuid import uuid4
+
+from fastapi_cache import FastAPICache
+from fastapi_cache.coder import Coder, JsonCoder
+from prometheus_client import Counter, Histogram
+from pydantic import TypeAdapter
+
+from config.config import settings
+from config.logger import logger
+from instrumentation import timed
+
+
+CACHE_HITS = Counter("cache_hits_total", "Cache lookups answered from the cache", ["namespace", "tier"])
+CACHE_MISSES = Counter("cache_misses_total", "Cache lookups that fell through to the wrapped call", ["namespace"])
+CACHE_LATENCY = Histogram(
+    "cache_lookup_duration_seconds",
+    "Time spent reading a key from the cache backend",
+    ["namespace"],
+    buckets=[0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25],
+)
+CACHE_COALESCED = Counter(
+    "cache_coalesced_total",
+    "Lookups that waited for an identical in-flight lookup instead of running their own",
+    ["namespace"],
+)
+CACHE_EARLY_REFRESHES = Counter(
+    "cache_early_refreshes_total",
+    "Cache hits that were refreshed ahead of their expiry",
+    ["namespace"],
+)
+CACHE_LOCK_WAITS = Counter(
+    "cache_fill_lock_waits_total",
+    "Misses that waited for another worker holding the fill lock",
+    ["namespace"],
+)
+CACHE_STALE_FILLS = Counter(
+    "cache_stale_fills_total",
+    "Fills not written to the cache because their key was invalidated while they ran",
+    ["namespace"],
+)
+CACHE_INVALIDATIONS = Counter(
+    "cache_invalidations_total",
+    "Keys evicted from the in-process cache",
+    ["source"],
+)
+
+
+class LocalCache:
+    # in-process TTL + LRU cache, the first tier in front of Redis
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+
+    def get(self, key: str):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def delete(self, key: str):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+local_cache = LocalCache(maxsize=settings.CACHE_L1_MAXSIZE, ttl=settings.CACHE_L1_TTL)
+
+
+class InvalidationLog:
+    # generation of the last invalidation of recent keys. A fill notes the
+    # generation before it reads and does not store its value if the key was
+    # invalidated meanwhile: the row it read may predate the write (a ban,
+    # an update) that caused the invalidation
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.generation = 0
+        self._keys: OrderedDict[str, int] = OrderedDict()
+        # keys dropped from the log count as invalidated at this generation
+        self._forgotten = 0
+
+    def bump(self, full_keys: list[str]):
+        self.generation += 1
+        for full_key in full_keys:
+            self._keys[full_key] = self.generation
+            self._keys.move_to_end(full_key)
+        while len(self._keys) > self.maxsize:
+            _, generation = self._keys.popitem(last=False)
+            self._forgotten = max(self._forgotten, generation)
+
+    def bump_all(self):
+        self.generation += 1
+        self._keys.clear()
+        self._forgotten = self.generation
+
+    def changed_since(self, full_key: str, generation: int) -> bool:
+        return self._keys.get(full_key, self._forgotten) > generation
+
+
+invalidation_log = InvalidationLog(maxsize=settings.CACHE_L1_MAXSIZE)
+
+
+# coder, validator, expire and tier settings per namespace, shared by get_many/set_many
+_namespaces: dict[str, tuple] = {}
+
+
+def cache_key(namespace: str, key: str) -> str:
+    return f"{FastAPICache.get_prefix()}:{namespace}:{key}"
+
+
+# lookups currently being filled in this worker, concurrent misses for the
+# same key wait for the first one instead of querying the database again
+_in_flight: dict[str, asyncio.Future] = {}
+
+# moving average of how long a fill takes per namespace, for early refresh
+_fill_durations: dict[str, float] = {}
+
+RELEASE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+# KEYS[1] entry, KEYS[2] its version; ARGV[1] the version read before the
+# fill ('' when there was none), ARGV[2] value, ARGV[3] expiry in seconds.
+# Every invalidation bumps the version, so a fill whose row was read before
+# an invalidation by any worker does not store it
+FILL_SCRIPT = """
+local version = redis.call('GET', KEYS[2]) or ''
+if version ~= ARGV[1] then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3])
+return 1
+"""
+
+
+def _version_key(full_key: str) -> str:
+    return f"{full_key}:version"
+
+
+def _version(value: Optional[bytes]) -> str:
+    return value.decode() if value is not None else ""
+
+
+def _retrieve_exception(future: asyncio.Future):
+    # followers may all be gone, do not log the leader's error a second time
+    if not future.cancelled():
+        future.exception()
+
+
+def _refresh_early(namespace: str, ttl: float) -> bool:
+    # probabilistic early expiration (XFetch): the closer the entry is to
+    # expiring and the slower it is to rebuild, the likelier one request
+    # refreshes it ahead of time, so it rarely expires under load
+    beta = settings.CACHE_EARLY_REFRESH_BETA
+    duration = _fill_durations.get(namespace)
+    if not beta or not duration or ttl < 0:
+        return False
+    return -duration * beta * math.log(random.random() or 1e-12) >= ttl
+
+
+async def _acquire_fill_lock(redis, full_key: str) -> Optional[str]:
+    token = uuid4().hex
+    acquired = await redis.set(f"{full_key}:lock", token, nx=True, px=int(settings.CACHE_FILL_LOCK_TTL * 1000))
+    return token if acquired else None
+
+
+async def _release_fill_lock(redis, full_key: str, token: str):
+    try:
+        await redis.eval(RELEASE_LOCK_SCRIPT, 1, f"{full_key}:lock", token)
+    except Exception as e:
+        logger.warning("releasing cache fill lock for %s failed: %s", full_key, e)
+
+
+async def _store_fill(backend, full_key: str, value: bytes, expire: int, version: str) -> bool:
+    # False when the key was invalidated since `version` was read
+    redis = getattr(backend, "redis", None)
+    with timed("redis", "set"):
+        if redis is None:
+            await backend.set(full_key, value, expire)
+            return True
+        return bool(await redis.eval(FILL_SCRIPT, 2, full_key, _version_key(full_key), version, value, expire))
+
+
+async def _wait_for_fill(backend, full_key: str):
+    # another worker holds the lock, poll for its result for a bounded time
+    deadline = time.monotonic() + settings.CACHE_FILL_LOCK_WAIT
+    while time.monotonic() < deadline:
+        await asyncio.sleep(settings.CACHE_FILL_LOCK_POLL)
+        value = await backend.get(full_key)
+        if value is not None:
+            return value
+    return None
+
+
+def cached(
+    namespace: str,
+    key: Callable[..., Optional[str]],
+    expire: int,
+    model: Any = None,
+    coder: Type[Coder] = JsonCoder,
+    local: bool = True,
+):
+    # key receives the same arguments as the wrapped function and must build
+    # the cache key from semantic values only (ids, emails, token subjects),
+    # never from per-request objects like AsyncSession or Request.
+    # Returning None skips the cache for that call. A coder that builds the
+    # model itself needs no model, its hits are then used without validation;
+    # values the coder can not decode count as misses.
+    adapter = TypeAdapter(model) if model is not None else None
+    _namespaces[namespace] = (coder, adapter, expire, local)
+
+    def decode(full_key: str, value: bytes, generation: int):
+        result = coder.decode(value)
+        result = adapter.validate_python(result) if adapter else result
+        if local and not invalidation_log.changed_since(full_key, generation):
+            local_cache.set(full_key, result)
+        return result
+
+    async def fill(full_key: str, func: Callable, args, kwargs):
+        generation = invalidation_log.generation
+        backend = FastAPICache.get_backend()
+        redis = getattr(backend, "redis", None)
+        start = time.perf_counter()
+        try:
+            with timed("redis", "get"):
+                if redis is not None:
+                    async with redis.pipeline(transaction=False) as pipe:
+                        pipe.pttl(full_key).get(full_key).get(_version_key(full_key))
+                        ttl, value, version = await pipe.execute()
+                    ttl = ttl / 1000 if ttl >= 0 else ttl
+                    version = _version(version)
+                else:
+                    ttl, value = await backend.get_with_ttl(full_key)
+                    version = ""
+        except Exception as e:
+            logger.warning("cache read for %s failed: %s", full_key, e)
+            # without a version a fill is only kept in the local tier
+            ttl, value, version = -1, None, None
+        CACHE_LATENCY.labels(namespace).observe(time.perf_counter() - start)
+
+        if value is not None and not _refresh_early(namespace, ttl):
+            try:
+                result = decode(full_key, value, generation)
+            except Exception as e:
+                logger.warning("cache entry %s could not be decoded: %s", full_key, e)
+                value = None
+            else:
+                CACHE_HITS.labels(namespace, "redis").inc()
+                return result
+        if value is not None:
+            CACHE_EARLY_REFRESHES.labels(namespace).inc()
+        else:
+            CACHE_MISSES.labels(namespace).inc()
+
+        lock = None
+        if value is None and settings.CACHE_FILL_LOCK and redis is not None:
+            try:
+                lock = await _acquire_fill_lock(redis, full_key)
+                if lock is None:
+                    CACHE_LOCK_WAITS.labels(namespace).inc()
+                    value = await _wait_for_fill(backend, full_key)
+                    if value is not None:
+                        CACHE_HITS.labels(namespace, "redis").inc()
+                        return decode(full_key, value, generation)
+            except Exception as e:
+                logger.warning("cache fill lock for %s failed: %s", full_key, e)
+
+        try:
+            start = time.perf_counter()
+            result = await func(*args, **kwargs)
+            duration = time.perf_counter() - start
+            _fill_durations[namespace] = 0.9 * _fill_durations.get(namespace, duration) + 0.1 * duration
+            # "not found" is never cached, so a freshly created user is visible at once
+            if result is None:
+                return result
+            # not stored when the key was invalidated meanwhile, by this worker
+            # or (through its version in Redis) by any other
+            if invalidation_log.changed_since(full_key, generation):
+                CACHE_STALE_FILLS.labels(namespace).inc()
+                return result
+            if version is not None:
+                try:
+                    if not await _store_fill(backend, full_key, coder.encode(result), expire, version):
+                        CACHE_STALE_FILLS.labels(namespace).inc()
+                        return result
+                except Exception as e:
+                    logger.warning("cache write for %s failed: %s", full_key, e)
+            if local:
+                local_cache.set(full_key, result, expire)
+            return result
+        finally:
+            if lock is not None:
+                await _release_fill_lock(redis, full_key, lock)
+
+    def decorator(func: Callable):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            semantic_key = key(*args, **kwargs)
+            if semantic_key is None or not FastAPICache.get_enable():
+                return await func(*args, **kwargs)
+            full_key = cache_key(namespace, semantic_key)
+
+            if local:
+                result = local_cache.get(full_key)
+                if result is not None:
+                    CACHE_HITS.labels(namespace, "local").inc()
+                    return result
+
+            while True:
+                flight = _in_flight.get(full_key)
+                if flight is None:
+                    break
+                CACHE_COALESCED.labels(namespace).inc()
+                try:
+                    return await asyncio.shield(flight)
+                except asyncio.CancelledError:
+                    # only retry when the leading request was cancelled, not this one
+                    if not flight.cancelled():
+                        raise
+
+            flight = asyncio.get_running_loop().create_future()
+            flight.add_done_callback(_retrieve_exception)
+            _in_flight[full_key] = flight
+            try:
+                result = await fill(full_key, func, args, kwargs)
+            except asyncio.CancelledError:
+                flight.cancel()
+                raise
+            except Exception as e:
+                flight.set_exception(e)
+                raise
+            else:
+                flight.set_result(result)
+                return result
+            finally:
+                _in_flight.pop(full_key, None)
+        return wrapper
+    return decorator
+
+
+class FillGuard:
+    # taken before a batch read of cache and database: get_many_keys notes the
+    # Redis version of each key it misses, and set_many_keys stores only the
+    # keys no worker invalidated since
+    def __init__(self):
+        self.generation = invalidation_log.generation
+        self.versions: dict[str, str] = {}
+
+
+def fill_guard() -> FillGuard:
+    return FillGuard()
+
+
+async def get_many(namespace: str, keys: list[str], guard: Optional[FillGuard] = None) -> dict[str, Any]:
+    found = await get_many_keys([(namespace, key) for key in keys], guard)
+    return {key: value for (_, key), value in found.items()}
+
+
+async def get_many_keys(
+    items: list[tuple[str, str]], guard: Optional[FillGuard] = None
+) -> dict[tuple[str, str], Any]:
+    # (namespace, key) pairs, possibly from several namespaces: local tier
+    # first, then one MGET for the rest; only hits are returned
+    generation = guard.generation if guard is not None else invalidation_log.generation
+    found = {}
+    missing = []
+    for namespace, key in items:
+        local = _namespaces[namespace][3]
+        value = local_cache.get(cache_key(namespace, key)) if local else None
+        if value is not None:
+            CACHE_HITS.labels(namespace, "local").inc()
+            found[(namespace, key)] = value
+        else:
+            missing.append((namespace, key))
+    if not missing or not FastAPICache.get_enable():
+        return found
+
+    backend = FastAPICache.get_backend()
+    full_keys = [cache_key(namespace, key) for namespace, key in missing]
+    start = time.perf_counter()
+    try:
+        redis = getattr(backend, "redis", None)
+        with timed("redis", "mget"):
+            if redis is not None and guard is not None:
+                values = await redis.mget(full_keys + [_version_key(full_key) for full_key in full_keys])
+                for full_key, version in zip(full_keys, values[len(full_keys):]):
+                    guard.versions[full_key] = _version(version)
+                values = values[:len(full_keys)]
+            elif redis is not None:
+                values = await redis.mget(full_keys)
+            else:
+                values = [await backend.get(full_key) for full_key in full_keys]
+                if guard is not None:
+                    guard.versions.update((full_key, "") for full_key in full_keys)
+    except Exception as e:
+        logger.warning("cache multi-get of %s keys failed: %s", len(full_keys), e)
+        values = [None] * len(full_keys)
+    elapsed = time.perf_counter() - start
+    for namespace in {namespace for namespace, _ in missing}:
+        CACHE_LATENCY.labels(namespace).observe(elapsed)
+
+    for (namespace, key), full_key, value in zip(missing, full_keys, values):
+        coder, adapter, _, local = _namespaces[namespace]
+        try:
+            result = coder.decode(value) if value is not None else None
+            result = adapter.validate_python(result) if adapter and result is not None else result
+        except Exception as e:
+            logger.warning("cache entry %s could not be decoded: %s", full_key, e)
+            result = None
+        if result is None:
+            CACHE_MISSES.labels(namespace).inc()
+            continue
+        CACHE_HITS.labels(namespace, "redis").inc()
+        if local and not invalidation_log.changed_since(full_key, generation):
+            local_cache.set(full_key, result)
+        found[(namespace, key)] = result
+    return found
+
+
+async def set_many(namespace: str, items: dict[str, Any], guard: Optional[FillGuard] = None):
+    await set_many_keys([(namespace, key, value) for key, value in items.items()], guard)
+
+
+async def set_many_keys(items: list[tuple[str, str, Any]], guard: Optional[FillGuard] = None):
+    # (namespace, key, value) triples written in one pipeline, each with its
+    # namespace's expiry. With the guard of the read that produced them, keys
+    # invalidated since are skipped, and keys whose version was not read are
+    # only kept in the local tier
+    if not items or not FastAPICache.get_enable():
+        return
+    entries = []
+    for namespace, key, value in items:
+        full_key = cache_key(namespace, key)
+        if guard is not None and invalidation_log.changed_since(full_key, guard.generation):
+            CACHE_STALE_FILLS.labels(namespace).inc()
+            continue
+        entries.append((namespace, full_key, value))
+    if not entries:
+        return
+    writes = []
+    for namespace, full_key, value in entries:
+        coder, _, expire, _ = _namespaces[namespace]
+        version = guard.versions.get(full_key) if guard is not None else None
+        if guard is None or version is not None:
+            writes.append((namespace, full_key, coder.encode(value), expire, version))
+    stale = set()
+    backend = FastAPICache.get_backend()
+    try:
+        redis = getattr(backend, "redis", None)
+        with timed("redis", "mset"):
+            if redis is not None:
+                async with redis.pipeline(transaction=False) as pipe:
+                    for _, full_key, value, expire, version in writes:
+                        if version is None:
+                            pipe.set(full_key, value, ex=expire)
+                        else:
+                            pipe.eval(FILL_SCRIPT, 2, full_key, _version_key(full_key), version, value, expire)
+                    results = await pipe.execute()
+                for (namespace, full_key, _, _, version), stored in zip(writes, results):
+                    if version is not None and not stored:
+                        CACHE_STALE_FILLS.labels(namespace).inc()
+                        stale.add(full_key)
+            else:
+                for _, full_key, value, expire, _ in writes:
+                    await backend.set(full_key, value, expire)
+    except Exception as e:
+        logger.warning("cache multi-set of %s keys failed: %s", len(writes), e)
+    for namespace, full_key, value in entries:
+        _, _, expire, local = _namespaces[namespace]
+        if local and full_key not in stale:
+            local_cache.set(full_key, value, expire)
+
+
+class CacheInvalidator:
+    # drops keys from Redis and broadcasts the eviction to the in-process
+    # caches of every worker and replica over Redis pub/sub
+    def __init__(self, channel: str):
+        self.channel = channel
+        # called with the evicted keys, both for local and broadcast evictions
+        self.listeners: list[Callable[[list[str]], None]] = []
+        self._bus = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self, bus):
+        self._bus = bus
+        pubsub = bus.pubsub()
+        await pubsub.subscribe(self.channel)
+        self._task = asyncio.create_task(self._run(pubsub))
+        logger.info("listening for cache invalidations on %s", self.channel)
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.error("cache invalidation listener failed: %s", e)
+        self._task = None
+        self._bus = None
+
+    async def invalidate(self, *full_keys: str):
+        invalidation_log.bump(list(full_keys))
+        for full_key in full_keys:
+            local_cache.delete(full_key)
+        for listener in self.listeners:
+            listener(list(full_keys))
+        CACHE_INVALIDATIONS.labels("local").inc(len(full_keys))
+        try:
+            backend = FastAPICache.get_backend()
+            redis = getattr(backend, "redis", None)
+            if redis is not None:
+                # the version bump turns away fills that read before this
+                # invalidation and would otherwise store after the delete
+                async with redis.pipeline(transaction=False) as pipe:
+                    for full_key in full_keys:
+                        pipe.delete(full_key)
+                        pipe.incr(_version_key(full_key))
+                        pipe.expire(_version_key(full_key), settings.CACHE_VERSION_TTL)
+                    await pipe.execute()
+            else:
+                for full_key in full_keys:
+                    await backend.clear(key=full_key)
+            if self._bus is not None:
+                await self._bus.publish(self.channel, "\n".join(full_keys))
+        except Exception as e:
+            logger.error("cache invalidation for %s failed: %s", full_keys, e)
+
+    async def _run(self, pubsub):
+        delay = 1.0
+        while True:
+            try:
+                if pubsub is None:
+                    pubsub = self._bus.pubsub()
+                    await pubsub.subscribe(self.channel)
+                    # evictions published while unsubscribed were missed
+                    invalidation_log.bump_all()
+                    local_cache.clear()
+                    CACHE_INVALIDATIONS.labels("resubscribe").inc()
+                    logger.info("resubscribed to cache invalidations on %s", self.channel)
+                    delay = 1.0
+                await self._listen(pubsub)
+            except asyncio.CancelledError:
+                await self._reset(pubsub)
+                raise
+            except Exception as e:
+                logger.error("cache invalidation subscription on %s failed: %s", self.channel, e)
+            await self._reset(pubsub)
+            pubsub = None
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 30.0)
+
+    @staticmethod
+    async def _reset(pubsub):
+        if pubsub is None:
+            return
+        try:
+            await pubsub.reset()
+        except Exception as e:
+            logger.warning("closing the cache invalidation subscription failed: %s", e)
+
+    async def _listen(self, pubsub):
+        async for message in pubsub.listen():
+            if message["type"] != "message":
+                continue
+            data = message["data"]
+            full_keys = (data.decode() if isinstance(data, bytes) else data).split("\n")
+            invalidation_log.bump(full_keys)
+            for full_key in full_keys:
+                local_cache.delete(full_key)
+            for listener in self.listeners:
+                listener(full_keys)
+            CACHE_INVALIDATIONS.labels("pubsub").inc(len(full_keys))
+
+
+cache_invalidator = CacheInvalidator(channel=settings.CACHE_INVALIDATION_CHANNEL)
+
+async def invalidate(*full_keys: str):
+    await cache_invalidator.invalidate(*full_keys)
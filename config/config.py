@@ -1,13 +1,170 @@
+import math
 import os
+from typing import Optional
+from pydantic import model_validator
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 
+def available_cpus() -> int:
+    # CPUs this process can actually use: its affinity mask (cpuset, taskset)
+    # capped by a cgroup v2 CPU quota (docker --cpus). os.cpu_count() counts
+    # every CPU of the host, also inside a container limited to a few
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as cpu_max:
+            quota, period = cpu_max.read().split()
+        if quota != "max":
+            cpus = min(cpus, max(1, math.ceil(int(quota) / int(period))))
+    except (OSError, ValueError):
+        pass
+    return cpus
+
+
 class Settings(BaseSettings):
     SECRET_KEY: str
     ALGORITHM: str
     AUTH_DATABASE_URL: str
     REDIS_URL: str
 
+    # server.py runs SERVER_WORKERS processes, main.py a single one with reload.
+    # Pools below are per worker process: the service opens up to
+    # SERVER_WORKERS * (DB_POOL_SIZE + DB_MAX_OVERFLOW) connections to the
+    # primary (and as many to each replica), keep that under max_connections
+    SERVER_HOST: str = "0.0.0.0"
+    SERVER_PORT: int = 8000
+    SERVER_WORKERS: int = available_cpus()
+    SERVER_GRACEFUL_TIMEOUT: int = 30
+    SERVER_KEEPALIVE_TIMEOUT: int = 5
+    # only for throwaway local databases
+    DROP_TABLES_ON_SHUTDOWN: bool = False
+
+    LOG_LEVEL: str = "INFO"
+    # "json" for structured output, "text" for the old human-readable lines
+    LOG_FORMAT: str = "json"
+    LOG_QUEUE_SIZE: int = 10000
+    # info lines per second allowed from each logging call, 0 turns sampling off
+    LOG_RATE_LIMIT: float = 50.0
+
+    DB_POOL_SIZE: int = 10
+    DB_MAX_OVERFLOW: int = 20
+    DB_POOL_TIMEOUT: float = 30.0
+    DB_POOL_RECYCLE: int = 1800
+    DB_POOL_PRE_PING: bool = True
+    DB_PREPARED_STATEMENT_CACHE_SIZE: int = 100
+    # read-only queries go to these when they are healthy, JSON list in the env
+    AUTH_DATABASE_REPLICA_URLS: list[str] = []
+    DB_REPLICA_MAX_LAG: float = 5.0
+    DB_REPLICA_CHECK_INTERVAL: float = 2.0
+    DB_REPLICA_CHECK_TIMEOUT: float = 1.0
+    # reads of a just-written user stay on the primary this long, keep it
+    # above DB_REPLICA_MAX_LAG
+    DB_READ_YOUR_WRITES_SECONDS: float = 10.0
+    DB_STICKY_KEYS_MAXSIZE: int = 100000
+
+    PASSWORD_HASH_EXECUTOR: str = "thread"
+    # hashing threads (or processes) per worker, unset shares the CPUs
+    # between the workers so that they do not oversubscribe them together
+    PASSWORD_HASH_WORKERS: Optional[int] = None
+    PASSWORD_HASH_MAX_QUEUE: int = 64
+    # new hashes use this scheme, hashes in the other one or with other costs
+    # are upgraded on the next successful login; see benchmarks/calibrate_hashing.py
+    PASSWORD_HASH_SCHEME: str = "bcrypt"
+    PASSWORD_BCRYPT_ROUNDS: int = 12
+    PASSWORD_ARGON2_TIME_COST: int = 3
+    PASSWORD_ARGON2_MEMORY_COST: int = 65536
+    PASSWORD_ARGON2_PARALLELISM: int = 1
+
+    KAFKA_BOOTSTRAP_SERVERS: str = "kafka:9092"
+    KAFKA_PRODUCER: str = "confluent"
+    KAFKA_LINGER_MS: int = 20
+    KAFKA_BATCH_SIZE: int = 1000
+    KAFKA_QUEUE_SIZE: int = 10000
+    KAFKA_OVERFLOW_POLICY: str = "drop"
+    KAFKA_BLOCK_TIMEOUT: float = 1.0
+    KAFKA_SPILL_PATH: str = "logs/kafka-spill.ndjson"
+    # seconds between attempts to move spilled events back into the queue
+    KAFKA_SPILL_REPLAY_INTERVAL: float = 5.0
+    KAFKA_FLUSH_TIMEOUT: float = 10.0
+
+    CACHE_L1_MAXSIZE: int = 10000
+    CACHE_L1_TTL: int = 30
+    CACHE_INVALIDATION_CHANNEL: str = "cache-invalidation"
+    # lifetime of the per-key version bumped by every invalidation, keep it
+    # well above the slowest cache fill
+    CACHE_VERSION_TTL: int = 3600
+    # 0 turns probabilistic early refresh off, higher values refresh earlier
+    CACHE_EARLY_REFRESH_BETA: float = 1.0
+    # cross-worker lock so that only one worker fills a missing key
+    CACHE_FILL_LOCK: bool = False
+    CACHE_FILL_LOCK_TTL: float = 5.0
+    CACHE_FILL_LOCK_WAIT: float = 0.5
+    CACHE_FILL_LOCK_POLL: float = 0.02
+
+    JWT_KEYS_FILE: Optional[str] = None
+    JWT_KEYS_RELOAD_INTERVAL: int = 60
+    JWT_ACCEPT_LEGACY_HS: bool = True
+    JWKS_CACHE_MAX_AGE: int = 300
+
+    INTROSPECTION_MAX_BATCH: int = 100
+    # bearer tokens of the services allowed to introspect over HTTP, JSON list
+    # in the env; admins can always do it with their session
+    INTROSPECTION_CLIENT_TOKENS: list[str] = []
+    USERS_LOOKUP_MAX_BATCH: int = 500
+    GRPC_PORT: int = 0
+    # without TLS files the server only listens on this host; with them it
+    # requires client certificates signed by GRPC_TLS_CLIENT_CA_FILE (mTLS)
+    GRPC_HOST: str = "127.0.0.1"
+    GRPC_TLS_CERT_FILE: Optional[str] = None
+    GRPC_TLS_KEY_FILE: Optional[str] = None
+    GRPC_TLS_CLIENT_CA_FILE: Optional[str] = None
+    GRPC_GRACE_PERIOD: float = 5.0
+
+    USERS_STREAM_CHUNK_SIZE: int = 1000
+
+    BULK_IMPORT_BATCH_SIZE: int = 5000
+    # hashing processes of an import through the admin endpoint, which runs
+    # inside a web worker next to logins; the CLI (python bulk_import.py)
+    # uses every available CPU unless told otherwise with --workers
+    BULK_IMPORT_WORKERS: int = 1
+    BULK_IMPORT_MAX_ERRORS: int = 1000
+
+    METRICS_STAGE_BUCKETS: list[float] = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0]
+    HTTP_LATENCY_BUCKETS: list[float] = [0.01, 0.05, 0.1, 0.3, 0.5, 0.7, 1.0, 2.5, 5.0, 10.0]
+    EVENT_LOOP_LAG_INTERVAL: float = 0.5
+
+    # login attempts per RATE_LIMIT_WINDOW seconds, 0 turns a scope off
+    RATE_LIMIT_ENABLED: bool = True
+    RATE_LIMIT_LOGIN_PER_EMAIL: int = 10
+    RATE_LIMIT_LOGIN_PER_IP: int = 100
+    RATE_LIMIT_LOGIN_GLOBAL: int = 0
+    RATE_LIMIT_WINDOW: float = 60.0
+    RATE_LIMIT_LOCAL_MAXSIZE: int = 100000
+    RATE_LIMIT_TRUST_FORWARDED_FOR: bool = False
+
+    ACCESS_TOKEN_TTL_MINUTES: int = 30
+    REFRESH_TOKEN_TTL_DAYS: int = 7
+    # refresh tokens issued before rotation have no jti, they are exchanged once for a new session
+    REFRESH_ACCEPT_LEGACY: bool = True
+    REVOCATION_STREAM: str = "token-revocations"
+    REVOCATION_FILTER_CAPACITY: int = 1_000_000
+    REVOCATION_FILTER_ERROR_RATE: float = 0.001
+    REVOCATION_FILTER_REBUILD_INTERVAL: float = 3600.0
+
+    EMAIL_FILTER_KEY: str = "email-filter"
+    EMAIL_FILTER_CAPACITY: int = 1_000_000
+    EMAIL_FILTER_ERROR_RATE: float = 0.01
+    # seconds between rebuilds of the filter from the users table
+    EMAIL_FILTER_REBUILD_INTERVAL: int = 3600
+
+    @model_validator(mode="after")
+    def derive_pool_sizes(self):
+        if self.PASSWORD_HASH_WORKERS is None:
+            self.PASSWORD_HASH_WORKERS = max(1, available_cpus() // max(self.SERVER_WORKERS, 1))
+        return self
+
     model_config = SettingsConfigDict(
         env_file=os.path.join(os.path.dirname(os.path.abspath(__file__)), ".env")
     )
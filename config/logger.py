@@ -1,10 +1,110 @@
+import atexit
+import json
 import logging
+import queue
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
 
+from prometheus_client import Counter, Gauge
 
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s",
+from config.config import settings
+
+
+LOG_RECORDS_DROPPED = Counter(
+    "log_records_dropped_total",
+    "Log records dropped before being written",
+    ["reason"],
 )
+LOG_QUEUE_DEPTH = Gauge("log_queue_depth", "Log records waiting for the writer thread", multiprocess_mode="livesum")
+for reason in ("queue_full", "rate_limited"):
+    LOG_RECORDS_DROPPED.labels(reason)
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class CallSiteRateLimitFilter(logging.Filter):
+    # token bucket per logging call site, so a line logged on every request
+    # is capped while rare lines with the same level still get through;
+    # warnings and errors are never dropped
+    def __init__(self, rate: float, level: int = logging.INFO):
+        super().__init__()
+        self.rate = rate
+        self.level = level
+        self._buckets: dict[tuple, tuple[float, float]] = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not self.rate or record.levelno > self.level:
+            return True
+        key = (record.pathname, record.lineno)
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (self.rate, now))
+            tokens = min(self.rate, tokens + (now - updated) * self.rate)
+            allowed = tokens >= 1
+            self._buckets[key] = (tokens - 1 if allowed else tokens, now)
+        if not allowed:
+            LOG_RECORDS_DROPPED.labels("rate_limited").inc()
+        return allowed
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    # the event loop only enqueues the record; formatting and the write to
+    # stdout happen on the listener thread, a full queue drops the record
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_RECORDS_DROPPED.labels("queue_full").inc()
+        LOG_QUEUE_DEPTH.set(self.queue.qsize())
+
+
+class DepthTrackingQueueListener(QueueListener):
+    # a callback gauge would not work in prometheus multiprocess mode
+    def handle(self, record: logging.LogRecord):
+        super().handle(record)
+        LOG_QUEUE_DEPTH.set(self.queue.qsize())
+
+
+def setup_logging() -> QueueListener:
+    log_queue = queue.Queue(maxsize=settings.LOG_QUEUE_SIZE)
+
+    output = logging.StreamHandler(sys.stdout)
+    if settings.LOG_FORMAT == "json":
+        output.setFormatter(JsonFormatter())
+    else:
+        output.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+
+    handler = NonBlockingQueueHandler(log_queue)
+    handler.addFilter(CallSiteRateLimitFilter(settings.LOG_RATE_LIMIT))
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(settings.LOG_LEVEL)
+
+    listener = DepthTrackingQueueListener(log_queue, output, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+log_listener = setup_logging()
 
 logger = logging.getLogger(__name__)
 
@@ -1,10 +1,18 @@
 import os
+import time
+from contextlib import asynccontextmanager, contextmanager
 
-from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
-from sqlalchemy.orm import DeclarativeBase 
+from prometheus_client import Counter, Gauge, Histogram
+from sqlalchemy import Select, any_, bindparam, event, text
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+from sqlalchemy.orm import DeclarativeBase, Session
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 
 from config.config import settings
 from config.logger import logger
+from database.replicas import ReplicaRouter, DB_READS
 
 class Base(DeclarativeBase):
     pass
@@ -12,9 +20,172 @@ class Base(DeclarativeBase):
 REDIS_URL=os.getenv("REDIS_URL") or settings.REDIS_URL
 DATABASE_URL=os.getenv("AUTH_DATABASE_URL") or settings.AUTH_DATABASE_URL
 
-async_engine = create_async_engine(url=DATABASE_URL, echo=False)
+DB_POOL_SIZE = Gauge("db_pool_size", "Connections kept open by the pool", ["engine"], multiprocess_mode="livesum")
+DB_POOL_CHECKED_OUT = Gauge("db_pool_checked_out", "Connections currently checked out of the pool", ["engine"], multiprocess_mode="livesum")
+DB_POOL_OVERFLOW = Gauge("db_pool_overflow", "Connections open beyond the pool size", ["engine"], multiprocess_mode="livesum")
+DB_POOL_CHECKOUT = Histogram(
+    "db_pool_checkout_seconds",
+    "Time to get a usable connection from the pool: waiting for a free one, opening a new one and the pre-ping",
+    buckets=[0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0],
+)
+DB_QUERY_DURATION = Histogram(
+    "db_query_duration_seconds",
+    "Time spent executing statements",
+    ["statement"],
+    buckets=[0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0],
+)
+DB_QUERY_ERRORS = Counter("db_query_errors_total", "Statements that raised", ["statement"])
+DB_CONNECTIONS_OPENED = Counter("db_connections_opened_total", "New database connections opened by the pool")
 
-async_session = async_sessionmaker(async_engine, expire_on_commit=False)
+
+class InstrumentedPool(AsyncAdaptedQueuePool):
+    def connect(self):
+        start = time.perf_counter()
+        try:
+            return super().connect()
+        finally:
+            DB_POOL_CHECKOUT.observe(time.perf_counter() - start)
+
+
+def create_engine(url: str):
+    connect_args = {}
+    if url.startswith("postgresql+asyncpg"):
+        # 0 disables the cache, needed behind pgbouncer in transaction mode
+        connect_args["prepared_statement_cache_size"] = settings.DB_PREPARED_STATEMENT_CACHE_SIZE
+    return create_async_engine(
+        url=url,
+        echo=False,
+        poolclass=InstrumentedPool,
+        pool_size=settings.DB_POOL_SIZE,
+        max_overflow=settings.DB_MAX_OVERFLOW,
+        pool_timeout=settings.DB_POOL_TIMEOUT,
+        pool_recycle=settings.DB_POOL_RECYCLE,
+        pool_pre_ping=settings.DB_POOL_PRE_PING,
+        connect_args=connect_args,
+    )
+
+def statement_type(statement: str) -> str:
+    return statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "OTHER"
+
+def instrument_engine(engine, name: str):
+    DB_POOL_SIZE.labels(name).set(engine.pool.size())
+
+    def update_pool_gauges(*args):
+        # engine.pool is replaced on dispose(), so look it up every time
+        DB_POOL_CHECKED_OUT.labels(name).set(engine.pool.checkedout())
+        DB_POOL_OVERFLOW.labels(name).set(max(engine.pool.overflow(), 0))
+
+    event.listen(engine.sync_engine, "checkout", update_pool_gauges)
+    event.listen(engine.sync_engine, "checkin", update_pool_gauges)
+    event.listen(engine.sync_engine, "connect", lambda *args: DB_CONNECTIONS_OPENED.inc())
+
+    # the start time lives on the execution context, not on the connection,
+    # so a statement that raises leaves nothing behind for the next one
+    @event.listens_for(engine.sync_engine, "before_cursor_execute")
+    def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+        if context is not None:
+            context.query_start = time.perf_counter()
+
+    @event.listens_for(engine.sync_engine, "after_cursor_execute")
+    def stop_query_timer(conn, cursor, statement, parameters, context, executemany):
+        started = getattr(context, "query_start", None)
+        if started is not None:
+            del context.query_start
+            DB_QUERY_DURATION.labels(statement_type(statement)).observe(time.perf_counter() - started)
+
+    @event.listens_for(engine.sync_engine, "handle_error")
+    def drop_query_timer(exception_context):
+        context = exception_context.execution_context
+        if getattr(context, "query_start", None) is not None:
+            del context.query_start
+        if exception_context.statement:
+            DB_QUERY_ERRORS.labels(statement_type(exception_context.statement)).inc()
+
+async_engine = create_engine(DATABASE_URL)
+instrument_engine(async_engine, "primary")
+
+replica_engines = {}
+for number, url in enumerate(settings.AUTH_DATABASE_REPLICA_URLS):
+    replica_engines[f"replica-{number}"] = create_engine(url)
+    instrument_engine(replica_engines[f"replica-{number}"], f"replica-{number}")
+
+replica_router = ReplicaRouter(
+    replica_engines,
+    max_lag=settings.DB_REPLICA_MAX_LAG,
+    check_interval=settings.DB_REPLICA_CHECK_INTERVAL,
+    check_timeout=settings.DB_REPLICA_CHECK_TIMEOUT,
+    sticky_seconds=settings.DB_READ_YOUR_WRITES_SECONDS,
+    sticky_maxsize=settings.DB_STICKY_KEYS_MAXSIZE,
+)
+
+class RoutingSession(Session):
+    # everything goes to the primary unless a read was routed to a replica
+    # with replica_reads; even then only SELECTs go there, never a flush
+    def get_bind(self, mapper=None, clause=None, **kw):
+        replica = self.info.get("replica")
+        if replica is not None and not self._flushing and isinstance(clause, Select):
+            return replica[1].sync_engine
+        return async_engine.sync_engine
+
+async_session = async_sessionmaker(async_engine, expire_on_commit=False, sync_session_class=RoutingSession)
+
+@contextmanager
+def replica_reads(session: AsyncSession, *sticky_keys: str):
+    # routes the SELECTs in the block to a healthy replica unless one of
+    # sticky_keys was written recently; a session already in a transaction
+    # stays on the primary so it sees its own uncommitted writes
+    replica = None if session.in_transaction() else replica_router.pick(*sticky_keys)
+    if replica is None:
+        yield None
+        return
+    session.info["replica"] = replica
+    try:
+        yield replica[0]
+    finally:
+        session.info.pop("replica", None)
+
+async def execute_read(session: AsyncSession, query, *sticky_keys: str):
+    # a replica that fails mid-request is taken out and the read retried on the primary
+    with replica_reads(session, *sticky_keys) as replica:
+        try:
+            return await session.execute(query)
+        except (DBAPIError, OSError) as e:
+            if replica is None:
+                raise
+            replica_router.mark_down(replica, e)
+            await session.rollback()
+    DB_READS.labels("primary", "fallback").inc()
+    return await session.execute(query)
+
+def dialect_insert(table):
+    # INSERT that supports on_conflict_do_nothing on the configured database
+    if async_engine.dialect.name == "postgresql":
+        return postgresql.insert(table)
+    return sqlite.insert(table)
+
+def any_of(column, values: list):
+    # "= ANY(:values)" binds the whole list as one array parameter, so every
+    # batch size shares one prepared statement; IN () on other databases
+    if async_engine.dialect.name == "postgresql":
+        return column == any_(bindparam(None, values, type_=postgresql.ARRAY(column.type)))
+    return column.in_(values)
+
+# any fixed number works as long as every instance of the service uses the same one
+STARTUP_LOCK_ID = 720_101
+
+@asynccontextmanager
+async def startup_lock():
+    # one worker or replica at a time runs the startup steps, the others wait
+    # here and then find the tables and the admin user already in place
+    if async_engine.dialect.name != "postgresql":
+        yield
+        return
+    async with async_engine.connect() as conn:
+        await conn.execute(text("SELECT pg_advisory_lock(:id)"), {"id": STARTUP_LOCK_ID})
+        try:
+            yield
+        finally:
+            await conn.execute(text("SELECT pg_advisory_unlock(:id)"), {"id": STARTUP_LOCK_ID})
 
 async def create_tables():
     async with async_engine.begin() as conn:
@@ -27,6 +198,14 @@ async def delete_tables():
         logger.info("dropped tables")
 
 async def get_db():
+    # sessions check a connection out lazily on the first query and give it
+    # back when the transaction ends, see release_connection
     async with async_session() as session:
         yield session
+
+async def release_connection(session: AsyncSession):
+    # ends a read-only transaction so the connection goes back to the pool
+    # instead of being held through bcrypt, Kafka or the rest of the request
+    if session.in_transaction():
+        await session.commit()
         
\ No newline at end of file
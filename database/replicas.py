@@ -0,0 +1,154 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from prometheus_client import Counter, Gauge
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from config.logger import logger
+
+
+DB_READS = Counter(
+    "db_reads_total",
+    "Read-only queries by the database they were sent to and why",
+    ["target", "reason"],
+)
+DB_REPLICA_LAG = Gauge(
+    "db_replica_lag_seconds",
+    "Replay lag of each replica as of the last health check",
+    ["replica"],
+    multiprocess_mode="livemax",
+)
+DB_REPLICA_HEALTHY = Gauge(
+    "db_replica_healthy",
+    "1 while a replica is answering and within the allowed lag",
+    ["replica"],
+    multiprocess_mode="livemin",
+)
+
+# 0 on a caught up standby (and on a primary), otherwise the age of the last
+# replayed transaction
+POSTGRES_LAG_QUERY = text("""
+SELECT CASE
+    WHEN NOT pg_is_in_recovery() THEN 0
+    WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+    ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+END
+""")
+
+
+class ReplicaRouter:
+    # picks the replica for a read, or None for the primary. Replicas are
+    # checked in the background and left out while they are down or lag
+    # behind by more than max_lag. Keys written recently (the cache keys of a
+    # user, fed by cache invalidations from every worker) are read from the
+    # primary for sticky_seconds, so nobody reads their own update from a
+    # replica that has not replayed it yet and caches the stale row
+    def __init__(
+        self,
+        replicas: dict[str, AsyncEngine],
+        max_lag: float,
+        check_interval: float,
+        check_timeout: float,
+        sticky_seconds: float,
+        sticky_maxsize: int,
+    ):
+        self.replicas = replicas
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.check_timeout = check_timeout
+        self.sticky_seconds = sticky_seconds
+        self.sticky_maxsize = sticky_maxsize
+        self.healthy: list[str] = []
+        self._sticky: OrderedDict[str, float] = OrderedDict()
+        self._next = 0
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        if not self.replicas:
+            return
+        await self.check()
+        self._task = asyncio.create_task(self._run())
+        logger.info("routing reads to %s of %s replicas", len(self.healthy), len(self.replicas))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for engine in self.replicas.values():
+            await engine.dispose()
+
+    def pick(self, *keys: str) -> Optional[tuple[str, AsyncEngine]]:
+        if not self.healthy:
+            if self.replicas:
+                DB_READS.labels("primary", "no_replica").inc()
+            return None
+        now = time.monotonic()
+        for key in keys:
+            until = self._sticky.get(key)
+            if until is not None and until > now:
+                DB_READS.labels("primary", "sticky").inc()
+                return None
+        name = self.healthy[self._next % len(self.healthy)]
+        self._next += 1
+        DB_READS.labels("replica", "routed").inc()
+        return name, self.replicas[name]
+
+    def stick(self, keys: list[str]):
+        until = time.monotonic() + self.sticky_seconds
+        for key in keys:
+            self._sticky[key] = until
+            self._sticky.move_to_end(key)
+        while len(self._sticky) > self.sticky_maxsize:
+            self._sticky.popitem(last=False)
+
+    def mark_down(self, name: str, error: Exception):
+        # a failed read takes the replica out until the next check passes
+        if name in self.healthy:
+            self.healthy = [healthy for healthy in self.healthy if healthy != name]
+            DB_REPLICA_HEALTHY.labels(name).set(0)
+            logger.error("replica %s failed, reading from the primary: %s", name, error)
+
+    async def _lag(self, engine: AsyncEngine) -> float:
+        async with engine.connect() as conn:
+            if engine.dialect.name != "postgresql":
+                await conn.execute(text("SELECT 1"))
+                return 0.0
+            return float(await conn.scalar(POSTGRES_LAG_QUERY))
+
+    async def check(self):
+        healthy = []
+        for name, engine in self.replicas.items():
+            try:
+                lag = await asyncio.wait_for(self._lag(engine), self.check_timeout)
+            except Exception as e:
+                if name in self.healthy:
+                    logger.error("replica %s is unavailable: %s", name, e)
+                DB_REPLICA_HEALTHY.labels(name).set(0)
+                continue
+            DB_REPLICA_LAG.labels(name).set(lag)
+            if lag > self.max_lag:
+                if name in self.healthy:
+                    logger.warning("replica %s lags %.1fs behind, reading from the primary", name, lag)
+                DB_REPLICA_HEALTHY.labels(name).set(0)
+                continue
+            DB_REPLICA_HEALTHY.labels(name).set(1)
+            healthy.append(name)
+        self.healthy = healthy
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.check_interval)
+            try:
+                await self.check()
+                now = time.monotonic()
+                while self._sticky and next(iter(self._sticky.values())) <= now:
+                    self._sticky.popitem(last=False)
+            except Exception as e:
+                logger.error("replica health check failed: %s", e)
@@ -0,0 +1,102 @@
+import asyncio
+from typing import Optional
+
+from prometheus_client import Counter
+from sqlalchemy import select
+
+from bloom import BloomFilter, RedisBloomFilter
+from config.config import settings
+from config.logger import logger
+from database.database import async_session
+from database.models import Users
+from instrumentation import timed
+
+
+EMAIL_FILTER_CHECKS = Counter(
+    "email_filter_checks_total",
+    "Registration email pre-checks by filter answer",
+    ["result"],
+)
+
+
+def normalize_email(email: str) -> str:
+    return email.strip().lower()
+
+
+class EmailFilter:
+    # "definitely new" answers let registration skip the existence query and
+    # go straight to the insert; a missing email in the filter (Redis flushed,
+    # rows added behind its back) only costs a wasted password hash, because
+    # the unique index on users.email has the final say
+    def __init__(self, key: str, capacity: int, error_rate: float, rebuild_interval: int):
+        self.filter = RedisBloomFilter(key, capacity, error_rate)
+        self.rebuild_interval = rebuild_interval
+        self._redis = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self, redis):
+        self._redis = redis
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        # deleted and renamed users stay in a Bloom filter as false
+        # positives, so it is rebuilt from the table every rebuild_interval
+        # seconds; one worker per interval does it, the others use the
+        # shared bitmap and only look again now and then whether it is due
+        while True:
+            try:
+                if await self._redis.set(f"{self.filter.key}:rebuild", 1, nx=True, ex=self.rebuild_interval):
+                    await self.rebuild()
+            except Exception as e:
+                logger.error("email filter rebuild check failed: %s", e)
+            await asyncio.sleep(max(self.rebuild_interval / 10, 1))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self._redis = None
+
+    async def rebuild(self):
+        local = BloomFilter(self.filter.capacity, self.filter.error_rate)
+        try:
+            async with async_session() as session:
+                result = await session.stream(select(Users.email).execution_options(yield_per=10000))
+                async for email in result.scalars():
+                    local.add(normalize_email(email))
+            await self.filter.replace(self._redis, local)
+            logger.info("email filter rebuilt with %s emails", len(local))
+        except Exception as e:
+            logger.error("email filter rebuild failed: %s", e)
+
+    async def might_exist(self, email: str) -> bool:
+        if self._redis is None:
+            return True
+        try:
+            with timed("redis", "email_filter"):
+                found = await self.filter.contains(self._redis, normalize_email(email))
+        except Exception as e:
+            logger.warning("email filter check failed: %s", e)
+            found = True
+        EMAIL_FILTER_CHECKS.labels("maybe" if found else "new").inc()
+        return found
+
+    async def add(self, *emails: str):
+        if self._redis is None or not emails:
+            return
+        try:
+            await self.filter.add(self._redis, *(normalize_email(email) for email in emails))
+        except Exception as e:
+            logger.warning("adding %s emails to the email filter failed: %s", len(emails), e)
+
+
+email_filter = EmailFilter(
+    key=settings.EMAIL_FILTER_KEY,
+    capacity=settings.EMAIL_FILTER_CAPACITY,
+    error_rate=settings.EMAIL_FILTER_ERROR_RATE,
+    rebuild_interval=settings.EMAIL_FILTER_REBUILD_INTERVAL,
+)
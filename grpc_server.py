@@ -0,0 +1,78 @@
+from typing import Optional
+
+import grpc
+from google.protobuf import struct_pb2
+
+from auth import introspect_tokens
+from config.config import settings
+from config.logger import logger
+from database.database import async_session
+from proto import introspection_pb2, introspection_pb2_grpc
+
+
+def _to_response(results) -> introspection_pb2.IntrospectResponse:
+    response = introspection_pb2.IntrospectResponse()
+    for result in results:
+        info = response.results.add(active=result.active, error=result.error or "")
+        if result.user_id is not None:
+            info.user_id = result.user_id
+            info.role = result.role.value
+            info.status = result.status.value
+        if result.claims:
+            claims = struct_pb2.Struct()
+            claims.update(result.claims)
+            info.claims.CopyFrom(claims)
+    return response
+
+
+class TokenIntrospectionService(introspection_pb2_grpc.TokenIntrospectionServicer):
+    async def _introspect(self, request, context):
+        if len(request.tokens) > settings.INTROSPECTION_MAX_BATCH:
+            await context.abort(
+                grpc.StatusCode.INVALID_ARGUMENT,
+                f"at most {settings.INTROSPECTION_MAX_BATCH} tokens per request",
+            )
+        async with async_session() as session:
+            results = await introspect_tokens(list(request.tokens), session)
+        return _to_response(results)
+
+    async def Introspect(self, request, context):
+        return await self._introspect(request, context)
+
+    async def IntrospectStream(self, request_iterator, context):
+        async for request in request_iterator:
+            yield await self._introspect(request, context)
+
+
+def _read(path: str) -> bytes:
+    with open(path, "rb") as source:
+        return source.read()
+
+
+def _server_credentials() -> Optional[grpc.ServerCredentials]:
+    # introspection tells whoever asks what a token is worth, so callers
+    # either prove who they are with a client certificate or share the host
+    tls_files = (settings.GRPC_TLS_CERT_FILE, settings.GRPC_TLS_KEY_FILE, settings.GRPC_TLS_CLIENT_CA_FILE)
+    if not any(tls_files):
+        return None
+    if not all(tls_files):
+        raise ValueError("GRPC_TLS_CERT_FILE, GRPC_TLS_KEY_FILE and GRPC_TLS_CLIENT_CA_FILE are needed together")
+    return grpc.ssl_server_credentials(
+        [(_read(settings.GRPC_TLS_KEY_FILE), _read(settings.GRPC_TLS_CERT_FILE))],
+        root_certificates=_read(settings.GRPC_TLS_CLIENT_CA_FILE),
+        require_client_auth=True,
+    )
+
+
+async def start_grpc_server(port: int) -> grpc.aio.Server:
+    server = grpc.aio.server()
+    introspection_pb2_grpc.add_TokenIntrospectionServicer_to_server(TokenIntrospectionService(), server)
+    credentials = _server_credentials()
+    if credentials is not None:
+        server.add_secure_port(f"[::]:{port}", credentials)
+        logger.info("gRPC introspection server listening on port %s with mTLS", port)
+    else:
+        server.add_insecure_port(f"{settings.GRPC_HOST}:{port}")
+        logger.info("gRPC introspection server listening on %s:%s without TLS", settings.GRPC_HOST, port)
+    await server.start()
+    return server
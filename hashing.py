@@ -0,0 +1,167 @@
+import asyncio
+import multiprocessing
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
+from typing import Optional
+
+from fastapi import HTTPException, status
+from passlib.context import CryptContext
+from prometheus_client import Counter, Gauge, Histogram
+
+from config.config import settings
+from config.logger import logger
+
+
+HASH_QUEUE_DEPTH = Gauge(
+    "password_hash_queue_depth",
+    "Password hashing jobs waiting for or running in the worker pool",
+    multiprocess_mode="livesum",
+)
+HASH_DURATION = Histogram(
+    "password_hash_duration_seconds",
+    "Time from submitting a password hashing job to getting its result",
+    ["operation"],
+    buckets=[0.01, 0.05, 0.1, 0.2, 0.3, 0.5, 1.0, 2.5, 5.0],
+)
+HASH_REJECTED = Counter(
+    "password_hash_rejected_total",
+    "Password hashing jobs rejected because the queue was full",
+    ["operation"],
+)
+HASH_VERIFIED = Counter(
+    "password_hash_verified_total",
+    "Successful password checks by the scheme of the stored hash and whether it is outdated",
+    ["scheme", "outdated"],
+)
+HASH_UPGRADES = Counter(
+    "password_hash_upgrades_total",
+    "Outdated password hashes rewritten after a successful login",
+    ["scheme", "result"],
+)
+SCHEMES = ("argon2", "bcrypt")
+
+
+def build_password_context(
+    scheme: str = settings.PASSWORD_HASH_SCHEME,
+    bcrypt_rounds: int = settings.PASSWORD_BCRYPT_ROUNDS,
+    argon2_time_cost: int = settings.PASSWORD_ARGON2_TIME_COST,
+    argon2_memory_cost: int = settings.PASSWORD_ARGON2_MEMORY_COST,
+    argon2_parallelism: int = settings.PASSWORD_ARGON2_PARALLELISM,
+) -> CryptContext:
+    # both schemes verify, only the default one hashes; "auto" marks the
+    # other scheme deprecated, and a hash made with other cost parameters
+    # needs an update as well
+    if scheme not in SCHEMES:
+        raise ValueError(f"password hash scheme must be one of {', '.join(SCHEMES)}")
+    return CryptContext(
+        schemes=[scheme] + [other for other in SCHEMES if other != scheme],
+        default=scheme,
+        deprecated="auto",
+        bcrypt__rounds=bcrypt_rounds,
+        argon2__type="ID",
+        argon2__time_cost=argon2_time_cost,
+        argon2__memory_cost=argon2_memory_cost,
+        argon2__parallelism=argon2_parallelism,
+    )
+
+
+def needs_rehash(context: CryptContext, hashed_password: str) -> bool:
+    # called after a successful verify, so it also counts the hash mix
+    scheme = context.identify(hashed_password, required=False) or "unknown"
+    outdated = context.needs_update(hashed_password)
+    HASH_VERIFIED.labels(scheme, str(outdated).lower()).inc()
+    return outdated
+
+
+# worker side: contexts are passed as config strings so that the same
+# functions work in a thread pool and in a process pool
+@lru_cache(maxsize=8)
+def _load_context(config: str) -> CryptContext:
+    return CryptContext.from_string(config)
+
+def _hash(config: str, password: str) -> str:
+    return _load_context(config).hash(password)
+
+def _hash_many(config: str, passwords: list[str]) -> list[str]:
+    context = _load_context(config)
+    return [context.hash(password) for password in passwords]
+
+def _verify(config: str, plain_password: str, hashed_password: str) -> bool:
+    return _load_context(config).verify(plain_password, hashed_password)
+
+
+class PasswordHasher:
+    def __init__(self, executor: str, workers: int, max_queue: int):
+        if executor not in ("thread", "process"):
+            raise ValueError("executor must be 'thread' or 'process'")
+        self.executor_type = executor
+        self.workers = workers
+        self.max_queue = max_queue
+        self._executor: Optional[Executor] = None
+        self._pending = 0
+
+    def _get_executor(self) -> Executor:
+        if self._executor is None:
+            if self.executor_type == "process":
+                # forking a process that runs threads (the event loop's
+                # executors, the log listener) can copy locks in a held state
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+            else:
+                # bcrypt releases the GIL while hashing, so threads scale across cores
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="password-hasher")
+            logger.info("password hasher started: %s pool with %s workers", self.executor_type, self.workers)
+        return self._executor
+
+    async def _submit(self, operation: str, func, *args):
+        if self._pending >= self.max_queue:
+            HASH_REJECTED.labels(operation).inc()
+            logger.warning("password hashing queue is full (%s), rejecting %s", self._pending, operation)
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="server is busy, try again later",
+                headers={"Retry-After": "1"},
+            )
+        self._pending += 1
+        HASH_QUEUE_DEPTH.inc()
+        start = time.perf_counter()
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._get_executor(), func, *args)
+        finally:
+            self._pending -= 1
+            HASH_QUEUE_DEPTH.dec()
+            HASH_DURATION.labels(operation).observe(time.perf_counter() - start)
+
+    async def hash(self, context: CryptContext, password: str) -> str:
+        return await self._submit("hash", _hash, context.to_string(), password)
+
+    async def verify(self, context: CryptContext, plain_password: str, hashed_password: str) -> bool:
+        return await self._submit("verify", _verify, context.to_string(), plain_password, hashed_password)
+
+    async def hash_many(self, context: CryptContext, passwords: list[str]) -> list[str]:
+        # one job per worker instead of one per password keeps pool overhead low
+        if not passwords:
+            return []
+        config = context.to_string()
+        chunk_size = -(-len(passwords) // self.workers)
+        chunks = [passwords[i:i + chunk_size] for i in range(0, len(passwords), chunk_size)]
+        results = await asyncio.gather(*(self._submit("hash_many", _hash_many, config, chunk) for chunk in chunks))
+        return [hashed for chunk in results for hashed in chunk]
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+
+
+pwd_context = build_password_context()
+
+password_hasher = PasswordHasher(
+    executor=settings.PASSWORD_HASH_EXECUTOR,
+    workers=settings.PASSWORD_HASH_WORKERS,
+    max_queue=settings.PASSWORD_HASH_MAX_QUEUE,
+)
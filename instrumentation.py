@@ -0,0 +1,139 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+from collections import Counter as StackCounter
+from contextlib import contextmanager
+from functools import wraps
+from typing import Optional
+
+from prometheus_client import Gauge, Histogram
+
+from config.config import settings
+from config.logger import logger
+
+
+STAGE_DURATION = Histogram(
+    "auth_stage_duration_seconds",
+    "Time spent in each stage of the request hot path",
+    ["stage", "operation"],
+    buckets=settings.METRICS_STAGE_BUCKETS,
+)
+EVENT_LOOP_LAG = Gauge(
+    "event_loop_lag_seconds",
+    "How late the event loop woke up a sleeping task, sampled periodically",
+    multiprocess_mode="livemax",
+)
+
+
+@contextmanager
+def timed(stage: str, operation: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_DURATION.labels(stage, operation).observe(time.perf_counter() - start)
+
+
+def timed_stage(stage: str, operation: Optional[str] = None):
+    # decorator for coroutines, the operation defaults to the function name
+    def decorator(func):
+        labels = (stage, operation or func.__name__)
+
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                STAGE_DURATION.labels(*labels).observe(time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+class EventLoopLagMonitor:
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            EVENT_LOOP_LAG.set(max(time.perf_counter() - start - self.interval, 0.0))
+
+
+class SamplingProfiler:
+    # samples the event loop thread's stack from a background thread and
+    # aggregates it in collapsed-stack format (flamegraph.pl / speedscope)
+    def __init__(self, max_depth: int = 64):
+        self.max_depth = max_depth
+        self.interval = 0.0
+        self.samples = 0
+        self._stacks = StackCounter()
+        self._lock = threading.Lock()
+        self._target_thread: Optional[int] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, interval: float):
+        if self.running:
+            return
+        self.interval = interval
+        self.samples = 0
+        with self._lock:
+            self._stacks.clear()
+        self._target_thread = threading.get_ident()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+        logger.info("sampling profiler started, interval %ss", interval)
+
+    def stop(self):
+        if not self.running:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        logger.info("sampling profiler stopped after %s samples", self.samples)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._target_thread)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None and len(stack) < self.max_depth:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            with self._lock:
+                self._stacks[";".join(reversed(stack))] += 1
+                self.samples += 1
+
+    def collapsed(self, limit: Optional[int] = None) -> str:
+        with self._lock:
+            top = self._stacks.most_common(limit)
+        return "".join(f"{stack} {count}\n" for stack, count in top)
+
+
+event_loop_monitor = EventLoopLagMonitor(interval=settings.EVENT_LOOP_LAG_INTERVAL)
+profiler = SamplingProfiler()
@@ -0,0 +1,178 @@
+import argparse
+import json
+import os
+import time
+from datetime import datetime, timezone
+from typing import Optional
+
+from jose import jwk, jwt, JWTError
+from jose.constants import ALGORITHMS
+
+from config.config import settings, get_auth_data
+from config.logger import logger
+
+
+ASYMMETRIC_ALGORITHMS = ALGORITHMS.RSA_DS | ALGORITHMS.EC_DS
+
+
+def _parse_time(value: Optional[str]) -> Optional[datetime]:
+    if not value:
+        return None
+    parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+
+class SigningKey:
+    def __init__(self, kid: str, algorithm: str, pem: str, not_before: Optional[datetime], not_after: Optional[datetime]):
+        if algorithm not in ASYMMETRIC_ALGORITHMS:
+            raise ValueError(f"unsupported signing algorithm for key {kid}: {algorithm}")
+        self.kid = kid
+        self.algorithm = algorithm
+        self.not_before = not_before
+        self.not_after = not_after
+        # parsed once, jose accepts Key objects directly in encode/decode
+        self.private_key = jwk.construct(pem, algorithm)
+        self.public_key = self.private_key.public_key()
+        self.public_jwk = {**self.public_key.to_dict(), "kid": kid, "alg": algorithm, "use": "sig"}
+
+    def can_sign(self, now: datetime) -> bool:
+        return (self.not_before is None or self.not_before <= now) and self.can_verify(now)
+
+    def can_verify(self, now: datetime) -> bool:
+        return self.not_after is None or now < self.not_after
+
+
+class KeyRing:
+    # Keys come from a JSON manifest:
+    # {"keys": [{"kid": "2026-10", "algorithm": "RS256", "private_key_path": "keys/2026-10.pem",
+    #            "not_before": "2026-10-01T00:00:00Z", "not_after": "2027-01-08T00:00:00Z"}]}
+    # The newest key past its not_before signs, every key before its not_after
+    # verifies and is published in the JWKS. Publish a new key ahead of its
+    # not_before and keep the old one until its last refresh token expires.
+    def __init__(self, manifest_path: Optional[str], reload_interval: float, accept_legacy_hs: bool):
+        self.manifest_path = manifest_path
+        self.reload_interval = reload_interval
+        self.keys: dict[str, SigningKey] = {}
+        self.jwks_json = b'{"keys": []}'
+        auth_data = get_auth_data()
+        self.legacy_algorithm = auth_data['algorithm']
+        self.legacy_key = jwk.construct(auth_data['secret_key'], auth_data['algorithm']) if accept_legacy_hs or not manifest_path else None
+        self._manifest_mtime = None
+        self._checked_at = 0.0
+        if manifest_path:
+            self.load()
+
+    def load(self):
+        with open(self.manifest_path, encoding="utf-8") as manifest_file:
+            manifest = json.load(manifest_file)
+        base_dir = os.path.dirname(os.path.abspath(self.manifest_path))
+        keys = {}
+        for entry in manifest["keys"]:
+            with open(os.path.join(base_dir, entry["private_key_path"]), encoding="utf-8") as key_file:
+                pem = key_file.read()
+            keys[entry["kid"]] = SigningKey(
+                kid=entry["kid"],
+                algorithm=entry["algorithm"],
+                pem=pem,
+                not_before=_parse_time(entry.get("not_before")),
+                not_after=_parse_time(entry.get("not_after")),
+            )
+        self.keys = keys
+        self._manifest_mtime = os.path.getmtime(self.manifest_path)
+        self._render_jwks()
+        logger.info("loaded %s jwt signing keys: %s", len(keys), ', '.join(keys))
+
+    def _maybe_reload(self):
+        if not self.manifest_path or time.monotonic() - self._checked_at < self.reload_interval:
+            return
+        self._checked_at = time.monotonic()
+        try:
+            if os.path.getmtime(self.manifest_path) != self._manifest_mtime:
+                self.load()
+        except (OSError, ValueError, KeyError) as e:
+            logger.error("failed to reload jwt keys, keeping the current ones: %s", e)
+        self._render_jwks()
+
+    def _render_jwks(self):
+        now = datetime.now(timezone.utc)
+        published = [key.public_jwk for key in self.keys.values() if key.can_verify(now)]
+        self.jwks_json = json.dumps({"keys": published}).encode("utf-8")
+
+    def signing_key(self) -> Optional[SigningKey]:
+        self._maybe_reload()
+        now = datetime.now(timezone.utc)
+        active = [key for key in self.keys.values() if key.can_sign(now)]
+        if not active:
+            return None
+        return max(active, key=lambda key: key.not_before or datetime.min.replace(tzinfo=timezone.utc))
+
+    def encode(self, claims: dict) -> str:
+        key = self.signing_key()
+        if key is not None:
+            return jwt.encode(claims, key.private_key, algorithm=key.algorithm, headers={"kid": key.kid})
+        if self.legacy_key is None:
+            raise ValueError("no active jwt signing key")
+        return jwt.encode(claims, self.legacy_key, algorithm=self.legacy_algorithm)
+
+    def decode(self, token: str, options: Optional[dict] = None) -> dict:
+        self._maybe_reload()
+        kid = jwt.get_unverified_header(token).get("kid")
+        if kid is None:
+            if self.legacy_key is None:
+                raise JWTError("token has no key id")
+            return jwt.decode(token, self.legacy_key, algorithms=[self.legacy_algorithm], options=options)
+        key = self.keys.get(kid)
+        if key is None or not key.can_verify(datetime.now(timezone.utc)):
+            raise JWTError(f"unknown or retired key id: {kid}")
+        return jwt.decode(token, key.public_key, algorithms=[key.algorithm], options=options)
+
+
+key_ring = KeyRing(
+    manifest_path=settings.JWT_KEYS_FILE,
+    reload_interval=settings.JWT_KEYS_RELOAD_INTERVAL,
+    accept_legacy_hs=settings.JWT_ACCEPT_LEGACY_HS,
+)
+
+
+def generate_key(kid: str, algorithm: str, manifest_path: str, not_before: Optional[str], not_after: Optional[str]):
+    if algorithm in ALGORITHMS.RSA_DS:
+        import rsa
+        _, private_key = rsa.newkeys(2048)
+        pem = private_key.save_pkcs1().decode("utf-8")
+    elif algorithm in ALGORITHMS.EC_DS:
+        import ecdsa
+        curve = {"ES256": ecdsa.NIST256p, "ES384": ecdsa.NIST384p, "ES512": ecdsa.NIST521p}[algorithm]
+        pem = ecdsa.SigningKey.generate(curve=curve).to_pem().decode("utf-8")
+    else:
+        raise ValueError(f"unsupported signing algorithm: {algorithm}")
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+    os.makedirs(base_dir, exist_ok=True)
+    key_path = os.path.join(base_dir, f"{kid}.pem")
+    with open(key_path, "w", encoding="utf-8") as key_file:
+        key_file.write(pem)
+    os.chmod(key_path, 0o600)
+    manifest = {"keys": []}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, encoding="utf-8") as manifest_file:
+            manifest = json.load(manifest_file)
+    manifest["keys"].append({
+        "kid": kid,
+        "algorithm": algorithm,
+        "private_key_path": f"{kid}.pem",
+        "not_before": not_before,
+        "not_after": not_after,
+    })
+    with open(manifest_path, "w", encoding="utf-8") as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+    print(f"added key {kid} ({algorithm}) to {manifest_path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Add a signing key to the jwt key manifest")
+    parser.add_argument("kid")
+    parser.add_argument("--algorithm", default="RS256", choices=sorted(ASYMMETRIC_ALGORITHMS))
+    parser.add_argument("--manifest", default=settings.JWT_KEYS_FILE or "keys/jwt_keys.json")
+    parser.add_argument("--not-before", help="ISO time the key starts signing, signs immediately if omitted")
+    parser.add_argument("--not-after", help="ISO time the key stops verifying")
+    args = parser.parse_args()
+    generate_key(args.kid, args.algorithm, args.manifest, args.not_before, args.not_after)
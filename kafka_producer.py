@@ -1,34 +1,357 @@
+import asyncio
+import fcntl
+import json
+import os
+import time
+from contextlib import contextmanager
 from datetime import datetime
+from typing import Optional
 
 from confluent_kafka import Producer
-import json
+from prometheus_client import Counter, Gauge, Histogram
 
+from config.config import settings
 from config.logger import logger
+from instrumentation import timed
+
+
+KAFKA_QUEUE_DEPTH = Gauge(
+    "kafka_producer_queue_depth",
+    "Events waiting in the in-memory queue before being handed to the Kafka client",
+    multiprocess_mode="livesum",
+)
+KAFKA_DELIVERY_LATENCY = Histogram(
+    "kafka_delivery_latency_seconds",
+    "Time from enqueueing an event to its delivery report",
+    ["topic"],
+    buckets=[0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0],
+)
+KAFKA_DELIVERY_FAILURES = Counter(
+    "kafka_delivery_failures_total",
+    "Events the broker failed to acknowledge",
+    ["topic"],
+)
+KAFKA_OVERFLOWS = Counter(
+    "kafka_producer_overflow_total",
+    "Events that did not fit into the in-memory queue",
+    ["policy"],
+)
+KAFKA_SPILL_MALFORMED = Counter(
+    "kafka_spill_malformed_total",
+    "Lines of the spill file that could not be parsed and were dropped on replay",
+)
+KAFKA_SPILL_DROPPED = Counter(
+    "kafka_spill_dropped_total",
+    "Events dropped because the spill file stayed locked and the in-memory backlog was full",
+)
+
+
+class FakeMessage:
+    def __init__(self, topic: str, value: bytes):
+        self._topic = topic
+        self._value = value
+
+    def topic(self):
+        return self._topic
+
+    def partition(self):
+        return 0
+
+    def value(self):
+        return self._value
+
+
+class FakeProducer:
+    # local stand-in for confluent_kafka.Producer, delivers on poll()
+    def __init__(self, conf: Optional[dict] = None):
+        self.conf = conf or {}
+        self.delivered = []
+        self._in_flight = []
+
+    def produce(self, topic, value=None, callback=None):
+        self._in_flight.append((topic, value, callback))
+
+    def poll(self, timeout=None):
+        in_flight, self._in_flight = self._in_flight, []
+        for topic, value, callback in in_flight:
+            self.delivered.append((topic, value))
+            if callback:
+                callback(None, FakeMessage(topic, value))
+        return len(in_flight)
+
+    def flush(self, timeout=None):
+        self.poll(0)
+        return 0
+
+    def __len__(self):
+        return len(self._in_flight)
 
 
-conf = {
-    'bootstrap.servers': 'kafka:9092'
-}
+class EventProducer:
+    def __init__(
+        self,
+        conf: dict,
+        fake: bool = False,
+        queue_size: int = 10000,
+        overflow_policy: str = "drop",
+        block_timeout: float = 1.0,
+        spill_path: str = "logs/kafka-spill.ndjson",
+        flush_timeout: float = 10.0,
+        poll_interval: float = 0.1,
+        replay_interval: float = 5.0,
+    ):
+        if overflow_policy not in ("drop", "block", "spill"):
+            raise ValueError("overflow_policy must be 'drop', 'block' or 'spill'")
+        self.conf = conf
+        self.fake = fake
+        self.queue_size = queue_size
+        self.overflow_policy = overflow_policy
+        self.block_timeout = block_timeout
+        self.spill_path = spill_path
+        self.flush_timeout = flush_timeout
+        self.poll_interval = poll_interval
+        self.replay_interval = replay_interval
+        self.producer = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        # spilled events that found the spill file locked, written on the next idle tick
+        self._unspilled: list[tuple[str, bytes]] = []
+        self._next_replay = 0.0
 
-producer = Producer(conf)
+    async def start(self):
+        self.producer = FakeProducer(self.conf) if self.fake else Producer(self.conf)
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        await self._replay_spill()
+        self._task = asyncio.create_task(self._run())
+        logger.info("kafka producer started, overflow policy: %s", self.overflow_policy)
 
-def delivery_report(err, msg):
-    if err is not None:
-        logger.error(f"Error in message delivery to kafka: {err}")
-    else:
-        logger.info(f"Message delivered to {msg.topic()} [{msg.partition()}]")
+    async def stop(self):
+        if self._task is None:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout=self.flush_timeout)
+        except asyncio.TimeoutError:
+            logger.error("kafka producer queue not drained on shutdown, %s events left", self._queue.qsize())
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        if self._unspilled:
+            # nothing waits for this process any more, wait for the lock
+            events, self._unspilled = self._unspilled, []
+            try:
+                await asyncio.to_thread(self._write_spill_locked, events, True)
+            except OSError as e:
+                logger.error("%s spilled kafka events lost on shutdown: %s", len(events), e)
+        with timed("kafka", "flush"):
+            remaining = await asyncio.to_thread(self.producer.flush, self.flush_timeout)
+        if remaining:
+            logger.error("%s kafka messages were not delivered before shutdown", remaining)
+        logger.info("kafka producer stopped")
 
-def send_user_registered_event(email):
+    async def send(self, topic: str, message: dict):
+        item = (topic, json.dumps(message).encode("utf-8"), time.perf_counter())
+        if self._queue is None:
+            raise RuntimeError("kafka producer is not started")
+        with timed("kafka", "enqueue"):
+            try:
+                self._queue.put_nowait(item)
+            except asyncio.QueueFull:
+                KAFKA_OVERFLOWS.labels(self.overflow_policy).inc()
+                await self._overflow(item)
+        KAFKA_QUEUE_DEPTH.set(self._queue.qsize())
+
+    async def _overflow(self, item):
+        topic, value, _ = item
+        if self.overflow_policy == "block":
+            try:
+                await asyncio.wait_for(self._queue.put(item), timeout=self.block_timeout)
+                return
+            except asyncio.TimeoutError:
+                logger.error("kafka producer queue is full, dropping event for topic %s", topic)
+        elif self.overflow_policy == "spill":
+            await self._spill([(topic, value)])
+        else:
+            logger.error("kafka producer queue is full, dropping event for topic %s", topic)
+
+    @contextmanager
+    def _spill_lock(self, blocking: bool = True):
+        # every worker process of the server shares the spill file: appends
+        # and replays take this lock, so that no worker appends to a file
+        # another one is replaying or two of them replay the same events.
+        # Yields False when not blocking and another process holds it
+        os.makedirs(os.path.dirname(self.spill_path) or ".", exist_ok=True)
+        with open(self.spill_path + ".lock", "a") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+                locked = True
+            except BlockingIOError:
+                locked = False
+            yield locked
+
+    async def _spill(self, events):
+        # the file work runs in a thread and never waits for the lock: while
+        # another worker replays, events are kept in memory for the next idle
+        # tick, up to queue_size of them
+        try:
+            written = await asyncio.to_thread(self._write_spill_locked, events, False)
+        except OSError as e:
+            logger.error("could not spill kafka events: %s", e)
+            written = False
+        if not written:
+            self._hold(events)
+
+    def _hold(self, events):
+        room = self.queue_size - len(self._unspilled)
+        self._unspilled.extend(events[:room])
+        if len(events) > room:
+            KAFKA_SPILL_DROPPED.inc(len(events) - room)
+            logger.error("kafka spill file is busy, dropping %s events", len(events) - room)
+
+    def _write_spill_locked(self, events, blocking: bool) -> bool:
+        with self._spill_lock(blocking) as locked:
+            if locked:
+                self._write_spill(events)
+            return locked
+
+    def _write_spill(self, events):
+        with open(self.spill_path, "a", encoding="utf-8") as spill_file:
+            for topic, value in events:
+                spill_file.write(json.dumps({"topic": topic, "value": value.decode("utf-8")}) + "\n")
+
+    async def _replay_spill(self):
+        self._next_replay = time.monotonic() + self.replay_interval
+        try:
+            items = await asyncio.to_thread(self._take_spilled, self._queue.maxsize - self._queue.qsize())
+        except OSError as e:
+            logger.error("could not replay spilled kafka events: %s", e)
+            return
+        left = []
+        for item in items:
+            try:
+                self._queue.put_nowait(item)
+            except asyncio.QueueFull:
+                # send() filled the queue while the file was read
+                left.append(item[:2])
+        if left:
+            self._hold(left)
+
+    def _take_spilled(self, limit: int) -> list:
+        # up to `limit` spilled events, the rest stays in the spill file
+        replay_path = self.spill_path + ".replay"
+        if not os.path.exists(replay_path) and not os.path.exists(self.spill_path):
+            return []
+        with self._spill_lock(blocking=False) as locked:
+            # skipped while another worker is replaying
+            if not locked:
+                return []
+            # a replay cut short by a crash is resumed before newer spills are
+            # taken, its events are older
+            if not os.path.exists(replay_path):
+                if not os.path.exists(self.spill_path):
+                    return []
+                os.replace(self.spill_path, replay_path)
+            items = []
+            overflow = []
+            malformed = 0
+            with open(replay_path, encoding="utf-8") as replay_file:
+                for line in replay_file:
+                    # a line cut off by a crash while spilling
+                    try:
+                        event = json.loads(line)
+                        item = (event["topic"], event["value"].encode("utf-8"), time.perf_counter())
+                    except (ValueError, KeyError, TypeError, AttributeError):
+                        malformed += 1
+                        continue
+                    if len(items) < limit:
+                        items.append(item)
+                    else:
+                        overflow.append(item[:2])
+            if overflow:
+                self._write_spill(overflow)
+            os.remove(replay_path)
+        if malformed:
+            KAFKA_SPILL_MALFORMED.inc(malformed)
+            logger.error("dropped %s malformed lines of the kafka spill file", malformed)
+        logger.info("replayed %s spilled kafka events, %s still on disk", len(items), len(overflow))
+        return items
+
+    async def _run(self):
+        while True:
+            try:
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    self.producer.poll(0)
+                    if self._unspilled:
+                        events, self._unspilled = self._unspilled, []
+                        await self._spill(events)
+                    if (
+                        self.overflow_policy == "spill"
+                        and self._queue.empty()
+                        and time.monotonic() >= self._next_replay
+                    ):
+                        await self._replay_spill()
+                    continue
+                await self._produce(*item)
+                # hand over whatever else is queued before serving delivery reports
+                while not self._queue.empty():
+                    await self._produce(*self._queue.get_nowait())
+                KAFKA_QUEUE_DEPTH.set(self._queue.qsize())
+                self.producer.poll(0)
+            except Exception as e:
+                # keep the loop alive, a dead loop would leave every later event queued forever
+                logger.error("kafka producer loop failed: %s", e)
+                await asyncio.sleep(self.poll_interval)
+
+    async def _produce(self, topic: str, value: bytes, enqueued_at: float):
+        try:
+            while True:
+                try:
+                    self.producer.produce(
+                        topic,
+                        value=value,
+                        callback=lambda err, msg: self._delivery_report(err, msg, enqueued_at),
+                    )
+                    break
+                except BufferError:
+                    # librdkafka's local queue is full, let it drain
+                    self.producer.poll(0)
+                    await asyncio.sleep(self.poll_interval)
+        finally:
+            self._queue.task_done()
+
+    def _delivery_report(self, err, msg, enqueued_at: float):
+        KAFKA_DELIVERY_LATENCY.labels(msg.topic()).observe(time.perf_counter() - enqueued_at)
+        if err is not None:
+            KAFKA_DELIVERY_FAILURES.labels(msg.topic()).inc()
+            logger.error("Error in message delivery to kafka: %s", err)
+        else:
+            logger.info("Message delivered to %s [%s]", msg.topic(), msg.partition())
+
+
+event_producer = EventProducer(
+    conf={
+        'bootstrap.servers': settings.KAFKA_BOOTSTRAP_SERVERS,
+        'linger.ms': settings.KAFKA_LINGER_MS,
+        'batch.num.messages': settings.KAFKA_BATCH_SIZE,
+    },
+    fake=settings.KAFKA_PRODUCER == "fake",
+    queue_size=settings.KAFKA_QUEUE_SIZE,
+    overflow_policy=settings.KAFKA_OVERFLOW_POLICY,
+    block_timeout=settings.KAFKA_BLOCK_TIMEOUT,
+    spill_path=settings.KAFKA_SPILL_PATH,
+    flush_timeout=settings.KAFKA_FLUSH_TIMEOUT,
+    replay_interval=settings.KAFKA_SPILL_REPLAY_INTERVAL,
+)
+
+async def send_user_registered_event(email):
     topic = 'user-registration'
     message = {
         'event_type': 'user-registered',
         'email': email,
         'timestamp': datetime.now().isoformat()
     }
-
-    producer.produce(
-        topic,
-        value=json.dumps(message).encode('utf-8'),
-        callback=delivery_report
-    )
-    producer.flush()
\ No newline at end of file
+    await event_producer.send(topic, message)
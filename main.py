@@ -1,17 +1,28 @@
+import os
 from contextlib import asynccontextmanager
 
 import uvicorn
 from fastapi import FastAPI
 from fastapi_cache import FastAPICache
+from prometheus_client import multiprocess
 from starlette_exporter import PrometheusMiddleware, handle_metrics
 from fastapi_cache.backends.redis import RedisBackend
 from redis import asyncio as aioredis
 
 from config.logger import logger
 from repository import AuthRepository 
-from routers import router as auth_router
-from database.database import create_tables, delete_tables, async_session, REDIS_URL
+from routers import router as auth_router, jwks_router
+from database.database import create_tables, delete_tables, startup_lock, async_session, replica_router, REDIS_URL
 from database.models import RoleEnum
+from hashing import password_hasher
+from kafka_producer import event_producer
+from cache import cache_invalidator
+from rate_limit import login_rate_limiter
+from revocation import revocation_list
+from email_filter import email_filter
+from config.config import settings
+from grpc_server import start_grpc_server
+from instrumentation import event_loop_monitor, profiler
 
 default_admin_user = {
   "email": "admin@example.com",
@@ -21,34 +32,70 @@ default_admin_user = {
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    await create_tables()
-    redis = await aioredis.from_url(REDIS_URL, encoding="utf8", decode_responses=True)
+    event_loop_monitor.start()
+    async with startup_lock():
+        await create_tables()
+        async with async_session() as db_session:
+            await AuthRepository.add_admin_user(default_admin_user, db_session)
+    await replica_router.start()
+    redis = await aioredis.from_url(REDIS_URL)
     FastAPICache.init(RedisBackend(redis), prefix="fastapi-cache")
-    logger.info(f"Redis cache initialized")
-    async with async_session() as db_session:
-        await AuthRepository.add_admin_user(default_admin_user, db_session)
+    logger.info("Redis cache initialized")
+    await cache_invalidator.start(redis)
+    login_rate_limiter.start(redis)
+    await revocation_list.start(redis)
+    await event_producer.start()
+    await email_filter.start(redis)
+    grpc_server = None
+    if settings.GRPC_PORT:
+        grpc_server = await start_grpc_server(settings.GRPC_PORT)
+    logger.info(
+        "worker %s (%s in total): up to %s database connections, %s password hashing workers",
+        os.getpid(),
+        settings.SERVER_WORKERS,
+        settings.DB_POOL_SIZE + settings.DB_MAX_OVERFLOW,
+        settings.PASSWORD_HASH_WORKERS,
+    )
     yield
+    if grpc_server is not None:
+        await grpc_server.stop(settings.GRPC_GRACE_PERIOD)
+    await event_producer.stop()
+    await cache_invalidator.stop()
+    login_rate_limiter.stop()
+    await revocation_list.stop()
+    await email_filter.stop()
     await redis.close()
-    await delete_tables()
+    password_hasher.shutdown()
+    await replica_router.stop()
+    if settings.DROP_TABLES_ON_SHUTDOWN:
+        await delete_tables()
+    profiler.stop()
+    await event_loop_monitor.stop()
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        multiprocess.mark_process_dead(os.getpid())
 
 app = FastAPI(lifespan=lifespan)
 
 app.include_router(auth_router, prefix="/auth", tags=["auth-service"])
+app.include_router(jwks_router, tags=["auth-service"])
 
 app.add_middleware(
     PrometheusMiddleware,
     app_name="api_monitoring",
     group_paths=True,
     skip_paths=[],
-    buckets=[0.1, 0.3, 0.5, 0.7, 1.0, 2.5]
+    buckets=settings.HTTP_LATENCY_BUCKETS
 )
 app.add_route("/metrics", handle_metrics)
 
 if __name__ == "__main__":
+    # development server, production runs through server.py
     uvicorn.run(
         "main:app",
-        host="0.0.0.0",
-        port=8000,
-        reload=True
+        host=settings.SERVER_HOST,
+        port=settings.SERVER_PORT,
+        reload=True,
+        # uvicorn's own loggers go through the application's queue handler
+        log_config=None
     )
     logger.info("App started")
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+# Generated by the protocol buffer compiler.  DO NOT EDIT!
+# NO CHECKED-IN PROTOBUF GENCODE
+# source: proto/introspection.proto
+# Protobuf Python Version: 5.29.0
+"""Generated protocol buffer code."""
+from google.protobuf import descriptor as _descriptor
+from google.protobuf import descriptor_pool as _descriptor_pool
+from google.protobuf import runtime_version as _runtime_version
+from google.protobuf import symbol_database as _symbol_database
+from google.protobuf.internal import builder as _builder
+_runtime_version.ValidateProtobufRuntimeVersion(
+    _runtime_version.Domain.PUBLIC,
+    5,
+    29,
+    0,
+    '',
+    'proto/introspection.proto'
+)
+# @@protoc_insertion_point(imports)
+
+_sym_db = _symbol_database.Default()
+
+
+from google.protobuf import struct_pb2 as google_dot_protobuf_dot_struct__pb2
+
+
+DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\x19proto/introspection.proto\x12\x15\x61uth.introspection.v1\x1a\x1cgoogle/protobuf/struct.proto\"#\n\x11IntrospectRequest\x12\x0e\n\x06tokens\x18\x01 \x03(\t\"\x82\x01\n\tTokenInfo\x12\x0e\n\x06\x61\x63tive\x18\x01 \x01(\x08\x12\r\n\x05\x65rror\x18\x02 \x01(\t\x12\x0f\n\x07user_id\x18\x03 \x01(\x03\x12\x0c\n\x04role\x18\x04 \x01(\t\x12\x0e\n\x06status\x18\x05 \x01(\t\x12\'\n\x06\x63laims\x18\x06 \x01(\x0b\x32\x17.google.protobuf.Struct\"G\n\x12IntrospectResponse\x12\x31\n\x07results\x18\x01 \x03(\x0b\x32 .auth.introspection.v1.TokenInfo2\xe4\x01\n\x12TokenIntrospection\x12\x61\n\nIntrospect\x12(.auth.introspection.v1.IntrospectRequest\x1a).auth.introspection.v1.IntrospectResponse\x12k\n\x10IntrospectStream\x12(.auth.introspection.v1.IntrospectRequest\x1a).auth.introspection.v1.IntrospectResponse(\x01\x30\x01\x62\x06proto3')
+
+_globals = globals()
+_builder.BuildMessageAndEnumDescriptors(DESCRIPTOR, _globals)
+_builder.BuildTopDescriptorsAndMessages(DESCRIPTOR, 'proto.introspection_pb2', _globals)
+if not _descriptor._USE_C_DESCRIPTORS:
+  DESCRIPTOR._loaded_options = None
+  _globals['_INTROSPECTREQUEST']._serialized_start=82
+  _globals['_INTROSPECTREQUEST']._serialized_end=117
+  _globals['_TOKENINFO']._serialized_start=120
+  _globals['_TOKENINFO']._serialized_end=250
+  _globals['_INTROSPECTRESPONSE']._serialized_start=252
+  _globals['_INTROSPECTRESPONSE']._serialized_end=323
+  _globals['_TOKENINTROSPECTION']._serialized_start=326
+  _globals['_TOKENINTROSPECTION']._serialized_end=554
+# @@protoc_insertion_point(module_scope)
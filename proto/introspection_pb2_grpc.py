@@ -0,0 +1,142 @@
+# Generated by the gRPC Python protocol compiler plugin. DO NOT EDIT!
+"""Client and server classes corresponding to protobuf-defined services."""
+import grpc
+import warnings
+
+from proto import introspection_pb2 as proto_dot_introspection__pb2
+
+GRPC_GENERATED_VERSION = '1.71.0'
+GRPC_VERSION = grpc.__version__
+_version_not_supported = False
+
+try:
+    from grpc._utilities import first_version_is_lower
+    _version_not_supported = first_version_is_lower(GRPC_VERSION, GRPC_GENERATED_VERSION)
+except ImportError:
+    _version_not_supported = True
+
+if _version_not_supported:
+    raise RuntimeError(
+        f'The grpc package installed is at version {GRPC_VERSION},'
+        + f' but the generated code in proto/introspection_pb2_grpc.py depends on'
+        + f' grpcio>={GRPC_GENERATED_VERSION}.'
+        + f' Please upgrade your grpc module to grpcio>={GRPC_GENERATED_VERSION}'
+        + f' or downgrade your generated code using grpcio-tools<={GRPC_VERSION}.'
+    )
+
+
+class TokenIntrospectionStub(object):
+    """Missing associated documentation comment in .proto file."""
+
+    def __init__(self, channel):
+        """Constructor.
+
+        Args:
+            channel: A grpc.Channel.
+        """
+        self.Introspect = channel.unary_unary(
+                '/auth.introspection.v1.TokenIntrospection/Introspect',
+                request_serializer=proto_dot_introspection__pb2.IntrospectRequest.SerializeToString,
+                response_deserializer=proto_dot_introspection__pb2.IntrospectResponse.FromString,
+                _registered_method=True)
+        self.IntrospectStream = channel.stream_stream(
+                '/auth.introspection.v1.TokenIntrospection/IntrospectStream',
+                request_serializer=proto_dot_introspection__pb2.IntrospectRequest.SerializeToString,
+                response_deserializer=proto_dot_introspection__pb2.IntrospectResponse.FromString,
+                _registered_method=True)
+
+
+class TokenIntrospectionServicer(object):
+    """Missing associated documentation comment in .proto file."""
+
+    def Introspect(self, request, context):
+        """validates a batch of tokens in one call
+        """
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def IntrospectStream(self, request_iterator, context):
+        """one response per request message, for gateways that keep a stream open
+        """
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+
+def add_TokenIntrospectionServicer_to_server(servicer, server):
+    rpc_method_handlers = {
+            'Introspect': grpc.unary_unary_rpc_method_handler(
+                    servicer.Introspect,
+                    request_deserializer=proto_dot_introspection__pb2.IntrospectRequest.FromString,
+                    response_serializer=proto_dot_introspection__pb2.IntrospectResponse.SerializeToString,
+            ),
+            'IntrospectStream': grpc.stream_stream_rpc_method_handler(
+                    servicer.IntrospectStream,
+                    request_deserializer=proto_dot_introspection__pb2.IntrospectRequest.FromString,
+                    response_serializer=proto_dot_introspection__pb2.IntrospectResponse.SerializeToString,
+            ),
+    }
+    generic_handler = grpc.method_handlers_generic_handler(
+            'auth.introspection.v1.TokenIntrospection', rpc_method_handlers)
+    server.add_generic_rpc_handlers((generic_handler,))
+    server.add_registered_method_handlers('auth.introspection.v1.TokenIntrospection', rpc_method_handlers)
+
+
+ # This class is part of an EXPERIMENTAL API.
+class TokenIntrospection(object):
+    """Missing associated documentation comment in .proto file."""
+
+    @staticmethod
+    def Introspect(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(
+            request,
+            target,
+            '/auth.introspection.v1.TokenIntrospection/Introspect',
+            proto_dot_introspection__pb2.IntrospectRequest.SerializeToString,
+            proto_dot_introspection__pb2.IntrospectResponse.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
+
+    @staticmethod
+    def IntrospectStream(request_iterator,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.stream_stream(
+            request_iterator,
+            target,
+            '/auth.introspection.v1.TokenIntrospection/IntrospectStream',
+            proto_dot_introspection__pb2.IntrospectRequest.SerializeToString,
+            proto_dot_introspection__pb2.IntrospectResponse.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
@@ -0,0 +1,167 @@
+import math
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from fastapi import HTTPException, Request, status
+from prometheus_client import Counter
+
+from config.config import settings
+from config.logger import logger
+from instrumentation import timed
+
+
+RATE_LIMIT_REJECTED = Counter(
+    "rate_limit_rejected_total",
+    "Requests rejected by the rate limiter",
+    ["scope", "tier"],
+)
+RATE_LIMIT_ERRORS = Counter(
+    "rate_limit_errors_total",
+    "Rate limit checks that could not reach Redis and were let through",
+)
+
+# token buckets for all keys are checked first and only consumed if every one
+# of them has a token left, so a request rejected by the global limit does not
+# use up the caller's per-email budget
+TOKEN_BUCKET_SCRIPT = """
+local now = tonumber(ARGV[1])
+local tokens = {}
+for i = 1, #KEYS do
+    local capacity = tonumber(ARGV[i * 2])
+    local rate = tonumber(ARGV[i * 2 + 1])
+    local bucket = redis.call('HMGET', KEYS[i], 'tokens', 'ts')
+    local available = tonumber(bucket[1]) or capacity
+    local updated = tonumber(bucket[2]) or now
+    available = math.min(capacity, available + math.max(now - updated, 0) * rate)
+    if available < 1 then
+        return {i, tostring((1 - available) / rate)}
+    end
+    tokens[i] = available
+end
+for i = 1, #KEYS do
+    local capacity = tonumber(ARGV[i * 2])
+    local rate = tonumber(ARGV[i * 2 + 1])
+    redis.call('HSET', KEYS[i], 'tokens', tostring(tokens[i] - 1), 'ts', tostring(now))
+    redis.call('EXPIRE', KEYS[i], math.ceil(capacity / rate) + 1)
+end
+return {0, '0'}
+"""
+
+
+class LocalTokenBuckets:
+    # in-process pre-filter: if this process alone has used up a key's budget
+    # the fleet-wide bucket is empty too, so the Redis round trip is skipped
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._buckets: OrderedDict[str, tuple[float, float]] = OrderedDict()
+
+    def retry_after(self, key: str, capacity: int, rate: float, now: float) -> float:
+        tokens, updated = self._buckets.pop(key, (capacity, now))
+        tokens = min(capacity, tokens + max(now - updated, 0) * rate)
+        self._buckets[key] = (tokens, now)
+        if len(self._buckets) > self.maxsize:
+            self._buckets.popitem(last=False)
+        return 0.0 if tokens >= 1 else (1 - tokens) / rate
+
+    def consume(self, key: str):
+        tokens, updated = self._buckets[key]
+        self._buckets[key] = (tokens - 1, updated)
+
+    def refund(self, key: str):
+        # the bucket may have been evicted since, then there is nothing to give back
+        bucket = self._buckets.get(key)
+        if bucket is not None:
+            self._buckets[key] = (bucket[0] + 1, bucket[1])
+
+    def clear(self):
+        self._buckets.clear()
+
+
+class RateLimiter:
+    def __init__(self, name: str, limits: dict[str, int], window: float, local_maxsize: int, enabled: bool = True):
+        # limits are requests per window for each scope, 0 turns a scope off
+        self.name = name
+        self.limits = {scope: limit for scope, limit in limits.items() if limit > 0}
+        self.window = window
+        self.enabled = enabled
+        self.local = LocalTokenBuckets(local_maxsize)
+        self._script = None
+
+    def start(self, redis):
+        self._script = redis.register_script(TOKEN_BUCKET_SCRIPT)
+
+    def stop(self):
+        self._script = None
+        self.local.clear()
+
+    def _reject(self, scope: str, tier: str, retry_after: float):
+        RATE_LIMIT_REJECTED.labels(scope, tier).inc()
+        logger.warning("%s rate limit exceeded for %s", self.name, scope)
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="too many attempts, try again later",
+            headers={"Retry-After": str(max(math.ceil(retry_after), 1))},
+        )
+
+    async def check(self, **identities: Optional[str]):
+        # identities maps a scope to the caller's value for it, e.g. email=...,
+        # ip=...; the "global" scope needs no value
+        if not self.enabled:
+            return
+        buckets = []
+        for scope, limit in self.limits.items():
+            if scope == "global":
+                buckets.append((scope, f"rate-limit:{self.name}:global", limit))
+            elif identities.get(scope):
+                buckets.append((scope, f"rate-limit:{self.name}:{scope}:{identities[scope]}", limit))
+        if not buckets:
+            return
+
+        now = time.time()
+        for scope, key, limit in buckets:
+            retry_after = self.local.retry_after(key, limit, limit / self.window, now)
+            if retry_after:
+                self._reject(scope, "local", retry_after)
+        for _, key, _ in buckets:
+            self.local.consume(key)
+
+        if self._script is None:
+            return
+        args = [now]
+        for _, _, limit in buckets:
+            args += [limit, limit / self.window]
+        try:
+            with timed("redis", "rate_limit"):
+                rejected, retry_after = await self._script(keys=[key for _, key, _ in buckets], args=args)
+        except Exception as e:
+            # fail open, the local buckets still cap what a single process lets through
+            RATE_LIMIT_ERRORS.inc()
+            logger.warning("%s rate limit check failed: %s", self.name, e)
+            return
+        if rejected:
+            # Redis took no token from any bucket, neither does this process
+            for _, key, _ in buckets:
+                self.local.refund(key)
+            self._reject(buckets[rejected - 1][0], "redis", float(retry_after))
+
+
+def client_ip(request: Request) -> Optional[str]:
+    if settings.RATE_LIMIT_TRUST_FORWARDED_FOR:
+        forwarded = request.headers.get("x-forwarded-for")
+        if forwarded:
+            return forwarded.split(",")[0].strip()
+    return request.client.host if request.client else None
+
+
+login_rate_limiter = RateLimiter(
+    name="login",
+    limits={
+        "email": settings.RATE_LIMIT_LOGIN_PER_EMAIL,
+        "ip": settings.RATE_LIMIT_LOGIN_PER_IP,
+        "global": settings.RATE_LIMIT_LOGIN_GLOBAL,
+    },
+    window=settings.RATE_LIMIT_WINDOW,
+    local_maxsize=settings.RATE_LIMIT_LOCAL_MAXSIZE,
+    enabled=settings.RATE_LIMIT_ENABLED,
+)
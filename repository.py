@@ -1,88 +1,258 @@
-from datetime import timedelta
+from typing import AsyncIterator, Optional
 
 from fastapi import HTTPException
-from sqlalchemy import select, insert, update
+from sqlalchemy import select, update, exists, or_
 from sqlalchemy.ext.asyncio import AsyncSession
-from passlib.context import CryptContext
-from fastapi_cache.decorator import cache
 
-from database.models import Users, AccountStatus
-from schemas import UserCreate, UserRead, UserUpdate, CreateAdminUser
+from database.database import async_session, release_connection, dialect_insert, execute_read, replica_reads, replica_router, any_of
+from database.models import Users, AccountStatus, RoleEnum
+from schemas import UserCreate, UserRead, UserUpdate, CreateAdminUser, UserRecordCoder
 from config.logger import logger
+from hashing import password_hasher, pwd_context, HASH_UPGRADES
+from cache import cached, cache_key, fill_guard, invalidate, get_many, set_many, get_many_keys, set_many_keys, cache_invalidator
+from instrumentation import timed, timed_stage
+from email_filter import email_filter
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# a user whose cache keys were just invalidated is read from the primary for a while
+cache_invalidator.listeners.append(replica_router.stick)
 
-def get_password_hash(password: str) -> str:
-    return pwd_context.hash(password)
+@timed_stage("password_hash", "hash")
+async def get_password_hash(password: str) -> str:
+    return await password_hasher.hash(pwd_context, password)
 class AuthRepository:
     @classmethod
-    async def add_user(cls, user: UserCreate, session: AsyncSession) -> int:
+    async def add_user(cls, user: UserCreate, session: AsyncSession) -> Optional[Users]:
+        # the unique index decides, None means the email is already taken
         user_model = user.model_dump()
-        user_model['password'] = get_password_hash(user.password)
-        query = insert(Users).values(**user_model).returning(Users)
-        result = await session.execute(query)
-        user = result.scalar_one_or_none()
-        logger.info(f"user: {user.email} created")
-        await session.commit()
-        return user
+        user_model['password'] = await get_password_hash(user.password)
+        query = (
+            dialect_insert(Users)
+            .values(**user_model)
+            .on_conflict_do_nothing(index_elements=[Users.email])
+            .returning(Users)
+        )
+        with timed("db", "add_user"):
+            result = await session.execute(query)
+            new_user = result.scalar_one_or_none()
+            await session.commit()
+        if new_user is None:
+            logger.warning("user: %s already exists", user.email)
+            return None
+        await email_filter.add(new_user.email)
+        logger.info("user: %s created", new_user.email)
+        return new_user
     @classmethod
-    @cache(expire=timedelta(minutes=5), namespace="users")
+    @timed_stage("db")
+    async def email_exists(cls, email: str, session: AsyncSession) -> bool:
+        result = await execute_read(session, select(exists().where(Users.email==email)), cache_key("users:email", email))
+        found = result.scalar()
+        await release_connection(session)
+        return bool(found)
+    @classmethod
+    @cached(namespace="users:email", key=lambda cls, email, session: email, expire=300, coder=UserRecordCoder)
+    @timed_stage("db")
     async def find_user_by_email(cls, email: str, session: AsyncSession):
         query = select(Users).where(Users.email==email)
-        result = await session.execute(query)
+        result = await execute_read(session, query, cache_key("users:email", email))
         user = result.scalar_one_or_none()
+        await release_connection(session)
         if user:
-            logger.info(f"user: {user.email} is found")
-            return UserRead.model_validate(user)
-        logger.warning(f"user with email: {email} is not found")
+            logger.info("user: %s is found", user.email)
+            return UserRead.from_row(user)
+        logger.warning("user with email: %s is not found", email)
         return None
     @classmethod
-    async def find_all_users(cls, session: AsyncSession):
-        query = select(Users)
-        result = await session.execute(query)
-        users = result.scalars().all()
-        if users:
-            logger.info(f"selected all users")
-            users_list = [UserRead.model_validate(user) for user in users]
-            return users_list
-        logger.warning(f"no users found")
-        return None
+    @timed_stage("db")
+    async def find_credentials(cls, email: str, session: AsyncSession) -> Optional[tuple[UserRead, str]]:
+        # login only: the password hash is read straight from the database and
+        # never cached
+        query = select(Users).where(Users.email==email)
+        result = await execute_read(session, query, cache_key("users:email", email))
+        user = result.scalar_one_or_none()
+        await release_connection(session)
+        if user is None:
+            logger.warning("user with email: %s is not found", email)
+            return None
+        return UserRead.from_row(user), user.password
+    @classmethod
+    def _users_query(cls, after_id: Optional[int], status: Optional[AccountStatus], role: Optional[RoleEnum]):
+        query = select(Users).order_by(Users.id)
+        if after_id is not None:
+            query = query.where(Users.id > after_id)
+        if status is not None:
+            query = query.where(Users.status == status)
+        if role is not None:
+            query = query.where(Users.role == role)
+        return query
+    @classmethod
+    @timed_stage("db")
+    async def find_users_page(
+        cls,
+        session: AsyncSession,
+        after_id: Optional[int] = None,
+        limit: int = 100,
+        status: Optional[AccountStatus] = None,
+        role: Optional[RoleEnum] = None,
+    ) -> list[UserRead]:
+        query = cls._users_query(after_id, status, role).limit(limit)
+        result = await execute_read(session, query)
+        users = [UserRead.from_row(user) for user in result.scalars()]
+        await release_connection(session)
+        logger.info("selected %s users after id %s", len(users), after_id)
+        return users
     @classmethod
-    @cache(expire=timedelta(minutes=5), namespace="users")
+    async def stream_users(
+        cls,
+        session: AsyncSession,
+        status: Optional[AccountStatus] = None,
+        role: Optional[RoleEnum] = None,
+        chunk_size: int = 1000,
+    ) -> AsyncIterator[list[UserRead]]:
+        # server-side cursor, only one chunk of rows is held in memory at a time
+        query = cls._users_query(None, status, role).execution_options(yield_per=chunk_size)
+        with replica_reads(session):
+            result = await session.stream(query)
+            async for partition in result.scalars().partitions():
+                yield [UserRead.from_row(user) for user in partition]
+    @classmethod
+    @cached(namespace="users:id", key=lambda cls, id, session: str(id), expire=300, coder=UserRecordCoder)
+    @timed_stage("db")
     async def find_user_by_id(cls, id: int, session: AsyncSession):
         query = select(Users).where(Users.id==id)
-        result = await session.execute(query)
+        result = await execute_read(session, query, cache_key("users:id", str(id)))
         user = result.scalar_one_or_none()
+        await release_connection(session)
         if user:
-            logger.info(f"user: {user.email} is found")
-            return UserRead.model_validate(user)
-        logger.warning(f"user with id: {id} is not found")
+            logger.info("user: %s is found", user.email)
+            return UserRead.from_row(user)
+        logger.warning("user with id: %s is not found", id)
         raise HTTPException(status_code=404, detail="user not found")
     @classmethod
-    async def update_user(cls, user_id: int, new_user_data: UserUpdate, session: AsyncSession) -> int:
+    async def find_users_by_ids(cls, ids: list[int], session: AsyncSession) -> dict[int, UserRead]:
+        unique_ids = list(dict.fromkeys(ids))
+        guard = fill_guard()
+        found = await get_many("users:id", [str(id) for id in unique_ids], guard)
+        users = {int(id): user for id, user in found.items()}
+        missing = [id for id in unique_ids if id not in users]
+        if missing:
+            query = select(Users).where(any_of(Users.id, missing))
+            with timed("db", "find_users_by_ids"):
+                result = await execute_read(session, query, *(cache_key("users:id", str(id)) for id in missing))
+                loaded = {user.id: UserRead.from_row(user) for user in result.scalars()}
+                await release_connection(session)
+            await set_many("users:id", {str(id): user for id, user in loaded.items()}, guard)
+            users.update(loaded)
+        logger.info("found %s of %s users by id", len(users), len(unique_ids))
+        return users
+    @classmethod
+    async def lookup_users(
+        cls,
+        ids: list[int],
+        emails: list[str],
+        session: AsyncSession,
+    ) -> tuple[list[Optional[UserRead]], list[Optional[UserRead]]]:
+        # one MGET over both namespaces, one query for the misses and one
+        # pipeline to cache what was loaded under its id and its email
+        wanted = [("users:id", str(id)) for id in dict.fromkeys(ids)]
+        wanted += [("users:email", email) for email in dict.fromkeys(emails)]
+        guard = fill_guard()
+        found = await get_many_keys(wanted, guard)
+        by_id = {int(key): user for (namespace, key), user in found.items() if namespace == "users:id"}
+        by_email = {key: user for (namespace, key), user in found.items() if namespace == "users:email"}
+        missing_ids = [int(key) for namespace, key in wanted if namespace == "users:id" and int(key) not in by_id]
+        missing_emails = [key for namespace, key in wanted if namespace == "users:email" and key not in by_email]
+        if missing_ids or missing_emails:
+            conditions = []
+            if missing_ids:
+                conditions.append(any_of(Users.id, missing_ids))
+            if missing_emails:
+                conditions.append(any_of(Users.email, missing_emails))
+            sticky_keys = [cache_key("users:id", str(id)) for id in missing_ids]
+            sticky_keys += [cache_key("users:email", email) for email in missing_emails]
+            with timed("db", "lookup_users"):
+                result = await execute_read(session, select(Users).where(or_(*conditions)), *sticky_keys)
+                loaded = [UserRead.from_row(user) for user in result.scalars()]
+                await release_connection(session)
+            backfill = []
+            for user in loaded:
+                by_id[user.id] = by_email[user.email] = user
+                backfill += [("users:id", str(user.id), user), ("users:email", user.email, user)]
+            await set_many_keys(backfill, guard)
+        logger.info("looked up %s ids and %s emails, %s missed the cache",
+                    len(ids), len(emails), len(missing_ids) + len(missing_emails))
+        return [by_id.get(id) for id in ids], [by_email.get(email) for email in emails]
+    @classmethod
+    async def update_user(cls, user_id: int, new_user_data: UserUpdate, session: AsyncSession) -> Optional[UserRead]:
         user_model = new_user_data.model_dump(exclude_unset=True)
         if user_model["password"]:
-            user_model['password'] = get_password_hash(new_user_data.password)
-        query = update(Users).where(Users.id==user_id).values(**user_model).returning(Users)
-        result = await session.execute(query)
-        user = result.scalar_one_or_none()
-        logger.info(f"updated account data for user with id: {user_id}")
-        await session.commit()
-        return user
+            user_model['password'] = await get_password_hash(new_user_data.password)
+        with timed("db", "update_user"):
+            old_email = await session.scalar(select(Users.email).where(Users.id==user_id))
+            query = update(Users).where(Users.id==user_id).values(**user_model).returning(Users)
+            result = await session.execute(query)
+            user = result.scalar_one_or_none()
+            await session.commit()
+        logger.info("updated account data for user with id: %s", user_id)
+        if user and user.email != old_email:
+            await email_filter.add(user.email)
+        await cls.invalidate_user(user_id, old_email, user.email if user else None)
+        return UserRead.from_row(user) if user else None
+    @classmethod
+    async def upgrade_password_hash(cls, user_id: int, email: str, old_hash: str, password: str):
+        # runs in the background after a login with an outdated hash; only
+        # replaces the hash that was verified, a password changed in the
+        # meantime is left alone
+        scheme = pwd_context.identify(old_hash, required=False) or "unknown"
+        try:
+            new_hash = await get_password_hash(password)
+            async with async_session() as session:
+                query = update(Users).where(Users.id==user_id, Users.password==old_hash).values(password=new_hash)
+                with timed("db", "upgrade_password_hash"):
+                    result = await session.execute(query)
+                    await session.commit()
+        except Exception as e:
+            HASH_UPGRADES.labels(scheme, "error").inc()
+            logger.warning("upgrading the password hash of user with id %s failed: %s", user_id, e)
+            return
+        if not result.rowcount:
+            HASH_UPGRADES.labels(scheme, "skipped").inc()
+            return
+        HASH_UPGRADES.labels(scheme, "upgraded").inc()
+        logger.info("upgraded %s password hash of user with id %s", scheme, user_id)
+        await cls.invalidate_user(user_id, email)
     @classmethod
-    async def update_account_status(cls, user_id: int, status: AccountStatus, session: AsyncSession) -> int:
+    async def update_account_status(cls, user_id: int, status: AccountStatus, session: AsyncSession) -> Optional[UserRead]:
         query = update(Users).where(Users.id==user_id).values(status=status).returning(Users)
-        result = await session.execute(query)
-        updated_user = result.scalar_one_or_none()
-        logger.info(f"updated account status for user with id: {user_id}")
-        await session.commit()
-        return updated_user
+        with timed("db", "update_account_status"):
+            result = await session.execute(query)
+            updated_user = result.scalar_one_or_none()
+            await session.commit()
+        logger.info("updated account status for user with id: %s", user_id)
+        await cls.invalidate_user(user_id, updated_user.email if updated_user else None)
+        return UserRead.from_row(updated_user) if updated_user else None
     @classmethod
     async def add_admin_user(cls, user: dict, session: AsyncSession) -> int:
-        user['password'] = get_password_hash(user['password'])
-        query = insert(Users).values(**user).returning(Users.email)
+        # idempotent, runs on every startup of every worker; checked on the
+        # primary, a lagging replica could miss an admin created a moment ago
+        if await session.scalar(select(exists().where(Users.email==user['email']))):
+            await release_connection(session)
+            logger.info("admin user %s already exists", user['email'])
+            return
+        user = {**user, 'password': await get_password_hash(user['password'])}
+        query = (
+            dialect_insert(Users)
+            .values(**user)
+            .on_conflict_do_nothing(index_elements=[Users.email])
+            .returning(Users.email)
+        )
         result = await session.execute(query)
         admin_user = result.scalar_one_or_none()
-        logger.info(f"created admin user: {admin_user}")
         await session.commit()
-    
\ No newline at end of file
+        if admin_user:
+            await email_filter.add(admin_user)
+            logger.info("created admin user: %s", admin_user)
+    @classmethod
+    async def invalidate_user(cls, user_id: int, *emails: str):
+        keys = [cache_key("users:id", str(user_id))]
+        keys += [cache_key("users:email", email) for email in set(emails) if email]
+        await invalidate(*keys)
@@ -0,0 +1,169 @@
+import asyncio
+import time
+from typing import Optional
+
+from prometheus_client import Counter, Gauge
+
+from bloom import BloomFilter
+from config.config import settings
+from config.logger import logger
+from instrumentation import timed
+
+
+REVOCATION_CHECKS = Counter(
+    "token_revocation_checks_total",
+    "Revocation checks by how they were answered",
+    ["result"],
+)
+REVOCATION_FILTER_ITEMS = Gauge(
+    "token_revocation_filter_items",
+    "Revoked ids held in this worker's Bloom filter",
+    multiprocess_mode="livemax",
+)
+REFRESH_REUSE_DETECTED = Counter(
+    "refresh_token_reuse_detected_total",
+    "Already rotated refresh tokens presented again, the whole session is revoked",
+)
+
+
+class RevocationList:
+    # revoked session ids live in Redis as keys that expire with the tokens;
+    # every revocation is also appended to a stream that all workers tail into
+    # a local Bloom filter, so a token of a session that was never revoked is
+    # accepted without a network hop and only filter hits are confirmed in
+    # Redis. Spent refresh token jtis are only SET NX keys: they are checked
+    # by claim alone, and refresh tokens are never accepted as access tokens
+    def __init__(self, stream: str, ttl: int, capacity: int, error_rate: float, rebuild_interval: float):
+        self.stream = stream
+        self.ttl = ttl
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.rebuild_interval = rebuild_interval
+        self.filter = BloomFilter(capacity, error_rate)
+        self._redis = None
+        self._last_id = "0-0"
+        self._task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def _key(id: str) -> str:
+        return f"revoked:{id}"
+
+    async def start(self, redis):
+        self._redis = redis
+        await self._rebuild()
+        self._task = asyncio.create_task(self._run())
+        logger.info("revocation filter loaded with %s ids from %s", len(self.filter), self.stream)
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        self._redis = None
+
+    def _publish(self, pipe, ids: list[str]):
+        # entries older than the longest token lifetime are trimmed, their ids
+        # can no longer match a valid token
+        min_id = f"{int((time.time() - self.ttl) * 1000)}-0"
+        for id in ids:
+            pipe.xadd(self.stream, {"id": id}, minid=min_id, approximate=True)
+            self.filter.add(id)
+
+    async def revoke(self, *ids: str, ttl: Optional[int] = None):
+        async with self._redis.pipeline(transaction=False) as pipe:
+            for id in ids:
+                pipe.set(self._key(id), 1, ex=ttl or self.ttl)
+            self._publish(pipe, list(ids))
+            await pipe.execute()
+        REVOCATION_FILTER_ITEMS.set(len(self.filter))
+
+    async def claim(self, id: str, ttl: int) -> bool:
+        # spends a single-use id, False if it had already been used; one
+        # refresh per session and rotation would swamp the filter, so spent
+        # ids stay out of the stream
+        with timed("redis", "revocation_claim"):
+            return bool(await self._redis.set(self._key(id), 1, ex=max(ttl, 1), nx=True))
+
+    async def is_spent(self, id: str) -> bool:
+        # whether claim() has used up this id, asked only for legacy tokens
+        # that have no session to revoke; their lifetime check already keeps
+        # most of them out, so an unreachable Redis lets them through
+        try:
+            with timed("redis", "revocation_spent"):
+                return bool(await self._redis.exists(self._key(id)))
+        except Exception as e:
+            REVOCATION_CHECKS.labels("error").inc()
+            logger.warning("spent token check failed: %s", e)
+            return False
+
+    async def is_revoked(self, *ids: str) -> bool:
+        candidates = [id for id in ids if id and id in self.filter]
+        if not candidates:
+            REVOCATION_CHECKS.labels("filter").inc()
+            return False
+        try:
+            with timed("redis", "revocation_check"):
+                found = await self._redis.exists(*(self._key(id) for id in candidates))
+        except Exception as e:
+            # a filter hit is almost always a real revocation, fail closed
+            REVOCATION_CHECKS.labels("error").inc()
+            logger.warning("revocation check failed, rejecting token: %s", e)
+            return True
+        REVOCATION_CHECKS.labels("revoked" if found else "false_positive").inc()
+        return bool(found)
+
+    async def _rebuild(self):
+        # expired revocations can not be removed from a Bloom filter, so it is
+        # rebuilt from the (trimmed) stream from time to time
+        rebuilt = BloomFilter(self.capacity, self.error_rate)
+        last_id = "-"
+        while True:
+            entries = await self._redis.xrange(self.stream, min=last_id, count=10000)
+            if last_id != "-":
+                entries = entries[1:]
+            if not entries:
+                break
+            for entry_id, fields in entries:
+                rebuilt.add(fields[b"id"].decode())
+            last_id = entries[-1][0]
+        # tailing resumes after the last entry read, so nothing revoked in the
+        # meantime is missed
+        if last_id != "-":
+            self._last_id = last_id.decode() if isinstance(last_id, bytes) else last_id
+        self.filter = rebuilt
+        REVOCATION_FILTER_ITEMS.set(len(rebuilt))
+
+    async def _run(self):
+        rebuild_at = time.monotonic() + self.rebuild_interval
+        while True:
+            try:
+                response = await self._redis.xread({self.stream: self._last_id}, count=1000, block=1000)
+                for _, entries in response:
+                    for entry_id, fields in entries:
+                        id = fields[b"id"].decode()
+                        # revocations made by this worker are already in the filter
+                        if id not in self.filter:
+                            self.filter.add(id)
+                        self._last_id = entry_id
+                REVOCATION_FILTER_ITEMS.set(len(self.filter))
+                if time.monotonic() >= rebuild_at:
+                    await self._rebuild()
+                    rebuild_at = time.monotonic() + self.rebuild_interval
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("reading revocations from %s failed: %s", self.stream, e)
+                await asyncio.sleep(1)
+
+
+revocation_list = RevocationList(
+    stream=settings.REVOCATION_STREAM,
+    ttl=settings.REFRESH_TOKEN_TTL_DAYS * 24 * 3600,
+    capacity=settings.REVOCATION_FILTER_CAPACITY,
+    error_rate=settings.REVOCATION_FILTER_ERROR_RATE,
+    rebuild_interval=settings.REVOCATION_FILTER_REBUILD_INTERVAL,
+)
@@ -1,25 +1,43 @@
 from typing import Optional
 
-from fastapi import APIRouter, Depends, Response, HTTPException, status, Request
+from fastapi import APIRouter, Depends, Response, HTTPException, status, Request, Query
+from fastapi.responses import StreamingResponse, PlainTextResponse
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.exc import IntegrityError
-from fastapi_cache.decorator import cache
 
 from kafka_producer import send_user_registered_event
-from database.models import AccountStatus
-from database.database import get_db
+from database.models import AccountStatus, RoleEnum
+from database.database import get_db, async_session
 from config.logger import logger
-from schemas import UserCreate, UserAuth, UserUpdate
+from schemas import UserCreate, UserAuth, UserUpdate, IntrospectRequest, TokenIntrospection, UsersPage, UsersLookupRequest, UsersLookup
 from repository import AuthRepository
+from bulk_import import import_users, iter_lines
+from jwt_keys import key_ring
+from instrumentation import profiler
+from rate_limit import login_rate_limiter, client_ip
+from email_filter import email_filter
+from config.config import settings
 from auth import (
     authenticate_user, 
-    create_access_token, 
-    create_refresh_token, 
+    issue_tokens,
+    rotate_refresh_token,
+    revoke_session,
     set_token_cookie, TokenType,
     get_current_user,
-    get_current_admin_user)
+    get_current_admin_user,
+    authorize_introspection,
+    introspect_tokens)
 
 router = APIRouter()
+jwks_router = APIRouter()
+
+@jwks_router.get("/.well-known/jwks.json")
+async def get_jwks():
+    return Response(
+        content=key_ring.jwks_json,
+        media_type="application/json",
+        headers={"Cache-Control": f"public, max-age={settings.JWKS_CACHE_MAX_AGE}"},
+    )
 
 @router.post("/register/")
 async def create_user(
@@ -27,12 +45,16 @@ async def create_user(
     user: UserCreate,
     session: AsyncSession = Depends(get_db)
 ):
-    existed_user = await AuthRepository.find_user_by_email(user.email, session)
-    if existed_user:
-        logger.error(f"trying to create user with existing email - {user.email}")
+    # фильтр отвечает "точно новый" без запроса к базе; проверка нужна только
+    # чтобы не считать bcrypt зря, окончательно решает уникальный индекс при вставке
+    if await email_filter.might_exist(user.email) and await AuthRepository.email_exists(user.email, session):
+        logger.error("trying to create user with existing email - %s", user.email)
         raise HTTPException(status_code=400, detail="user with this email already exists")
     new_user = await AuthRepository.add_user(user, session)
-    send_user_registered_event(user.email)
+    if new_user is None:
+        logger.error("trying to create user with existing email - %s", user.email)
+        raise HTTPException(status_code=400, detail="user with this email already exists")
+    await send_user_registered_event(user.email)
     # TODO: раскомментировать логику создания токена при регистрации
     # access_token = await create_access_token({"sub": str(new_user.id), "role": str(new_user.role)})
     # refresh_token = await create_refresh_token({"sub": str(new_user.id)})
@@ -41,40 +63,49 @@ async def create_user(
     return {"message": "Вы успешно зарегистрированы"}
 
 @router.post("/login/")
-async def create_tokens(response: Response, user_data: UserAuth, session: AsyncSession = Depends(get_db)):
+async def create_tokens(request: Request, response: Response, user_data: UserAuth, session: AsyncSession = Depends(get_db)):
+    # до обращения к базе и bcrypt, чтобы перебор паролей не съедал CPU
+    await login_rate_limiter.check(email=user_data.email.lower(), ip=client_ip(request))
     user = await authenticate_user(email=user_data.email, password=user_data.password, session=session)
     if user is None:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detatil="неверная почта либо пароль")
-    access_token = await create_access_token({"sub": str(user.id)})
-    refresh_token = await create_refresh_token({"sub": str(user.id)})
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="неверная почта либо пароль")
+    access_token, refresh_token = await issue_tokens(user.id)
     await set_token_cookie(response, TokenType.ACCESS, access_token)
     await set_token_cookie(response, TokenType.REFRESH, refresh_token)
-    logger.info(f"user {user_data.email} logged in")
+    logger.info("user %s logged in", user_data.email)
     return {'access_token': access_token, 'refresh_token': refresh_token}
 
 @router.post("/logout/")
-async def logout_user(response: Response):
+async def logout_user(request: Request, response: Response):
+    await revoke_session(request)
     response.delete_cookie(key="user_access_token")
     response.delete_cookie(key="user_refresh_token", path="/auth/refresh")
     return {'message': 'Пользователь успешно вышел из системы'}
 
 @router.post("/refresh/")
 async def refresh_token(request: Request, response: Response, session: AsyncSession = Depends(get_db)):
-    user_from_token = await get_current_user(request, TokenType.REFRESH, session)
-    new_access_token = await create_access_token({"sub": str(user_from_token.id)})
+    new_access_token, new_refresh_token = await rotate_refresh_token(request, session)
     await set_token_cookie(response, TokenType.ACCESS, new_access_token)
-    return {'new_access_token': new_access_token}
+    await set_token_cookie(response, TokenType.REFRESH, new_refresh_token)
+    return {'new_access_token': new_access_token, 'new_refresh_token': new_refresh_token}
 
+# JSON пользователя сериализуется один раз и переиспользуется из кэша
 @router.get("/user_info/")
-@cache(expire=300)
 async def get_user_info(request: Request, user_id: Optional[int] = None, session: AsyncSession = Depends(get_db)):
     if user_id:
         admin_user = await get_current_admin_user(request, session)
         user = await AuthRepository.find_user_by_id(user_id, session)
-        return user
+        return Response(content=user.json_bytes(), media_type="application/json")
     else:
         user_from_token = await get_current_user(request, TokenType.ACCESS, session)
-        return user_from_token
+        return Response(content=user_from_token.json_bytes(), media_type="application/json")
+
+@router.post("/introspect/", response_model=list[TokenIntrospection])
+async def introspect(request: Request, body: IntrospectRequest, session: AsyncSession = Depends(get_db)):
+    await authorize_introspection(request, session)
+    if len(body.tokens) > settings.INTROSPECTION_MAX_BATCH:
+        raise HTTPException(status_code=400, detail=f"at most {settings.INTROSPECTION_MAX_BATCH} tokens per request")
+    return await introspect_tokens(body.tokens, session)
 
 @router.patch("/update_user/")
 async def update_user_info(
@@ -94,7 +125,7 @@ async def update_user_info(
     if user_update_data.email:
         existed_user = await AuthRepository.find_user_by_email(user_update_data.email, session)
     if existed_user:
-        logger.error(f"email - {existed_user.email} already exists")
+        logger.error("email - %s already exists", existed_user.email)
         raise HTTPException(status_code=400, detail="email already exists")
     new_user_data = await AuthRepository.update_user(user.id, user_update_data, session)
     return new_user_data
@@ -117,11 +148,73 @@ async def delete_user(
     new_user_data = await AuthRepository.update_account_status(user_id, status, session)
     return new_user_data
 
-# TODO: добавить GET /users/all endpoint для admin
+async def stream_users_ndjson(status: Optional[AccountStatus], role: Optional[RoleEnum]):
+    # the request session is closed before a streaming body is sent, so the stream opens its own
+    async with async_session() as session:
+        async for chunk in AuthRepository.stream_users(session, status, role, settings.USERS_STREAM_CHUNK_SIZE):
+            yield "".join(user.model_dump_json() + "\n" for user in chunk)
+
 @router.get("/users/all/")
-@cache(expire=30)
-async def get_all_users(request: Request, session: AsyncSession = Depends(get_db)): 
+async def get_all_users(
+    request: Request,
+    cursor: Optional[int] = None,
+    limit: int = Query(default=100, ge=1, le=1000),
+    status: Optional[AccountStatus] = None,
+    role: Optional[RoleEnum] = None,
+    stream: bool = False,
+    session: AsyncSession = Depends(get_db)
+    ):
+    admin_user = await get_current_admin_user(request, session)
+    if stream:
+        return StreamingResponse(stream_users_ndjson(status, role), media_type="application/x-ndjson")
+    users = await AuthRepository.find_users_page(session, cursor, limit, status, role)
+    next_cursor = users[-1].id if len(users) == limit else None
+    return UsersPage(items=users, next_cursor=next_cursor)
+
+# один запрос вместо user_info на каждый id
+@router.post("/users/lookup/", response_model=UsersLookup)
+async def lookup_users(
+    request: Request,
+    body: UsersLookupRequest,
+    session: AsyncSession = Depends(get_db)
+    ):
+    admin_user = await get_current_admin_user(request, session)
+    if len(body.ids) + len(body.emails) > settings.USERS_LOOKUP_MAX_BATCH:
+        raise HTTPException(status_code=400, detail=f"at most {settings.USERS_LOOKUP_MAX_BATCH} ids and emails per request")
+    by_id, by_email = await AuthRepository.lookup_users(body.ids, body.emails, session)
+    return UsersLookup(by_id=by_id, by_email=by_email)
+
+@router.post("/users/import/")
+async def import_users_from_body(
+    request: Request,
+    format: str = Query(default="csv", pattern="^(csv|ndjson)$"),
+    session: AsyncSession = Depends(get_db)
+    ):
+    admin_user = await get_current_admin_user(request, session)
+    report = await import_users(iter_lines(request.stream()), format, session)
+    logger.info("admin %s imported %s users", admin_user.email, report.inserted)
+    return report.as_dict()
+
+# профилировщик event loop, стеки отдаются в collapsed формате для flamegraph
+@router.post("/admin/profiler/")
+async def toggle_profiler(
+    request: Request,
+    enabled: bool,
+    interval: float = Query(default=0.01, ge=0.001, le=1.0),
+    session: AsyncSession = Depends(get_db)
+    ):
+    admin_user = await get_current_admin_user(request, session)
+    if enabled:
+        profiler.start(interval)
+    else:
+        profiler.stop()
+    return {"running": profiler.running, "interval": profiler.interval, "samples": profiler.samples}
+
+@router.get("/admin/profiler/")
+async def get_profile(
+    request: Request,
+    limit: Optional[int] = Query(default=None, ge=1),
+    session: AsyncSession = Depends(get_db)
+    ):
     admin_user = await get_current_admin_user(request, session)
-    users = await AuthRepository.find_all_users(session)
-    return users
-    
\ No newline at end of file
+    return PlainTextResponse(profiler.collapsed(limit))
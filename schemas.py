@@ -1,7 +1,9 @@
-from typing import Optional
+from typing import Any, Optional
 from datetime import datetime
 
-from pydantic import BaseModel, EmailStr
+import msgpack
+from fastapi_cache.coder import Coder
+from pydantic import BaseModel, EmailStr, PrivateAttr
 
 from database.models import RoleEnum, AccountStatus
 
@@ -18,17 +20,94 @@ class UserCreate(UserAuth):
 class CreateAdminUser(UserAuth):
     role: RoleEnum
 
-class UserRead(UserAuth):
+class UserRead(BaseModel):
+    # everything about a user that leaves the repository, never the password hash
     id: int
+    email: EmailStr
     balance: float
     role: RoleEnum
     status: AccountStatus
     created_at: datetime
+    _json: Optional[bytes] = PrivateAttr(default=None)
+
+    class Config:
+        from_attributes = True
+
+    @classmethod
+    def from_row(cls, row) -> "UserRead":
+        # rows of our own table are valid already, skip the validators
+        return cls.model_construct(
+            id=row.id,
+            email=row.email,
+            balance=float(row.balance),
+            role=RoleEnum(row.role),
+            status=AccountStatus(row.status),
+            created_at=row.created_at,
+        )
+
+    def json_bytes(self) -> bytes:
+        # serialized once per object; cached users are shared by many requests
+        if self._json is None:
+            self._json = self.__pydantic_serializer__.to_json(self)
+        return self._json
+
+USER_RECORD_VERSION = 1
+
+class UserRecordCoder(Coder):
+    # cache record of a UserRead: a msgpack array of the field values. Only
+    # this service writes it, so a hit is rebuilt without validation; a record
+    # of another version fails to decode and is treated as a miss
+    @classmethod
+    def encode(cls, value: UserRead) -> bytes:
+        return msgpack.packb([
+            USER_RECORD_VERSION,
+            value.id,
+            value.email,
+            value.balance,
+            RoleEnum(value.role).value,
+            AccountStatus(value.status).value,
+            value.created_at.isoformat(),
+        ])
+
+    @classmethod
+    def decode(cls, value: bytes) -> UserRead:
+        version, *fields = msgpack.unpackb(value)
+        if version != USER_RECORD_VERSION:
+            raise ValueError(f"unknown user record version {version}")
+        id, email, balance, role, status, created_at = fields
+        return UserRead.model_construct(
+            id=id,
+            email=email,
+            balance=balance,
+            role=RoleEnum(role),
+            status=AccountStatus(status),
+            created_at=datetime.fromisoformat(created_at),
+        )
 
 class UserUpdate(UserAuth):
     email: Optional[EmailStr]
     password: Optional[str]
 
+class UsersPage(BaseModel):
+    items: list[UserRead]
+    next_cursor: Optional[int] = None
+
+class UsersLookupRequest(BaseModel):
+    ids: list[int] = []
+    emails: list[EmailStr] = []
+
+class UsersLookup(BaseModel):
+    # same order as the request, None where there is no such user
+    by_id: list[Optional[UserRead]]
+    by_email: list[Optional[UserRead]]
 
-    
+class IntrospectRequest(BaseModel):
+    tokens: list[str]
 
+class TokenIntrospection(BaseModel):
+    active: bool
+    error: Optional[str] = None
+    claims: Optional[dict[str, Any]] = None
+    user_id: Optional[int] = None
+    role: Optional[RoleEnum] = None
+    status: Optional[AccountStatus] = None
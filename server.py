@@ -0,0 +1,37 @@
+import os
+import shutil
+import tempfile
+
+import uvicorn
+
+from config.config import settings
+
+
+def prepare_multiprocess_metrics():
+    # workers write their metrics to files in this directory and /metrics
+    # aggregates them; it is emptied before the workers start and before
+    # anything in this process has created a metric
+    metrics_dir = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+    if not metrics_dir:
+        metrics_dir = os.path.join(tempfile.gettempdir(), f"auth-metrics-{settings.SERVER_PORT}")
+        os.environ["PROMETHEUS_MULTIPROC_DIR"] = metrics_dir
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir)
+
+
+if __name__ == "__main__":
+    if settings.SERVER_WORKERS > 1:
+        prepare_multiprocess_metrics()
+    uvicorn.run(
+        "main:app",
+        host=settings.SERVER_HOST,
+        port=settings.SERVER_PORT,
+        workers=settings.SERVER_WORKERS,
+        loop="uvloop",
+        http="httptools",
+        # on SIGTERM stop accepting, let in-flight requests finish, then run the lifespan shutdown
+        timeout_graceful_shutdown=settings.SERVER_GRACEFUL_TIMEOUT,
+        timeout_keep_alive=settings.SERVER_KEEPALIVE_TIMEOUT,
+        proxy_headers=True,
+        log_config=None,
+    )
@@ -0,0 +1,77 @@
+"""Shared setup for the behaviour tests.
+
+    pip install -r requirements.txt -r tests/requirements.txt
+    python -m pytest -q tests
+
+Redis is fakeredis and the database a throwaway SQLite file, like in
+benchmarks/; async tests run on anyio's pytest plugin.
+"""
+import os
+import tempfile
+
+os.environ.setdefault("SECRET_KEY", "test")
+os.environ.setdefault("ALGORITHM", "HS256")
+os.environ.setdefault(
+    "AUTH_DATABASE_URL",
+    f"sqlite+aiosqlite:///{os.path.join(tempfile.mkdtemp(prefix='auth-tests-'), 'auth.db')}",
+)
+os.environ.setdefault("REDIS_URL", "redis://localhost:6379/0")
+os.environ.setdefault("KAFKA_PRODUCER", "fake")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+os.environ.setdefault("PASSWORD_BCRYPT_ROUNDS", "4")
+
+import fakeredis
+import httpx
+import pytest
+from fastapi_cache import FastAPICache
+from fastapi_cache.backends.redis import RedisBackend
+
+from cache import local_cache, invalidation_log
+from database.database import async_engine, async_session, create_tables, delete_tables
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture
+async def redis():
+    client = fakeredis.FakeAsyncRedis(server=fakeredis.FakeServer())
+    FastAPICache.reset()
+    FastAPICache.init(RedisBackend(client), prefix="test")
+    local_cache.clear()
+    invalidation_log.bump_all()
+    yield client
+    await client.close()
+
+
+@pytest.fixture
+async def session():
+    await create_tables()
+    async with async_session() as db_session:
+        yield db_session
+    await delete_tables()
+    # pooled connections belong to this test's event loop
+    await async_engine.dispose()
+
+
+@pytest.fixture
+async def client(monkeypatch):
+    # the whole app with its lifespan, every Redis client on one fake server
+    import main
+
+    server = fakeredis.FakeServer()
+
+    async def from_url(*args, **kwargs):
+        return fakeredis.FakeAsyncRedis(server=server)
+
+    monkeypatch.setattr(main.aioredis, "from_url", from_url)
+    FastAPICache.reset()
+    local_cache.clear()
+    async with main.lifespan(main.app):
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as http:
+            yield http
+    await delete_tables()
+    await async_engine.dispose()
@@ -0,0 +1,138 @@
+import time
+from typing import Optional
+
+import pytest
+
+from auth import legacy_token_id
+from config.config import settings
+from jwt_keys import key_ring
+from revocation import revocation_list
+
+pytestmark = pytest.mark.anyio
+
+USER = {"email": "user@example.com", "password": "password123"}
+ADMIN = {"email": "admin@example.com", "password": "admin"}
+SERVICE = {"authorization": "Bearer service-secret"}
+
+
+@pytest.fixture(autouse=True)
+def service_token(monkeypatch):
+    monkeypatch.setattr(settings, "INTROSPECTION_CLIENT_TOKENS", ["service-secret"])
+
+
+async def login(client) -> dict:
+    response = await client.post("/auth/register/", json=USER)
+    assert response.status_code in (200, 201, 400)
+    response = await client.post("/auth/login/", json=USER)
+    assert response.status_code == 200
+    client.cookies.clear()
+    return response.json()
+
+
+async def introspect(client, tokens: list[str], headers: Optional[dict] = None, session: Optional[str] = None):
+    client.cookies.clear()
+    if session:
+        client.cookies.set("user_access_token", session)
+    return await client.post("/auth/introspect/", json={"tokens": tokens}, headers=headers)
+
+
+def use_cookie(client, name: str, token: str):
+    # only this token, not the ones set by earlier responses
+    client.cookies.clear()
+    client.cookies.set(name, token)
+
+
+async def refresh(client, token: str):
+    use_cookie(client, "user_refresh_token", token)
+    return await client.post("/auth/refresh/")
+
+
+async def user_info(client, token: str):
+    use_cookie(client, "user_access_token", token)
+    return await client.get("/auth/user_info/")
+
+
+async def user_id(client, tokens: dict) -> int:
+    return (await user_info(client, tokens["access_token"])).json()["id"]
+
+
+def legacy_token(sub: int, lifetime: float) -> str:
+    # issued before rotation and the type claim: no jti, no sid, no type
+    return key_ring.encode({"sub": str(sub), "exp": int(time.time() + lifetime)})
+
+
+async def test_refresh_rotates_the_tokens(client):
+    tokens = await login(client)
+    response = await refresh(client, tokens["refresh_token"])
+    assert response.status_code == 200
+    assert (await user_info(client, response.cookies["user_access_token"])).status_code == 200
+    assert (await refresh(client, response.cookies["user_refresh_token"])).status_code == 200
+
+
+async def test_refresh_token_reuse_revokes_the_session(client):
+    tokens = await login(client)
+    rotated = await refresh(client, tokens["refresh_token"])
+    assert rotated.status_code == 200
+    assert (await refresh(client, tokens["refresh_token"])).status_code == 401
+    # the session is gone, for the old and the new tokens alike
+    assert (await user_info(client, tokens["access_token"])).status_code == 401
+    assert (await user_info(client, rotated.cookies["user_access_token"])).status_code == 401
+    assert (await refresh(client, rotated.cookies["user_refresh_token"])).status_code == 401
+
+
+async def test_tokens_are_only_accepted_as_their_type(client):
+    tokens = await login(client)
+    assert (await user_info(client, tokens["refresh_token"])).status_code == 401
+    assert (await refresh(client, tokens["access_token"])).status_code == 401
+
+
+async def test_logout_revokes_the_session(client):
+    tokens = await login(client)
+    use_cookie(client, "user_access_token", tokens["access_token"])
+    response = await client.post("/auth/logout/")
+    assert response.status_code == 200
+    assert (await user_info(client, tokens["access_token"])).status_code == 401
+    assert (await refresh(client, tokens["refresh_token"])).status_code == 401
+
+
+async def test_legacy_refresh_token_is_exchanged_once(client):
+    sub = await user_id(client, await login(client))
+    token = legacy_token(sub, settings.REFRESH_TOKEN_TTL_DAYS * 24 * 3600)
+    assert (await refresh(client, token)).status_code == 200
+    assert (await refresh(client, token)).status_code == 401
+
+
+async def test_legacy_refresh_token_is_not_an_access_token(client):
+    sub = await user_id(client, await login(client))
+    token = legacy_token(sub, settings.REFRESH_TOKEN_TTL_DAYS * 24 * 3600)
+    assert (await user_info(client, token)).status_code == 401
+    introspection = (await introspect(client, [token], headers=SERVICE)).json()
+    assert introspection[0]["active"] is False
+
+
+async def test_spent_legacy_token_close_to_expiry_is_not_an_access_token(client):
+    # in its last minutes a legacy refresh token looks like an access token,
+    # once it has been exchanged it is turned away all the same
+    sub = await user_id(client, await login(client))
+    token = legacy_token(sub, 60)
+    assert (await user_info(client, token)).status_code == 200
+    assert await revocation_list.claim(legacy_token_id(token), ttl=60)
+    assert (await user_info(client, token)).status_code == 401
+
+
+async def test_introspection_needs_a_service_token_or_an_admin(client):
+    tokens = await login(client)
+    response = await introspect(client, [tokens["access_token"]])
+    assert response.status_code == 401
+    response = await introspect(client, [tokens["access_token"]], headers={"authorization": "Bearer guessed"})
+    assert response.status_code == 401
+    response = await introspect(client, [tokens["access_token"]], session=tokens["access_token"])
+    assert response.status_code == 403
+
+    response = await introspect(client, [tokens["access_token"], "garbage"], headers=SERVICE)
+    assert response.status_code == 200
+    assert [result["active"] for result in response.json()] == [True, False]
+
+    admin = (await client.post("/auth/login/", json=ADMIN)).json()
+    response = await introspect(client, [tokens["access_token"]], session=admin["access_token"])
+    assert response.status_code == 200
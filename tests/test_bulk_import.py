@@ -0,0 +1,65 @@
+import pytest
+from passlib.context import CryptContext
+from sqlalchemy import func, select
+
+from bulk_import import UserImporter, import_users, iter_rows
+from database.models import Users
+from hashing import PasswordHasher
+
+pytestmark = pytest.mark.anyio
+
+context = CryptContext(schemes=["bcrypt"], bcrypt__rounds=4)
+HASHED = context.hash("password")
+
+
+async def lines_of(text: str):
+    for line in text.split("\n"):
+        yield line
+
+
+async def rows_of(text: str, fmt: str = "csv") -> list:
+    return [row async for row in iter_rows(lines_of(text), fmt)]
+
+
+async def test_quoted_newlines_stay_in_one_record():
+    rows = await rows_of('email,password,note\na@example.com,pw,"two\nlines, and a comma"\n\nb@example.com,pw,plain')
+    assert rows == [
+        (2, {"email": "a@example.com", "password": "pw", "note": "two\nlines, and a comma"}, None),
+        (5, {"email": "b@example.com", "password": "pw", "note": "plain"}, None),
+    ]
+
+
+async def test_unterminated_quote_is_reported():
+    rows = await rows_of('email,password\na@example.com,"pw')
+    assert rows == [(2, None, "malformed csv row: unterminated quoted field")]
+
+
+async def test_malformed_ndjson_line_does_not_stop_the_import():
+    rows = await rows_of('{"email": "a@example.com"}\n{"email": \n{"email": "b@example.com"}', "ndjson")
+    assert [line for line, _, _ in rows] == [1, 2, 3]
+    assert rows[1][1] is None and rows[1][2].startswith("malformed ndjson row")
+
+
+async def test_failed_batch_is_reported_and_the_import_goes_on(session, monkeypatch):
+    calls = 0
+    insert_rows = UserImporter._insert_rows
+
+    async def fail_first_batch(self, rows):
+        nonlocal calls
+        calls += 1
+        if calls == 1:
+            raise RuntimeError("connection lost")
+        return await insert_rows(self, rows)
+
+    monkeypatch.setattr(UserImporter, "_insert_rows", fail_first_batch)
+    monkeypatch.setattr("bulk_import.settings.BULK_IMPORT_BATCH_SIZE", 2)
+    text = "email,password\n" + "\n".join(f"user{i}@example.com,{HASHED}" for i in range(4))
+    hasher = PasswordHasher(executor="thread", workers=1, max_queue=1)
+    report = await import_users(lines_of(text), "csv", session, hasher, context)
+
+    assert report.processed == 4
+    assert report.inserted == 2
+    assert report.failed == 2
+    assert [error["line"] for error in report.errors] == [2, 3]
+    assert all(error["error"] == "batch not written: connection lost" for error in report.errors)
+    assert await session.scalar(select(func.count()).select_from(Users)) == 2
@@ -0,0 +1,104 @@
+import asyncio
+
+import pytest
+
+import cache
+from cache import cached, cache_key, fill_guard, get_many, set_many, CacheInvalidator, InvalidationLog
+
+pytestmark = pytest.mark.anyio
+
+
+async def invalidate_in_other_worker(monkeypatch, *full_keys: str):
+    # the shared Redis sees the eviction, this worker's invalidation log
+    # does not until the pub/sub message arrives
+    with monkeypatch.context() as patch:
+        patch.setattr(cache, "invalidation_log", InvalidationLog(maxsize=100))
+        await CacheInvalidator(channel="test").invalidate(*full_keys)
+
+
+class Table:
+    # a row read by a fill that can be held between reading and returning
+    def __init__(self, value):
+        self.value = value
+        self.reads = 0
+        self.read = asyncio.Event()
+        self.release = asyncio.Event()
+        self.release.set()
+
+    async def load(self, user_id: int):
+        self.reads += 1
+        value = self.value
+        self.read.set()
+        await self.release.wait()
+        return {"id": user_id, "status": value}
+
+
+def cached_table(namespace: str, table: Table):
+    return cached(namespace, key=lambda user_id: str(user_id), expire=300)(table.load)
+
+
+async def test_concurrent_misses_share_one_fill(redis):
+    table = Table("active")
+    table.release.clear()
+    load = cached_table("test-coalesce", table)
+    lookups = [asyncio.create_task(load(1)) for _ in range(20)]
+    await table.read.wait()
+    table.release.set()
+    results = await asyncio.gather(*lookups)
+    assert table.reads == 1
+    assert all(result == {"id": 1, "status": "active"} for result in results)
+
+
+async def test_fill_invalidated_in_this_worker_is_not_stored(redis):
+    table = Table("active")
+    table.release.clear()
+    load = cached_table("test-local-stale", table)
+    lookup = asyncio.create_task(load(1))
+    await table.read.wait()
+    table.value = "banned"
+    await cache.invalidate(cache_key("test-local-stale", "1"))
+    table.release.set()
+    assert (await lookup)["status"] == "active"
+    assert await redis.get(cache_key("test-local-stale", "1")) is None
+    assert (await load(1))["status"] == "banned"
+
+
+async def test_fill_invalidated_in_another_worker_is_not_stored(redis, monkeypatch):
+    # the fill reads the row, another worker commits a ban and deletes the
+    # key, and the fill writes before the eviction reaches this worker
+    table = Table("active")
+    table.release.clear()
+    load = cached_table("test-remote-stale", table)
+    lookup = asyncio.create_task(load(1))
+    await table.read.wait()
+    table.value = "banned"
+    await invalidate_in_other_worker(monkeypatch, cache_key("test-remote-stale", "1"))
+    table.release.set()
+    assert (await lookup)["status"] == "active"
+    assert await redis.get(cache_key("test-remote-stale", "1")) is None
+    assert cache.local_cache.get(cache_key("test-remote-stale", "1")) is None
+    assert (await load(1))["status"] == "banned"
+
+
+async def test_batch_fill_skips_keys_invalidated_in_another_worker(redis, monkeypatch):
+    cached_table("test-batch", Table("active"))
+    guard = fill_guard()
+    assert await get_many("test-batch", ["1", "2"], guard) == {}
+    await invalidate_in_other_worker(monkeypatch, cache_key("test-batch", "1"))
+    await set_many("test-batch", {"1": {"id": 1, "status": "active"}, "2": {"id": 2, "status": "active"}}, guard)
+    assert await redis.get(cache_key("test-batch", "1")) is None
+    assert await redis.get(cache_key("test-batch", "2")) is not None
+    cache.local_cache.clear()
+    assert await get_many("test-batch", ["1", "2"]) == {"2": {"id": 2, "status": "active"}}
+
+
+async def test_fill_after_invalidation_is_stored(redis):
+    table = Table("active")
+    load = cached_table("test-refill", table)
+    await load(1)
+    await cache.invalidate(cache_key("test-refill", "1"))
+    table.value = "banned"
+    assert (await load(1))["status"] == "banned"
+    cache.local_cache.clear()
+    assert (await load(1))["status"] == "banned"
+    assert table.reads == 2
@@ -0,0 +1,25 @@
+import pytest
+from prometheus_client import REGISTRY
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+from database.database import async_engine
+
+pytestmark = pytest.mark.anyio
+
+
+def observed(metric: str, statement: str) -> float:
+    return REGISTRY.get_sample_value(metric, {"statement": statement}) or 0
+
+
+async def test_failed_statement_leaves_no_timer_behind():
+    errors, selects = observed("db_query_errors_total", "SELECT"), observed("db_query_duration_seconds_count", "SELECT")
+    async with async_engine.connect() as conn:
+        with pytest.raises(OperationalError):
+            await conn.execute(text("SELECT * FROM no_such_table"))
+        assert (await conn.execute(text("SELECT 1"))).scalar() == 1
+        assert "query_start" not in conn.sync_connection.info
+    await async_engine.dispose()
+
+    assert observed("db_query_errors_total", "SELECT") == errors + 1
+    assert observed("db_query_duration_seconds_count", "SELECT") == selects + 1
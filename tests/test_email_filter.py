@@ -0,0 +1,40 @@
+import asyncio
+
+import pytest
+from sqlalchemy import delete
+
+from database.models import Users
+from email_filter import EmailFilter
+
+pytestmark = pytest.mark.anyio
+
+
+async def wait_for(condition, timeout: float = 5.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not await condition():
+        assert asyncio.get_running_loop().time() < deadline, "timed out"
+        await asyncio.sleep(0.05)
+
+
+async def test_filter_is_rebuilt_periodically(redis, session):
+    session.add(Users(email="old@example.com", password="x"))
+    await session.commit()
+    email_filter = EmailFilter(key="test-emails", capacity=1000, error_rate=0.001, rebuild_interval=1)
+    await email_filter.start(redis)
+    try:
+        await wait_for(lambda: email_filter.might_exist("old@example.com"))
+        assert not await email_filter.might_exist("new@example.com")
+
+        # renamed behind the filter's back: only a rebuild forgets the old address
+        await session.execute(delete(Users).where(Users.email == "old@example.com"))
+        session.add(Users(email="renamed@example.com", password="x"))
+        await session.commit()
+
+        async def rebuilt():
+            return not await email_filter.might_exist("old@example.com")
+
+        await wait_for(rebuilt)
+        assert await email_filter.might_exist("renamed@example.com")
+    finally:
+        await email_filter.stop()
+    assert email_filter._task is None
@@ -0,0 +1,41 @@
+import socket
+
+import grpc
+import pytest
+
+from config.config import settings
+from grpc_server import start_grpc_server
+from proto import introspection_pb2, introspection_pb2_grpc
+
+pytestmark = pytest.mark.anyio
+
+
+def free_port() -> int:
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+async def test_without_tls_only_the_local_host_is_served(session):
+    port = free_port()
+    server = await start_grpc_server(port)
+    try:
+        async with grpc.aio.insecure_channel(f"127.0.0.1:{port}") as channel:
+            stub = introspection_pb2_grpc.TokenIntrospectionStub(channel)
+            response = await stub.Introspect(introspection_pb2.IntrospectRequest(tokens=["garbage"]))
+        assert [result.active for result in response.results] == [False]
+        # nothing listens on the other addresses of the machine
+        with socket.socket() as probe:
+            probe.settimeout(1)
+            outside = socket.gethostbyname(socket.gethostname())
+            if outside.startswith("127."):
+                pytest.skip("no non-loopback address to probe")
+            assert probe.connect_ex((outside, port)) != 0
+    finally:
+        await server.stop(None)
+
+
+async def test_partial_tls_settings_are_refused(monkeypatch):
+    monkeypatch.setattr(settings, "GRPC_TLS_CERT_FILE", "server.pem")
+    with pytest.raises(ValueError):
+        await start_grpc_server(free_port())
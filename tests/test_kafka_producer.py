@@ -0,0 +1,84 @@
+import asyncio
+import fcntl
+import json
+
+import pytest
+
+from kafka_producer import EventProducer
+
+pytestmark = pytest.mark.anyio
+
+
+def producer(tmp_path, **kwargs) -> EventProducer:
+    options = dict(queue_size=2, overflow_policy="spill", poll_interval=0.01, replay_interval=0.05)
+    options.update(kwargs)
+    return EventProducer(conf={}, fake=True, spill_path=str(tmp_path / "spill.ndjson"), **options)
+
+
+def spill_line(number: int) -> str:
+    return json.dumps({"topic": "t", "value": json.dumps({"n": number})}) + "\n"
+
+
+def delivered(event_producer: EventProducer) -> list[int]:
+    return [json.loads(value)["n"] for _, value in event_producer.producer.delivered]
+
+
+async def wait_for(condition, timeout: float = 5.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        assert asyncio.get_running_loop().time() < deadline, "timed out"
+        await asyncio.sleep(0.01)
+
+
+async def test_overflow_is_spilled_and_replayed(tmp_path):
+    event_producer = producer(tmp_path)
+    await event_producer.start()
+    # the producer loop does not get to run between these sends
+    for number in range(10):
+        await event_producer.send("t", {"n": number})
+    assert (tmp_path / "spill.ndjson").exists()
+
+    await wait_for(lambda: len(event_producer.producer.delivered) == 10)
+    await event_producer.stop()
+    assert sorted(delivered(event_producer)) == list(range(10))
+    assert not (tmp_path / "spill.ndjson").exists()
+
+
+async def test_replay_resumes_the_interrupted_replay_first(tmp_path):
+    (tmp_path / "spill.ndjson.replay").write_text(spill_line(0) + "not json\n" + spill_line(1) + '{"topic": "t"')
+    (tmp_path / "spill.ndjson").write_text(spill_line(2))
+    event_producer = producer(tmp_path, queue_size=10)
+    await event_producer.start()
+
+    await wait_for(lambda: len(event_producer.producer.delivered) == 3)
+    await event_producer.stop()
+    # malformed and cut off lines are dropped, the older replay goes first
+    assert delivered(event_producer) == [0, 1, 2]
+    assert not (tmp_path / "spill.ndjson.replay").exists()
+
+
+async def test_replay_takes_what_fits_into_the_queue(tmp_path):
+    (tmp_path / "spill.ndjson").write_text("".join(spill_line(number) for number in range(5)))
+    event_producer = producer(tmp_path, queue_size=2, replay_interval=60)
+    await event_producer.start()
+
+    await wait_for(lambda: len(event_producer.producer.delivered) == 2)
+    remaining = (tmp_path / "spill.ndjson").read_text().splitlines()
+    assert [json.loads(json.loads(line)["value"])["n"] for line in remaining] == [2, 3, 4]
+    await event_producer.stop()
+
+
+async def test_locked_spill_file_keeps_events_in_memory(tmp_path):
+    event_producer = producer(tmp_path)
+    await event_producer.start()
+    # another worker replaying holds the lock
+    with open(tmp_path / "spill.ndjson.lock", "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        for number in range(6):
+            await event_producer.send("t", {"n": number})
+        assert event_producer._unspilled
+        assert not (tmp_path / "spill.ndjson").exists()
+
+    await wait_for(lambda: len(event_producer.producer.delivered) == 6)
+    await event_producer.stop()
+    assert sorted(delivered(event_producer)) == list(range(6))
@@ -0,0 +1,73 @@
+import pytest
+from fastapi import HTTPException
+
+from rate_limit import RateLimiter
+
+pytestmark = pytest.mark.anyio
+
+
+def limiter(redis, **limits) -> RateLimiter:
+    rate_limiter = RateLimiter(name="test", limits=limits, window=60.0, local_maxsize=100)
+    if redis is not None:
+        rate_limiter.start(redis)
+    return rate_limiter
+
+
+async def rejection(rate_limiter: RateLimiter, **identities):
+    try:
+        await rate_limiter.check(**identities)
+    except HTTPException as e:
+        assert e.status_code == 429
+        return e
+    return None
+
+
+async def test_per_email_limit(redis):
+    rate_limiter = limiter(redis, email=3)
+    for _ in range(3):
+        assert await rejection(rate_limiter, email="a@example.com") is None
+    error = await rejection(rate_limiter, email="a@example.com")
+    assert error is not None and int(error.headers["Retry-After"]) >= 1
+    assert await rejection(rate_limiter, email="b@example.com") is None
+
+
+async def test_limit_is_shared_between_processes(redis):
+    # each limiter has its own local buckets, the Redis ones are shared
+    first, second = limiter(redis, email=2), limiter(redis, email=2)
+    assert await rejection(first, email="a@example.com") is None
+    assert await rejection(second, email="a@example.com") is None
+    assert await rejection(first, email="a@example.com") is not None
+
+
+async def test_global_reject_keeps_the_email_budget(redis):
+    rate_limiter = limiter(redis, email=2, ip=100, **{"global": 100})
+    other_process = limiter(redis, **{"global": 1})
+    # another process used up the global bucket
+    await other_process.check()
+    for _ in range(3):
+        assert await rejection(rate_limiter, email="a@example.com", ip="10.0.0.1") is not None
+    # neither this process nor Redis charged the email bucket for the rejects
+    await redis.delete("rate-limit:test:global")
+    for _ in range(2):
+        assert await rejection(rate_limiter, email="a@example.com", ip="10.0.0.1") is None
+    assert await rejection(rate_limiter, email="a@example.com", ip="10.0.0.1") is not None
+
+
+async def test_scope_without_identity_is_skipped(redis):
+    rate_limiter = limiter(redis, email=1, ip=1)
+    assert await rejection(rate_limiter, ip="10.0.0.1") is None
+    assert await rejection(rate_limiter, email="a@example.com") is None
+
+
+async def test_local_buckets_cap_a_process_without_redis():
+    class Unreachable:
+        def register_script(self, script):
+            async def run(keys, args):
+                raise ConnectionError("redis is down")
+            return run
+
+    rate_limiter = limiter(Unreachable(), email=2)
+    assert await rejection(rate_limiter, email="a@example.com") is None
+    assert await rejection(rate_limiter, email="a@example.com") is None
+    error = await rejection(rate_limiter, email="a@example.com")
+    assert error is not None